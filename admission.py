@@ -0,0 +1,155 @@
+"""Admission control перед очередью обновлений: приоритеты, сброс при перегрузке и лимиты на пользователя"""
+import time
+import threading
+from collections import OrderedDict, namedtuple
+
+from metrics import ADMISSION_DECISIONS
+
+# Приоритеты обновлений
+HIGH = 'high'      # подтверждение заявки
+NORMAL = 'normal'  # шаги диалога
+LOW = 'low'        # медиафайлы, правки сообщений и служебные обновления
+
+# Решения
+ACCEPT = 'accept'  # поставить в очередь
+SHED = 'shed'      # отбросить и ответить Telegram 200, чтобы он не повторял доставку (только флуд)
+BUSY = 'busy'      # ответить 503: Telegram повторит доставку позже
+
+Decision = namedtuple('Decision', 'outcome priority reason notify')
+
+
+def update_message(data):
+    """Сообщение из сырого обновления (message или edited_message)"""
+    return data.get('message') or data.get('edited_message')
+
+
+def classify(data, confirm_texts):
+    """Приоритет сырого обновления без построения объекта Update"""
+    message = data.get('message')
+    if message is None:
+        return NORMAL if 'callback_query' in data else LOW
+    if message.get('photo') or message.get('video') or message.get('document'):
+        return LOW
+    if message.get('text') in confirm_texts:
+        return HIGH
+    return NORMAL
+
+
+def media_size(data):
+    """Размер вложения в байтах (для фото — самого крупного размера, который и скачивается)"""
+    message = update_message(data) or {}
+    if message.get('photo'):
+        return message['photo'][-1].get('file_size') or 0
+    for kind in ('video', 'document'):
+        if message.get(kind):
+            return message[kind].get('file_size') or 0
+    return 0
+
+
+def sender(data):
+    """(user_id, chat_id, language_code) отправителя обновления или None"""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get('from')
+        if user:
+            chat = value.get('chat') or (value.get('message') or {}).get('chat') or user
+            return user['id'], chat['id'], user.get('language_code')
+    return None
+
+
+class _UserLimits:
+    """Два token bucket пользователя: сообщения и байты медиа"""
+
+    __slots__ = ('messages', 'media', 'updated', 'notified')
+
+    def __init__(self, messages, media, now):
+        self.messages = messages
+        self.media = media
+        self.updated = now
+        self.notified = 0.0
+
+
+class AdmissionController:
+    """Решает, принимать ли обновление, до постановки в очередь.
+
+    Глубина очереди сравнивается с двумя порогами. Выше high_water
+    откладываются низкоприоритетные обновления (медиа, служебные), выше
+    capacity - reserve — и шаги диалога, а оставшийся резерв очереди
+    достаётся только подтверждениям заявок. Отложенное обновление получает
+    503, и Telegram повторит доставку: вложения заявки при перегрузке не
+    теряются. Независимо от нагрузки у каждого пользователя есть token
+    bucket на сообщения и на байты медиа в минуту. Сверх него обновления
+    отбрасываются (флуд), и только об этом пользователь получает
+    предупреждение; подтверждения заявок расходуют токены, но не
+    отбрасываются.
+
+    Методы потокобезопасны: admit() вызывается из потоков HTTP-сервера.
+    """
+
+    def __init__(self, capacity, confirm_texts, high_water=0.5, reserve=0.1,
+                 messages_per_minute=30, media_bytes_per_minute=100 * 1024 * 1024,
+                 notice_interval=60.0, users=10000):
+        self.capacity = capacity
+        self.confirm_texts = frozenset(confirm_texts)
+        self.high_water = int(capacity * high_water)
+        self.normal_limit = int(capacity * (1 - reserve))
+        self.message_rate = messages_per_minute / 60
+        self.message_burst = messages_per_minute
+        self.media_rate = media_bytes_per_minute / 60
+        self.media_burst = media_bytes_per_minute
+        self.notice_interval = notice_interval
+        self.users = users
+        self._limits = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _decide(self, outcome, priority, reason, user_limits=None, now=None):
+        ADMISSION_DECISIONS.inc(priority=priority, outcome=outcome, reason=reason)
+        notify = False
+        if reason == 'flood' and user_limits is not None and now - user_limits.notified >= self.notice_interval:
+            # Сообщаем о сбросе не чаще раза в notice_interval, чтобы не отвечать на каждое сообщение флуда
+            user_limits.notified = now
+            notify = True
+        return Decision(outcome, priority, reason, notify)
+
+    def _user_limits(self, user_id, now):
+        limits = self._limits.get(user_id)
+        if limits is None:
+            limits = self._limits[user_id] = _UserLimits(self.message_burst, self.media_burst, now)
+            while len(self._limits) > self.users:
+                self._limits.popitem(last=False)
+        else:
+            self._limits.move_to_end(user_id)
+            elapsed = now - limits.updated
+            limits.messages = min(self.message_burst, limits.messages + elapsed * self.message_rate)
+            limits.media = min(self.media_burst, limits.media + elapsed * self.media_rate)
+            limits.updated = now
+        return limits
+
+    def admit(self, data, depth):
+        """Decision для сырого обновления при текущей глубине очереди"""
+        priority = classify(data, self.confirm_texts)
+        if depth >= self.capacity:
+            return self._decide(BUSY, priority, 'queue_full')
+        if priority == NORMAL and depth >= self.normal_limit:
+            return self._decide(BUSY, priority, 'overload')
+
+        who = sender(data)
+        if who is None:
+            if priority == LOW and depth >= self.high_water:
+                return self._decide(BUSY, priority, 'overload')
+            return self._decide(ACCEPT, priority, 'ok')
+
+        now = time.monotonic()
+        size = media_size(data)
+        with self._lock:
+            limits = self._user_limits(who[0], now)
+            if priority != HIGH:
+                if limits.messages < 1 or (size and limits.media < size):
+                    return self._decide(SHED, priority, 'flood', limits, now)
+            # Токены не расходуем: Telegram повторит доставку, и тогда они будут списаны
+            if priority == LOW and depth >= self.high_water:
+                return self._decide(BUSY, priority, 'overload')
+            limits.messages = max(limits.messages - 1, 0.0)
+            limits.media = max(limits.media - size, 0.0)
+        return self._decide(ACCEPT, priority, 'ok')
@@ -0,0 +1,68 @@
+"""Объединение альбомов (media_group_id) в одну пачку"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AlbumCollector:
+    """Буферизует обновления одного альбома и обрабатывает их одним вызовом.
+
+    Telegram присылает каждый файл альбома отдельным обновлением. Файлы
+    копятся, пока между ними проходит меньше window секунд (но не дольше
+    max_wait), после чего callback(user_id, items, **extra) вызывается один
+    раз для всего альбома.
+    """
+
+    def __init__(self, callback, window=1.0, max_wait=3.0):
+        self.callback = callback
+        self.window = window
+        self.max_wait = max_wait
+        self._albums = {}
+        self._running = {}
+        self._tasks = set()
+
+    def add(self, user_id, group_id, item, **extra):
+        """Добавляет файл в альбом и переносит срок обработки"""
+        key = (user_id, group_id)
+        loop = asyncio.get_running_loop()
+        album = self._albums.get(key)
+        if album is None:
+            album = self._albums[key] = {'items': [], 'extra': extra, 'deadline': loop.time() + self.max_wait,
+                                         'timer': None}
+        else:
+            album['timer'].cancel()
+        album['items'].append(item)
+        delay = min(self.window, max(0.0, album['deadline'] - loop.time()))
+        album['timer'] = task = asyncio.create_task(self._fire_later(key, delay), name=f"album-{group_id}")
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _fire_later(self, key, delay):
+        await asyncio.sleep(delay)
+        await self._fire(key)
+
+    async def _fire(self, key):
+        album = self._albums.pop(key, None)
+        if album is None:
+            return
+        done = self._running[key] = asyncio.get_running_loop().create_future()
+        try:
+            await self.callback(key[0], album['items'], **album['extra'])
+        except Exception as e:
+            logger.error("Ошибка обработки альбома %s: %s", key[1], e, extra={'user_id': key[0], 'stage': 'media'})
+        finally:
+            del self._running[key]
+            done.set_result(None)
+
+    async def flush_user(self, user_id):
+        """Немедленно обрабатывает незавершённые альбомы пользователя"""
+        for key in [key for key in self._albums if key[0] == user_id]:
+            album = self._albums.get(key)
+            if album is not None:
+                album['timer'].cancel()
+                await self._fire(key)
+        # Альбомы, обработка которых уже началась по таймеру
+        for key, done in list(self._running.items()):
+            if key[0] == user_id:
+                await asyncio.shield(done)
@@ -0,0 +1,96 @@
+"""Холодный старт: от запуска процесса до ответа на первое обновление.
+
+Запускает serve.py (как в Dockerfile) против заглушки Bot API из loadtest.py
+и сразу отправляет /start. Замеряет, когда порт начал принимать соединения,
+когда webhook получил ответ и когда пользователю ушёл ответ бота.
+
+    python benchmarks/cold_start.py --runs 5 --api-latency 0.05
+    python benchmarks/cold_start.py --entry bot.py   # для сравнения
+"""
+import os
+import sys
+import time
+import socket
+import signal
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+import httpx
+
+from loadtest import ROOT, StandIn, DialogFactory, free_port
+
+sys.path.insert(0, ROOT)
+
+
+def wait_port(port, deadline):
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.1):
+                return True
+        except OSError:
+            time.sleep(0.005)
+    return False
+
+
+def cold_start(entry, stand_in, update, user_id, env, timeout):
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix='cold-start-')
+    env = dict(env, PORT=str(port), DB_PATH=os.path.join(workdir, 'orders.db'))
+    replies = stand_in.replies[user_id]
+
+    started = time.monotonic()
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, entry)], cwd=workdir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = started + timeout
+        if not wait_port(port, deadline):
+            raise RuntimeError("порт не открылся")
+        listen = time.monotonic() - started
+        response = httpx.post(f"http://127.0.0.1:{port}/webhook", json=update, timeout=timeout)
+        ack = time.monotonic() - started
+        if response.status_code != 200:
+            raise RuntimeError(f"webhook ответил {response.status_code}")
+        if not stand_in.wait_replies(user_id, replies + 1, deadline - time.monotonic()):
+            raise RuntimeError("нет ответа на /start")
+        reply = time.monotonic() - started
+        return listen, ack, reply
+    finally:
+        proc.send_signal(signal.SIGINT)
+        proc.wait(30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Холодный старт бота")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--api-latency', type=float, default=0.05, help="задержка заглушки Bot API, с")
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--entry', default='serve.py', help="скрипт запуска")
+    args = parser.parse_args()
+
+    stand_in = StandIn(api_latency=args.api_latency)
+    stand_in.start()
+    env = dict(os.environ, BOT_TOKEN='123456:coldstart', TELEGRAM_API_URL=stand_in.url,
+               MAKE_WEBHOOK_URL=f"{stand_in.url}/make", WEBHOOK_URL=f"{stand_in.url}/webhook")
+
+    os.environ.setdefault('BOT_TOKEN', env['BOT_TOKEN'])
+    import bot
+    factory = DialogFactory(bot.TEXTS, bot.TECH_TYPES)
+
+    results = []
+    for run in range(args.runs):
+        user_id = 5000 + run
+        update = factory.dialog(user_id, 'ru')[0][1][0]
+        listen, ack, reply = cold_start(args.entry, stand_in, update, user_id, env, args.timeout)
+        results.append((listen, ack, reply))
+        print(f"  запуск {run + 1}: порт {listen * 1000:6.0f} мс, webhook 200 {ack * 1000:6.0f} мс, "
+              f"ответ пользователю {reply * 1000:6.0f} мс")
+    stand_in.stop()
+
+    for index, name in enumerate(("порт открыт", "webhook подтверждён", "ответ на первое обновление")):
+        print(f"{name:<28} медиана {statistics.median(r[index] for r in results) * 1000:6.0f} мс")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Накладные расходы обработчика на клавиатуры и фильтры в расчёте на одно обновление.
+
+Сравнивает построение разметки в каждом обработчике (как было до каталога:
+ReplyKeyboardMarkup из списка кнопок, нарезка типов техники по рядам,
+регулярное выражение для кнопок подтверждения) с готовыми объектами
+Catalog. Каталог расширяется до --languages языков и --tech-types типов
+техники, чтобы было видно, что их число не влияет на обработку обновления.
+
+    python benchmarks/handler_overhead.py --languages 2 --tech-types 7
+    python benchmarks/handler_overhead.py --languages 10 --tech-types 50
+"""
+import os
+import re
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update, ReplyKeyboardMarkup, KeyboardButton  # noqa: E402
+from telegram.ext import filters  # noqa: E402
+
+from catalog import Catalog, load_catalog  # noqa: E402
+
+
+def expand(texts, tech_types, languages, count):
+    """Каталог с languages языками и count типами техники в каждом"""
+    base = list(texts)
+    expanded_texts, expanded_types = {}, {}
+    for i in range(languages):
+        source = base[i % len(base)]
+        language = source if i < len(base) else f"{source}{i}"
+        expanded_texts[language] = dict(texts[source], confirm_buttons=[
+            f"{button} ({language})" if i >= len(base) else button for button in texts[source]['confirm_buttons']])
+        expanded_types[language] = [f"{tech_types[source][j % len(tech_types[source])]} {j}" for j in range(count)]
+    return expanded_texts, expanded_types
+
+
+# Построение разметки в обработчике, как до каталога
+
+def get_keyboard(buttons):
+    return ReplyKeyboardMarkup([[KeyboardButton(button)] for button in buttons], resize_keyboard=True)
+
+
+def tech_keyboard(buttons):
+    return ReplyKeyboardMarkup([buttons[i:i + 2] for i in range(0, len(buttons), 2)], resize_keyboard=True)
+
+
+def per_update(texts, tech_types, language):
+    return (get_keyboard([texts[language]['skip'], texts[language]['back']]),
+            get_keyboard(texts[language]['confirm_buttons']),
+            tech_keyboard(tech_types[language]))
+
+
+def cached(catalog, language):
+    return (catalog.markup(language, 'skip_back'),
+            catalog.markup(language, 'confirm'),
+            catalog.markup(language, 'tech_types'))
+
+
+def confirm_regex(texts):
+    return filters.Regex('^(' + '|'.join(re.escape(texts[language]['confirm_buttons'][0])
+                                         for language in texts) + ')$')
+
+
+def confirm_update(text):
+    return Update.de_json({'update_id': 1, 'message': {
+        'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'},
+        'from': {'id': 1, 'is_bot': False, 'first_name': 'u'}, 'text': text}}, None)
+
+
+def measure(name, fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    elapsed = (time.perf_counter() - started) / repeat
+    print(f"  {name:<40} {elapsed * 1e6:9.2f} мкс")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Накладные расходы обработчика на клавиатуры и фильтры")
+    parser.add_argument('--languages', type=int, default=2)
+    parser.add_argument('--tech-types', type=int, default=7)
+    parser.add_argument('--repeat', type=int, default=20000)
+    args = parser.parse_args()
+
+    texts, tech_types = load_catalog()
+    texts, tech_types = expand(texts, tech_types, args.languages, args.tech_types)
+
+    started = time.perf_counter()
+    catalog = Catalog(texts, tech_types)
+    print(f"Языков: {len(texts)}, типов техники: {args.tech_types}, "
+          f"сборка каталога при запуске: {(time.perf_counter() - started) * 1000:.2f} мс")
+
+    language = catalog.languages[-1]
+    print("Клавиатуры одного обновления (пропустить/назад, подтверждение, типы техники):")
+    before = measure("построение в обработчике", lambda: per_update(texts, tech_types, language), args.repeat)
+    after = measure("готовые из каталога", lambda: cached(catalog, language), args.repeat)
+    print(f"  ускорение: {before / after:.0f}×")
+
+    update = confirm_update(texts[language]['confirm_buttons'][0])
+    regex = confirm_regex(texts)
+    print("Фильтр кнопки подтверждения:")
+    measure("регулярное выражение", lambda: regex.check_update(update), args.repeat)
+    measure("filters.Text из каталога", lambda: catalog.confirm_filter.check_update(update), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,460 @@
+"""Нагрузочный тест webhook: полные диалоги заявок против настоящего Flask-приложения.
+
+Поднимает локальную заглушку Bot API и Make (с настраиваемой задержкой и
+ошибками), запускает bot.py в этом же процессе и отправляет на /webhook
+синтетические обновления Telegram от нескольких пользователей одновременно.
+Каждый виртуальный пользователь ждёт ответа бота перед следующим шагом.
+
+    python benchmarks/loadtest.py --users 50 --concurrency 20 --photos 2
+    python benchmarks/loadtest.py --users 200 --concurrency 50 --worker-processes 4
+
+С --worker-processes бот запускается отдельным процессом в многопроцессном
+режиме (WORKER_PROCESSES), как в продакшене. С --mode polling бот забирает
+те же обновления из заглушки через getUpdates (UPDATE_MODE=polling).
+
+    python benchmarks/loadtest.py --users 100 --concurrency 50 --mode polling
+
+Выводит обновлений в секунду, p50/p95/p99 подтверждения webhook и каждого
+шага диалога, рост базы и памяти процесса.
+"""
+import os
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import argparse
+import tempfile
+import subprocess
+import itertools
+import threading
+from urllib.parse import parse_qs
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Методы, которые считаются ответом пользователю
+REPLY_METHODS = {'sendMessage', 'sendPhoto', 'sendVideo', 'sendMediaGroup'}
+
+
+def sample_file(size=50000):
+    """Содержимое «скачиваемого» файла: настоящий JPEG, если есть Pillow (для превью), иначе случайные байты"""
+    try:
+        import io
+        from PIL import Image
+    except ImportError:
+        return os.urandom(size)
+    buffer = io.BytesIO()
+    Image.effect_noise((1280, 960), 64).convert('RGB').save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+class StandIn:
+    """Заглушка Bot API и Make на локальном HTTP-сервере"""
+
+    def __init__(self, api_latency=0.0, api_error_rate=0.0, api_429_rate=0.0,
+                 make_latency=0.0, make_error_rate=0.0):
+        self.api_latency = api_latency
+        self.api_error_rate = api_error_rate
+        self.api_429_rate = api_429_rate
+        self.make_latency = make_latency
+        self.make_error_rate = make_error_rate
+        self.replies = defaultdict(int)
+        self.calls = defaultdict(int)
+        self.make_received = 0
+        self._message_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+        self._updates = []
+        self._cond = threading.Condition()
+        self.file_body = sample_file()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="stand-in", daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+
+    def wait_replies(self, chat_id, count, timeout):
+        """Ждёт, пока в чат уйдёт count ответов"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.replies[chat_id] >= count, timeout)
+
+    def push_update(self, update):
+        """Обновление для getUpdates (режим polling). update_id назначается в порядке поступления"""
+        with self._cond:
+            self._updates.append(dict(update, update_id=next(self._update_ids)))
+            self._cond.notify_all()
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        with self._cond:
+            self.calls['getUpdates'] += 1
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            self._cond.wait_for(lambda: self._updates, float(params.get('timeout') or 0))
+            return self._updates[:limit]
+
+    def _record(self, method, chat_id):
+        with self._cond:
+            self.calls[method] += 1
+            if method in REPLY_METHODS and chat_id is not None:
+                self.replies[chat_id] += 1
+                self._cond.notify_all()
+
+    def _message(self, chat_id, text=None):
+        return {"message_id": next(self._message_ids), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": text}
+
+    def _result(self, method, params):
+        chat_id = int(params['chat_id']) if 'chat_id' in params else None
+        if method == 'getMe':
+            return {"id": 1, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+        if method == 'getWebhookInfo':
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        if method == 'getFile':
+            file_id = params.get('file_id', 'file')
+            return {"file_id": file_id, "file_unique_id": f"u{file_id}", "file_size": 50000,
+                    "file_path": f"photos/{file_id}.jpg"}
+        if method == 'sendMediaGroup':
+            return [self._message(chat_id)]
+        if method in ('sendMessage', 'sendPhoto', 'sendVideo', 'editMessageText'):
+            return self._message(chat_id, params.get('text'))
+        return True
+
+    def _handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, code, payload, content_type='application/json'):
+                body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _params(self):
+                raw = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                content_type = self.headers.get('Content-Type', '')
+                if 'json' in content_type:
+                    return json.loads(raw or b'{}')
+                if 'x-www-form-urlencoded' in content_type:
+                    return {key: values[0] for key, values in parse_qs(raw.decode()).items()}
+                return {}
+
+            def do_GET(self):
+                # Скачивание файла
+                time.sleep(stand_in.api_latency)
+                self._send(200, stand_in.file_body, 'application/octet-stream')
+
+            def do_POST(self):
+                params = self._params()
+                if self.path.startswith('/make'):
+                    time.sleep(stand_in.make_latency)
+                    if random.random() < stand_in.make_error_rate:
+                        return self._send(500, {"error": "injected"})
+                    with stand_in._cond:
+                        stand_in.make_received += 1
+                    return self._send(200, b'Accepted', 'text/plain')
+
+                method = self.path.rsplit('/', 1)[-1]
+                if method == 'getUpdates':
+                    return self._send(200, {"ok": True, "result": stand_in._get_updates(params)})
+                time.sleep(stand_in.api_latency)
+                if random.random() < stand_in.api_429_rate:
+                    return self._send(429, {"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                            "parameters": {"retry_after": 1}})
+                if random.random() < stand_in.api_error_rate:
+                    return self._send(500, {"ok": False, "error_code": 500, "description": "Injected error"})
+                result = stand_in._result(method, params)
+                stand_in._record(method, int(params['chat_id']) if 'chat_id' in params else None)
+                self._send(200, {"ok": True, "result": result})
+
+        return Handler
+
+
+class DialogFactory:
+    """Синтетические обновления Telegram для полного диалога заявки"""
+
+    def __init__(self, texts, tech_types):
+        self.texts = texts
+        self.tech_types = tech_types
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def _message(self, user_id, **fields):
+        message = {"message_id": next(self._ids), "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id)}
+        message.update(fields)
+        return {"update_id": next(self._ids), "message": message}
+
+    def _text(self, user_id, text):
+        fields = {"text": text}
+        if text.startswith('/'):
+            fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        return self._message(user_id, **fields)
+
+    def _callback(self, user_id, data):
+        return {"update_id": next(self._ids), "callback_query": {
+            "id": str(next(self._ids)), "from": self._user(user_id), "chat_instance": str(user_id), "data": data,
+            "message": {"message_id": next(self._ids), "date": int(time.time()),
+                        "chat": {"id": user_id, "type": "private"}, "text": "welcome"}}}
+
+    def _photo(self, user_id, index, group=None):
+        file_id = f"photo-{user_id}-{index}"
+        fields = {"photo": [{"file_id": file_id, "file_unique_id": f"u{file_id}", "width": 1280,
+                             "height": 960, "file_size": 50000}]}
+        if group:
+            fields["media_group_id"] = group
+        return self._message(user_id, **fields)
+
+    def dialog(self, user_id, language, photos=0, album=False):
+        """Список шагов (название, обновления, сколько ответов ждать)"""
+        texts = self.texts[language]
+        steps = [
+            ('start', [self._text(user_id, '/start')], 1),
+            ('language', [self._callback(user_id, f'lang_{language}')], 1),
+            ('name', [self._text(user_id, f"User {user_id}")], 1),
+            ('phone', [self._message(user_id, contact={"phone_number": f"+99890{user_id:07d}",
+                                                       "first_name": "User", "user_id": user_id})], 1),
+            ('tech_type', [self._text(user_id, random.choice(self.tech_types[language]))], 1),
+            ('problem', [self._text(user_id, "Не включается, горит индикатор ошибки")], 1),
+        ]
+        if album and photos:
+            steps.append(('album', [self._photo(user_id, i, f"album-{user_id}") for i in range(photos)], 1))
+        else:
+            steps += [('photo', [self._photo(user_id, i)], 1) for i in range(photos)]
+        steps += [
+            ('skip', [self._text(user_id, texts['skip'])], 1),
+            ('confirm', [self._text(user_id, texts['confirm_buttons'][0])], 1),
+        ]
+        return steps
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def rss_mb(pid='self'):
+    """Текущий RSS процесса в МБ"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if pid != 'self':
+        return 0.0
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def tree_rss_mb(pid):
+    """RSS процесса и его прямых потомков в МБ"""
+    total = rss_mb(pid)
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                    total += rss_mb(entry)
+        except (OSError, ValueError, IndexError):
+            continue
+    return total
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_in_process(bot, threads):
+    """Бот и waitress в этом процессе. Возвращает (адрес, остановка, замер памяти)"""
+    from waitress import create_server
+    bot.start_runtime()
+    server = create_server(bot.app, host='127.0.0.1', port=0, threads=threads)
+    threading.Thread(target=server.run, name="waitress", daemon=True).start()
+
+    def stop():
+        bot.stop_runtime()
+        server.close()
+
+    return f"http://127.0.0.1:{server.effective_port}", stop, rss_mb
+
+
+def start_subprocess(processes, timeout=60):
+    """bot.py отдельным процессом в многопроцессном режиме"""
+    port = free_port()
+    env = dict(os.environ, PORT=str(port), WORKER_PROCESSES=str(processes))
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'bot.py')], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            httpx.get(base_url, timeout=1)
+            break
+        except httpx.HTTPError:
+            if proc.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError("bot.py не запустился")
+            time.sleep(0.2)
+
+    def stop():
+        proc.send_signal(signal.SIGINT)
+        proc.wait(60)
+
+    return base_url, stop, lambda: tree_rss_mb(proc.pid)
+
+
+def db_size_mb(path):
+    return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p)) / (1024 * 1024)
+
+
+def run_user(client, stand_in, steps, user_id, timeout, acks, step_latency, failures, polling=False):
+    expected = 0
+    for name, updates, replies in steps:
+        started = time.perf_counter()
+        for update in updates:
+            if polling:
+                stand_in.push_update(update)
+                continue
+            sent = time.perf_counter()
+            response = client.post('/webhook', json=update)
+            acks.append(time.perf_counter() - sent)
+            if response.status_code != 200:
+                failures[f"{name}: HTTP {response.status_code}"] += 1
+        expected += replies
+        if not stand_in.wait_replies(user_id, expected, timeout):
+            failures[f"{name}: нет ответа за {timeout} с"] += 1
+            return False
+        step_latency[name].append(time.perf_counter() - started)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20, help="число диалогов")
+    parser.add_argument('--concurrency', type=int, default=10, help="одновременных пользователей")
+    parser.add_argument('--photos', type=int, default=1, help="фото в каждой заявке")
+    parser.add_argument('--album', action='store_true', help="отправлять фото альбомом")
+    parser.add_argument('--step-timeout', type=float, default=30.0)
+    parser.add_argument('--api-latency', type=float, default=0.02, help="задержка заглушки Bot API, с")
+    parser.add_argument('--api-error-rate', type=float, default=0.0, help="доля ответов 500 от Bot API")
+    parser.add_argument('--api-429-rate', type=float, default=0.0, help="доля ответов 429 от Bot API")
+    parser.add_argument('--make-latency', type=float, default=0.2, help="задержка заглушки Make, с")
+    parser.add_argument('--make-error-rate', type=float, default=0.0, help="доля ответов 500 от Make")
+    parser.add_argument('--worker-processes', type=int, default=1, help="процессов-обработчиков бота")
+    parser.add_argument('--mode', choices=('webhook', 'polling'), default='webhook',
+                        help="как бот получает обновления")
+    args = parser.parse_args()
+
+    stand_in = StandIn(api_latency=args.api_latency, api_error_rate=args.api_error_rate,
+                       api_429_rate=args.api_429_rate, make_latency=args.make_latency,
+                       make_error_rate=args.make_error_rate)
+    stand_in.start()
+
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    os.chdir(workdir)
+    db_path = os.path.join(workdir, 'orders.db')
+    os.environ.update({
+        'BOT_TOKEN': '123456:loadtest',
+        'DB_PATH': db_path,
+        'TELEGRAM_API_URL': stand_in.url,
+        'MAKE_WEBHOOK_URL': f"{stand_in.url}/make",
+        'WEBHOOK_URL': f"{stand_in.url}/webhook",
+        'UPDATE_MODE': args.mode,
+    })
+
+    import logging
+    import bot
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.worker_processes > 1:
+        base_url, stop, memory = start_subprocess(args.worker_processes)
+    else:
+        base_url, stop, memory = start_in_process(bot, threads=max(8, args.concurrency))
+    rss_before = memory()
+    db_before = db_size_mb(db_path)
+
+    factory = DialogFactory(bot.TEXTS, bot.TECH_TYPES)
+    dialogs = [
+        (1000 + i, factory.dialog(1000 + i, 'ru' if i % 2 else 'uz', args.photos, args.album))
+        for i in range(args.users)
+    ]
+    total_updates = sum(len(updates) for _, steps in dialogs for _, updates, _ in steps)
+
+    acks = []
+    step_latency = defaultdict(list)
+    failures = defaultdict(int)
+    limits = httpx.Limits(max_connections=args.concurrency)
+    with httpx.Client(base_url=base_url, limits=limits, timeout=30) as client:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(
+                lambda item: run_user(client, stand_in, item[1], item[0], args.step_timeout,
+                                      acks, step_latency, failures, polling=args.mode == 'polling'),
+                dialogs
+            ))
+        elapsed = time.perf_counter() - started
+
+    # Даём outbox доставить заявки в Make
+    deadline = time.monotonic() + 30
+    completed = sum(results)
+    while stand_in.make_received < completed and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+    rss_after = memory()
+    stop()
+    stand_in.stop()
+
+    import sqlite3
+    conn = sqlite3.connect(db_path)
+    orders = conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+    conn.close()
+
+    print(f"Диалогов: {args.users} (успешно {completed}), одновременно: {args.concurrency}, "
+          f"процессов бота: {args.worker_processes}, режим: {args.mode}, "
+          f"фото в заявке: {args.photos}{' альбомом' if args.album else ''}")
+    print(f"Обновлений: {total_updates} за {elapsed:.2f} с — {total_updates / elapsed:.1f} обновлений/с")
+    if acks:
+        print(f"Подтверждение webhook: p50 {percentile(acks, 50) * 1000:.1f} мс, "
+              f"p95 {percentile(acks, 95) * 1000:.1f} мс, p99 {percentile(acks, 99) * 1000:.1f} мс")
+    print("Шаги диалога (от отправки до ответа бота):")
+    for name, values in step_latency.items():
+        print(f"  {name:<10} n={len(values):<5} p50 {percentile(values, 50) * 1000:8.1f} мс  "
+              f"p95 {percentile(values, 95) * 1000:8.1f} мс  p99 {percentile(values, 99) * 1000:8.1f} мс")
+    print(f"Заявок в базе: {orders}, доставлено в Make: {stand_in.make_received}")
+    print(f"База: {db_before:.2f} → {db_size_mb(db_path):.2f} МБ, "
+          f"память процесса: {rss_before:.1f} → {rss_after:.1f} МБ")
+    print(f"Вызовы Bot API: {dict(stand_in.calls)}")
+    if failures:
+        print("Ошибки:")
+        for reason, count in sorted(failures.items()):
+            print(f"  {reason}: {count}")
+    return 0 if completed == args.users else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+"""Нагрузочный тест выдачи номеров заявок.
+
+Несколько процессов и потоков одновременно берут номера из одной базы.
+Проверяет отсутствие дублей и пропусков и выводит число выдач в секунду.
+
+    python benchmarks/order_numbers.py --processes 4 --threads 4 --count 500
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from order_numbers import init_counters, next_order_number  # noqa: E402
+from storage import Storage  # noqa: E402
+
+
+def _allocate(db_path, count):
+    conn = sqlite3.connect(db_path, timeout=60)
+    try:
+        now = datetime.now()
+        numbers = []
+        for _ in range(count):
+            with conn:
+                numbers.append(next_order_number(conn, now))
+        return numbers
+    finally:
+        conn.close()
+
+
+def _worker(args):
+    db_path, threads, count = args
+    results = [None] * threads
+
+    def run(i):
+        results[i] = _allocate(db_path, count)
+
+    pool = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return [number for chunk in results for number in chunk]
+
+
+def _run_storage(db_path, total):
+    """Все номера выдаются через поток записи Storage с групповыми коммитами"""
+    storage = Storage(db_path)
+    storage.start()
+    try:
+        now = datetime.now()
+        futures = [storage.submit_write(next_order_number, now) for _ in range(total)]
+        return [[future.result() for future in futures]]
+    finally:
+        storage.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--count', type=int, default=250, help="номеров на поток")
+    parser.add_argument('--wal', action='store_true', help="включить journal_mode=WAL")
+    parser.add_argument('--storage', action='store_true',
+                        help="выдавать номера через Storage (один поток записи, групповые коммиты)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'bench.db')
+        conn = sqlite3.connect(db_path)
+        if args.wal:
+            conn.execute("PRAGMA journal_mode=WAL")
+        init_counters(conn.cursor(), datetime.now())
+        conn.commit()
+        conn.close()
+
+        started = time.perf_counter()
+        if args.storage:
+            chunks = _run_storage(db_path, args.processes * args.threads * args.count)
+        else:
+            with Pool(args.processes) as pool:
+                chunks = pool.map(_worker, [(db_path, args.threads, args.count)] * args.processes)
+        elapsed = time.perf_counter() - started
+
+    numbers = [number for chunk in chunks for number in chunk]
+    total = len(numbers)
+    sequence = sorted(int(number.split('-')[1]) for number in numbers)
+    duplicates = total - len(set(numbers))
+    gaps = sequence != list(range(1, total + 1))
+
+    print(f"Процессов: {args.processes}, потоков: {args.threads}, номеров на поток: {args.count}")
+    print(f"Выдано: {total} за {elapsed:.2f} с ({total / elapsed:.0f} номеров/с)")
+    print(f"Дублей: {duplicates}, пропусков: {'есть' if gaps else 'нет'}")
+    return 1 if duplicates or gaps else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
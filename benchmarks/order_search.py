@@ -0,0 +1,116 @@
+"""Скорость выборки заявок на большой таблице.
+
+Заполняет временную базу синтетическими заявками (с той же схемой и
+индексами, что у бота) и замеряет типичные запросы /orders: по пользователю,
+телефону, номеру, типу техники, страницы keyset-пагинации и полнотекстовый
+поиск по описанию проблемы.
+
+    python benchmarks/order_search.py --rows 300000
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', '123456:benchmark')
+
+from bot import create_schema, TECH_TYPES  # noqa: E402
+from order_queries import query_orders  # noqa: E402
+
+PROBLEMS = [
+    "Не включается, горит индикатор ошибки",
+    "Сильно шумит при отжиме и протекает снизу",
+    "Не греет воду, на дисплее код E21",
+    "Холодильник не морозит, компрессор щёлкает",
+    "Посудомойка не сливает воду",
+    "Кондиционер капает внутри помещения",
+    "Muzlatgich sovutmayapti",
+    "Kir yuvish mashinasi suv oqizyapti",
+]
+
+
+def fill(conn, rows, users):
+    start = datetime(2024, 1, 1)
+    tech_types = TECH_TYPES['ru'] + TECH_TYPES['uz']
+    batch = []
+    for i in range(rows):
+        created = start + timedelta(seconds=i * 60)
+        user_id = random.randrange(users)
+        batch.append((f"{created:%d%m%Y}-{i:04d}", user_id, f"user{user_id}", f"User {user_id}",
+                      f"+99890{user_id:07d}", random.choice(tech_types),
+                      f"{random.choice(PROBLEMS)} (заявка {i})", "", random.choice(('ru', 'uz')),
+                      created.strftime('%Y-%m-%d %H:%M:%S')))
+        if len(batch) == 10000:
+            insert(conn, batch)
+            batch = []
+    insert(conn, batch)
+
+
+def insert(conn, batch):
+    conn.execute("BEGIN")
+    conn.executemany('''INSERT INTO orders (order_number, user_id, username, name, phone, tech_type, problem,
+                                            media_files, language, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', batch)
+    conn.execute("COMMIT")
+
+
+def measure(conn, name, filters, repeat, pages=1, limit=20):
+    timings = []
+    for _ in range(repeat):
+        cursor = None
+        started = time.perf_counter()
+        for _ in range(pages):
+            rows, cursor = query_orders(conn, filters(), cursor, limit)
+            if cursor is None:
+                break
+        timings.append((time.perf_counter() - started) / pages)
+    timings.sort()
+    p50 = timings[len(timings) // 2] * 1000
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000
+    print(f"  {name:<28} p50 {p50:7.3f} мс  p99 {p99:7.3f} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Скорость выборки заявок")
+    parser.add_argument('--rows', type=int, default=300000)
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix='order-search-'), 'orders.db')
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("BEGIN")
+    create_schema(conn)
+    conn.execute("COMMIT")
+
+    started = time.perf_counter()
+    fill(conn, args.rows, args.users)
+    print(f"Заявок: {args.rows}, заполнение {time.perf_counter() - started:.1f} с, "
+          f"база {os.path.getsize(db_path) / 1024 / 1024:.1f} МБ")
+
+    users = [random.randrange(args.users) for _ in range(args.repeat)]
+    tech_types = TECH_TYPES['ru']
+    print("Запросы (на страницу из 20 заявок):")
+    measure(conn, "последние заявки", lambda: {}, args.repeat)
+    measure(conn, "10 страниц подряд", lambda: {}, args.repeat // 10 or 1, pages=10)
+    measure(conn, "по user_id", lambda: {'user_id': random.choice(users)}, args.repeat)
+    measure(conn, "по телефону", lambda: {'phone': f"+99890{random.choice(users):07d}"}, args.repeat)
+    measure(conn, "по номеру заявки", lambda: {'order_number': "01012024-0042"}, args.repeat)
+    measure(conn, "тип техники + язык", lambda: {'tech_type': random.choice(tech_types), 'language': 'ru'},
+            args.repeat)
+    measure(conn, "за день", lambda: {'date_from': '2024-03-01', 'date_to': '2024-03-02'}, args.repeat)
+    measure(conn, "поиск «протекает»", lambda: {'q': 'протекает'}, args.repeat)
+    measure(conn, "поиск «не слив»", lambda: {'q': 'не слив'}, args.repeat)
+    measure(conn, "поиск + тип техники", lambda: {'q': 'шумит', 'tech_type': random.choice(tech_types)},
+            args.repeat)
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
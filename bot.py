@@ -1,17 +1,26 @@
+import time
+# Отсчёт холодного старта (serve.py передаёт момент запуска интерпретатора)
+BOOT_STARTED = time.monotonic()
+
 import os 
+import hmac
+import html
 import logging
 import sqlite3
 import asyncio
-import requests
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import partial, wraps
 import pytz
 from telegram import (
+    Bot,
     Update,
-    ReplyKeyboardMarkup,
-    KeyboardButton,
-    InlineKeyboardButton,
-    InlineKeyboardMarkup
+    InputMediaPhoto,
+    InputMediaVideo
 )
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -21,24 +30,139 @@ from telegram.ext import (
     filters,
     CallbackQueryHandler
 )
-from flask import Flask, request
+from flask import Flask, Response, request, jsonify, stream_with_context
+import httpx
+from runtime import UpdateRuntime
+import make_outbox
+from make_outbox import MakeDispatcher
+from order_numbers import init_counters, next_order_number
+from storage import Storage
+from sessions import SessionStore, ConversationPersistence, init_sessions
+from media import MediaIngestor, MediaRetention, init_media, attach_order, DONE as MEDIA_DONE, REMOTE as MEDIA_REMOTE
+from albums import AlbumCollector
+from dedupe import UpdateDeduplicator, init_dedupe
+from order_queries import init_order_indexes, parse_filters, query_orders
+from reports import init_rollups, select_rollups, parse_export_args, export_orders
+from profiles import ProfileCache
+from catalog import Catalog, load_catalog, CATALOG_PATH
+from maintenance import DatabaseMaintenance, read_archive, archive_months, enable_incremental_vacuum
+from ratelimit import PriorityRateLimiter, AdminDigest, OVERALL_RATE
+from workers import WorkerPool, shard_for, raw_update_key
+from polling import UpdatePoller
+from admission import AdmissionController, ACCEPT, SHED, BUSY, sender
+import tracing
+from tracing import Tracer, init_traces, span as trace_span
+from logs import setup_logging, parse_sampling
+from tenants import (
+    Tenant,
+    DEFAULT_BOT_ID,
+    load_tenants,
+    current as current_tenant,
+    activate as activate_tenant,
+    deactivate as deactivate_tenant
+)
+from metrics import (
+    REGISTRY,
+    ACTIVE_SESSIONS,
+    UPDATE_QUEUE_DEPTH,
+    WEBHOOK_ACK_LATENCY,
+    WEBHOOK_RESPONSES,
+    STARTUP_DURATION,
+    TIME_TO_FIRST_UPDATE,
+    timed_handler
+)
 
-# Настройка логгирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Настройка логгирования: запись в stdout идёт в отдельном потоке, а не в event loop.
+# LOG_FORMAT=text — привычный текстовый формат; LOG_SAMPLING — доля INFO-записей
+# многословных логгеров (по умолчанию httpx пишет строку на каждый запрос к Bot API)
+setup_logging(
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+    fmt=os.environ.get("LOG_FORMAT", "json"),
+    sampling=parse_sampling(os.environ.get("LOG_SAMPLING", "httpx=0.05")),
+    queue_size=int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
 )
 logger = logging.getLogger(__name__)
 
 # Конфигурация
+# BOTS_CONFIG — JSON-файл с несколькими ботами (см. tenants.load_tenants), которые
+# обслуживаются одним процессом на /webhook/<id>. Без него — один бот из переменных окружения
+BOTS_CONFIG = os.environ.get('BOTS_CONFIG')
 TOKEN = os.getenv("BOT_TOKEN")
-if not TOKEN:
+if not TOKEN and not BOTS_CONFIG:
     raise ValueError("❌ Не найден BOT_TOKEN в окружении")
 
 PORT = int(os.environ.get('PORT', 8080))
 ADMIN_CHAT_ID = 1838738269
 MOSCOW_TZ = pytz.timezone('Europe/Moscow')
-MAKE_WEBHOOK_URL = "https://hook.eu2.make.com/2rcn5ksonlssc9dbk5tnvrcm39kgq86m"
+MAKE_WEBHOOK_URL = os.environ.get('MAKE_WEBHOOK_URL', "https://hook.eu2.make.com/2rcn5ksonlssc9dbk5tnvrcm39kgq86m")
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', "https://zorservbot.fly.dev/webhook")
+# Адрес Bot API (подменяется при нагрузочном тестировании)
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', "https://api.telegram.org")
+MAKE_CONCURRENCY = int(os.environ.get('MAKE_CONCURRENCY', 4))
+MAKE_MAX_ATTEMPTS = int(os.environ.get('MAKE_MAX_ATTEMPTS', 8))
+# Соединений с Bot API в общем пуле всех ботов процесса
+BOT_API_CONNECTIONS = int(os.environ.get('BOT_API_CONNECTIONS', 256))
+# Тексты и типы техники всех языков
+CATALOG_FILE = os.environ.get('CATALOG_FILE', CATALOG_PATH)
+DB_PATH = os.environ.get('DB_PATH', 'orders.db')
+DB_SYNCHRONOUS = os.environ.get('DB_SYNCHRONOUS', 'NORMAL')
+# Кэш страниц SQLite на соединение: горячая база должна в него помещаться
+DB_CACHE_MB = int(os.environ.get('DB_CACHE_MB', 16))
+
+# Обслуживание базы: заявки старше DB_ARCHIVE_DAYS уходят в помесячные архивы,
+# резервные копии делаются, только если задан DB_BACKUP_DIR
+DB_ARCHIVE_DAYS = float(os.environ.get('DB_ARCHIVE_DAYS', 365))
+DB_ARCHIVE_DIR = os.environ.get('DB_ARCHIVE_DIR', os.path.join(os.path.dirname(DB_PATH), 'archive'))
+DB_BACKUP_DIR = os.environ.get('DB_BACKUP_DIR')
+DB_BACKUP_INTERVAL = float(os.environ.get('DB_BACKUP_INTERVAL', 6 * 60 * 60))
+DB_BACKUPS = int(os.environ.get('DB_BACKUPS', 7))
+DB_MAINTENANCE_INTERVAL = float(os.environ.get('DB_MAINTENANCE_INTERVAL', 60))
+# Базу, созданную без auto_vacuum, до этого размера перестраиваем при запуске
+DB_CONVERT_LIMIT_MB = int(os.environ.get('DB_CONVERT_LIMIT_MB', 64))
+
+# Сессии диалогов
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', 10000))
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 24 * 60 * 60))
+SESSION_FLUSH_INTERVAL = float(os.environ.get('SESSION_FLUSH_INTERVAL', 2))
+
+# Очередь обновлений webhook
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', 1000))
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', 8))
+
+# Admission control: доля очереди, выше которой сбрасываются медиа и служебные обновления,
+# резерв очереди только для подтверждений заявок и лимиты на пользователя в минуту
+ADMISSION_HIGH_WATER = float(os.environ.get('ADMISSION_HIGH_WATER', 0.5))
+ADMISSION_RESERVE = float(os.environ.get('ADMISSION_RESERVE', 0.1))
+USER_MESSAGES_PER_MINUTE = int(os.environ.get('USER_MESSAGES_PER_MINUTE', 30))
+USER_MEDIA_MB_PER_MINUTE = int(os.environ.get('USER_MEDIA_MB_PER_MINUTE', 100))
+
+# Трассы заявок: сколько последних держать в памяти и с какой задержкой ответа на ✅ сохранять в базу
+TRACE_BUFFER_SIZE = int(os.environ.get('TRACE_BUFFER_SIZE', 1000))
+TRACE_SLOW_SECONDS = float(os.environ.get('TRACE_SLOW_SECONDS', 5))
+
+# Отсев повторно доставленных обновлений
+DEDUPE_CACHE_SIZE = int(os.environ.get('DEDUPE_CACHE_SIZE', 10000))
+DEDUPE_HISTORY = int(os.environ.get('DEDUPE_HISTORY', 100000))
+
+# Кэш данных постоянных клиентов
+PROFILE_CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', 10000))
+
+# Токен для API выборки заявок (без него /orders отключён)
+ORDERS_API_TOKEN = os.environ.get('ORDERS_API_TOKEN')
+
+# Способ получения обновлений: webhook или polling (getUpdates).
+# POLLING_FALLBACK=1 — перейти на polling, если webhook не удалось установить
+UPDATE_MODE = os.environ.get('UPDATE_MODE', 'webhook')
+POLLING_FALLBACK = os.environ.get('POLLING_FALLBACK', '1') == '1'
+POLL_TIMEOUT = int(os.environ.get('POLL_TIMEOUT', 30))
+POLL_LIMIT = int(os.environ.get('POLL_LIMIT', 100))
+
+# Многопроцессный режим: число процессов-обработчиков (1 — всё в одном процессе)
+WORKER_PROCESSES = int(os.environ.get('WORKER_PROCESSES', 1))
+# Как часто процессы-обработчики передают свои метрики фронтенду для /metrics (секунды)
+METRICS_PUSH_INTERVAL = float(os.environ.get('METRICS_PUSH_INTERVAL', 5.0))
+# Как часто процесс с outbox проверяет заявки, сохранённые другими процессами
+MAKE_POLL_INTERVAL = float(os.environ.get('MAKE_POLL_INTERVAL', 1.0))
 
 # Состояния диалога
 (MAIN_MENU, GET_NAME, GET_PHONE, GET_TECH_TYPE, GET_PROBLEM, GET_MEDIA, CONFIRM) = range(7)
@@ -47,80 +171,53 @@ MAKE_WEBHOOK_URL = "https://hook.eu2.make.com/2rcn5ksonlssc9dbk5tnvrcm39kgq86m"
 MEDIA_DIR = "user_media"
 os.makedirs(MEDIA_DIR, exist_ok=True)
 
-# Глобальные переменные
-user_data = {}
-application = None
-
-# Тексты на разных языках
-TEXTS = {
-    'ru': {
-        'welcome': "👋 <b>Здравствуйте, меня зовут Zorservbot!</b>\nЯ помогу оформить Вам заказ!\n\n<b>Salom, mening ismim Zorservbot!</b>\nMen sizga buyurtma berishga yordam beraman!\n\n🌐 <b>Выберите язык / Tilni tanlang</b>",
-        'enter_name': "👤 <b>Введите ваше имя / Ismingizni kiriting:</b>",
-        'enter_phone': "📞 <b>Введите ваш номер телефона / Telefon raqamingizni kiriting:</b>\n\nИли нажмите кнопку ниже / Yoki quyidagi tugmani bosing:",
-        'select_tech': "🛠 <b>Выберите тип техники / Texnika turini tanlang:</b>",
-        'describe_problem': "❗ <b>Опишите проблему подробно / Muammoni batafsil bayon qiling:</b>",
-        'add_media': "📸 <b>Пришлите фото/видео неисправности / Nosozlikning foto/video suratini yuboring</b>\n\n• Фото до 20MB / Foto 20MB gacha\n• Видео до 50MB / Video 50MB gacha\n• Макс. 10 файлов / Maks. 10 fayl",
-        'confirm': "📋 <b>Ваша заявка / Arizangiz:</b>\n\n"
-                  "👤 <b>Имя / Ism:</b> {name}\n"
-                  "📞 <b>Телефон / Telefon:</b> {phone}\n"
-                  "🛠 <b>Тип техники / Texnika turi:</b> {tech_type}\n"
-                  "❗ <b>Проблема / Muammo:</b> {problem}\n\n"
-                  "<b>Всё верно? / Hammasi to'g'rimi?</b>",
-        'confirm_buttons': ["✅ Да, всё верно", "❌ Нет, изменить данные"],
-        'success': "✅ <b>Заявка #{order_number} отправлена! / #{order_number} raqamli ariza jo'natildi!</b>\n\nМы получили вашу заявку и уже начали работу. / Arizangiz qabul qilindi va ish boshlandi.\nМастер свяжется с вами в ближайшее время. / Tez orada usta siz bilan bog'lanadi.",
-        'error': "❌ Произошла ошибка при обработке вашей заявки. Пожалуйста, попробуйте позже. / Arizangizni qayta ishlashda xatolik yuz berdi. Iltimos, keyinroq urinib ko'ring.",
-        'back': "↩️ Назад / Orqaga",
-        'skip': "⏭ Пропустить / O'tkazish",
-        'cancel': "❌ Действие отменено. Чем ещё могу помочь? / Harakat bekor qilindi. Yana qanday yordam bera olaman?",
-        'start_again': "🔄 Начать заново / Qayta boshlash"
-    },
-    'uz': {
-        'welcome': "👋 <b>Здравствуйте, меня зовут Zorservbot!</b>\nЯ помогу оформить Вам заказ!\n\n<b>Salom, mening ismim Zorservbot!</b>\nMen sizga buyurtma berishga yordam beraman!\n\n🌐 <b>Выберите язык / Tilni tanlang</b>",
-        'enter_name': "👤 <b>Введите ваше имя / Ismingizni kiriting:</b>",
-        'enter_phone': "📞 <b>Введите ваш номер телефона / Telefon raqamingizni kiriting:</b>\n\nИли нажмите кнопку ниже / Yoki quyidagi tugmani bosing:",
-        'select_tech': "🛠 <b>Выберите тип техники / Texnika turini tanlang:</b>",
-        'describe_problem': "❗ <b>Опишите проблему подробно / Muammoni batafsil bayon qiling:</b>",
-        'add_media': "📸 <b>Пришлите фото/видео неисправности / Nosozlikning foto/video suratini yuboring</b>\n\n• Фото до 20MB / Foto 20MB gacha\n• Видео до 50MB / Video 50MB gacha\n• Макс. 10 файлов / Maks. 10 fayl",
-        'confirm': "📋 <b>Ваша заявка / Arizangiz:</b>\n\n"
-                  "👤 <b>Имя / Ism:</b> {name}\n"
-                  "📞 <b>Телефон / Telefon:</b> {phone}\n"
-                  "🛠 <b>Тип техники / Texnika turi:</b> {tech_type}\n"
-                  "❗ <b>Проблема / Muammo:</b> {problem}\n\n"
-                  "<b>Всё верно? / Hammasi to'g'rimi?</b>",
-        'confirm_buttons': ["✅ Ha, hammasi to'g'ri", "❌ Yo'q, o'zgartirmoqchiman"],
-        'success': "✅ <b>Заявка #{order_number} отправлена! / #{order_number} raqamli ariza jo'natildi!</b>\n\nМы получили вашу заявку и уже начали работу. / Arizangiz qabul qilindi va ish boshlandi.\nМастер свяжется с вами в ближайшее время. / Tez orada usta siz bilan bog'lanadi.",
-        'error': "❌ Произошла ошибка при обработке вашей заявки. Пожалуйста, попробуйте позже. / Arizangizni qayta ishlashda xatolik yuz berdi. Iltimos, keyinroq urinib ko'ring.",
-        'back': "↩️ Назад / Orqaga",
-        'skip': "⏭ Пропустить / O'tkazish",
-        'cancel': "❌ Действие отменено. Чем ещё могу помочь? / Harakat bekor qilindi. Yana qanday yordam bera olaman?",
-        'start_again': "🔄 Начать заново / Qayta boshlash"
-    }
-}
-
-TECH_TYPES = {
-    'ru': [
-        "Стиральная машина",
-        "Духовка",
-        "Электроплита",
-        "Холодильник",
-        "Посудомойка",
-        "Кофемашина",
-        "Робот-пылесос"
-    ],
-    'uz': [
-        "Kir yuvish mashinasi",
-        "Pech",
-        "Elektroplita",
-        "Muzlatgich",
-        "Idish yuvish mashinasi",
-        "Kofe mashinasi",
-        "Changyutgich robot"
-    ]
-}
-
-def init_db():
-    """Инициализация базы данных"""
-    conn = sqlite3.connect('orders.db')
+# Медиафайлы заявок
+MAX_MEDIA_FILES = 10
+MEDIA_SIZE_LIMITS = {'photo': 20 * 1024 * 1024, 'video': 50 * 1024 * 1024}
+MEDIA_CONCURRENCY = int(os.environ.get('MEDIA_CONCURRENCY', 4))
+# Сколько ждать загрузки вложений перед сохранением заявки (0 — не ждать: администратор
+# получает их по file_id, файл на диске дописывается в фоне)
+MEDIA_WAIT_TIMEOUT = float(os.environ.get('MEDIA_WAIT_TIMEOUT', 0))
+ALBUM_WINDOW = float(os.environ.get('ALBUM_WINDOW', 1.0))
+# Скачивать ли вложения на диск (администратор получает их по file_id в любом случае)
+MEDIA_DOWNLOAD = os.environ.get('MEDIA_DOWNLOAD', '1') == '1'
+# Процессы для построения превью (0 — превью не строятся)
+MEDIA_PREVIEW_PROCESSES = int(os.environ.get('MEDIA_PREVIEW_PROCESSES', 1))
+# Квота на медиафайлы и срок хранения оригиналов сохранённых заявок
+MEDIA_QUOTA_MB = int(os.environ.get('MEDIA_QUOTA_MB', 1024))
+MEDIA_MAX_AGE_DAYS = float(os.environ.get('MEDIA_MAX_AGE_DAYS', 90))
+MEDIA_RETENTION_INTERVAL = float(os.environ.get('MEDIA_RETENTION_INTERVAL', 600))
+
+# Ограничения Bot API
+CAPTION_LIMIT = 1024
+MEDIA_GROUP_LIMIT = 10
+
+# Дайджест уведомлений администратору при перегрузке
+ADMIN_DIGEST = os.environ.get('ADMIN_DIGEST', '0') == '1'
+ADMIN_DIGEST_THRESHOLD = int(os.environ.get('ADMIN_DIGEST_THRESHOLD', 3))
+# Сколько при остановке ждать уведомлений администратору, ещё не отправленных в Telegram
+ADMIN_NOTIFY_SHUTDOWN_TIMEOUT = float(os.environ.get('ADMIN_NOTIFY_SHUTDOWN_TIMEOUT', 15))
+
+# Глобальные переменные. Объекты отдельных ботов (application, база, сессии) — в tenants
+runtime = None
+preview_pool = None
+# Общие пулы соединений ботов: Bot API, Make и getUpdates
+bot_request = None
+make_client = None
+poll_client = None
+worker_pool = None
+worker_index = 0
+# Обработчики очереди ждут его, пока application инициализируется
+application_ready = asyncio.Event()
+first_update_processed = False
+# Уведомления администратору, отправляемые после ответа пользователю
+admin_notifications = set()
+
+# Тексты и типы техники на разных языках (catalog.json)
+TEXTS, TECH_TYPES = load_catalog(CATALOG_FILE)
+
+def create_schema(conn):
+    """Создание таблиц базы данных"""
     c = conn.cursor()
 
     c.execute('''CREATE TABLE IF NOT EXISTS orders
@@ -136,145 +233,211 @@ def init_db():
                   language TEXT,
                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
 
-    c.execute('''CREATE TABLE IF NOT EXISTS counters
-                 (id INTEGER PRIMARY KEY,
-                  last_order_number INTEGER,
-                  last_reset_date TEXT)''')
+    # Ключ идемпотентности подтверждения (колонка добавлена позже, старые базы мигрируем)
+    columns = [row[1] for row in c.execute("PRAGMA table_info(orders)")]
+    if 'idempotency_key' not in columns:
+        c.execute("ALTER TABLE orders ADD COLUMN idempotency_key TEXT")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_idempotency_key ON orders (idempotency_key)")
 
-    c.execute("SELECT COUNT(*) FROM counters WHERE id = 1")
-    if c.fetchone()[0] == 0:
-        current_date = datetime.now(MOSCOW_TZ).strftime('%Y-%m-%d')
-        c.execute("INSERT INTO counters (id, last_order_number, last_reset_date) VALUES (1, 0, ?)", (current_date,))
+    init_order_indexes(c)
 
-    conn.commit()
-    conn.close()
+    init_rollups(c, datetime.now(MOSCOW_TZ).utcoffset().total_seconds() / 3600)
 
-def get_next_order_number():
-    """Генерация номера заявки"""
-    conn = sqlite3.connect('orders.db')
-    c = conn.cursor()
+    init_counters(c, datetime.now(MOSCOW_TZ))
 
-    try:
-        current_date = datetime.now(MOSCOW_TZ).strftime('%Y-%m-%d')
-        c.execute("SELECT last_reset_date, last_order_number FROM counters WHERE id = 1")
-        result = c.fetchone()
+    make_outbox.init_outbox(c)
 
-        if not result:
-            last_order_number = 0
-            c.execute("INSERT INTO counters (id, last_order_number, last_reset_date) VALUES (1, 0, ?)", (current_date,))
-        else:
-            last_reset_date, last_order_number = result
-            if last_reset_date != current_date:
-                last_order_number = 0
-                c.execute("UPDATE counters SET last_order_number = 0, last_reset_date = ? WHERE id = 1", (current_date,))
+    init_sessions(c)
 
-        new_number = last_order_number + 1
-        c.execute("UPDATE counters SET last_order_number = ? WHERE id = 1", (new_number,))
-        conn.commit()
+    init_media(c)
 
-        return f"{datetime.now(MOSCOW_TZ).strftime('%d%m%Y')}-{new_number:04d}"
+    init_dedupe(c)
 
-    except sqlite3.Error as e:
-        logger.error(f"Ошибка базы данных: {e}")
-        return f"EMG-{datetime.now(MOSCOW_TZ).strftime('%d%m%Y%H%M%S')}"
-    finally:
-        conn.close()
+    init_traces(c)
 
-async def send_to_make_webhook(order_data):
-    """Отправка данных заявки в Make"""
-    try:
-        make_payload = {
-            "chat_id": order_data.get("user_id", 0),
-            "username": order_data.get("username", "Не указано"),
-            "name": order_data.get("name", "Не указано"),
-            "phone": order_data.get("phone", "Не указано"),
-            "tech_type": order_data.get("tech_type", "Не указано"),
-            "problem": order_data.get("problem", "Не указано"),
-            "language": order_data.get("language", "ru"),
-            "order_number": order_data.get("order_number", "Без номера"),
-            "media_count": order_data.get("media_count", 0),
-            "source": "telegram_bot"
-        }
-
-        for key, value in make_payload.items():
-            if value is None:
-                make_payload[key] = ""
-            elif not isinstance(value, (str, int, float)):
-                make_payload[key] = str(value)
-
-        logger.info(f"Отправка данных в Make: {make_payload}")
-
-        response = requests.post(
-            MAKE_WEBHOOK_URL,
-            json=make_payload,
-            timeout=10
-        )
+def open_storage(tenant):
+    """Создание хранилища бота без обращения к диску"""
+    tenant.storage = Storage(tenant.db_path, synchronous=DB_SYNCHRONOUS, cache_mb=DB_CACHE_MB)
+    tenant.user_data.bind(tenant.storage)
 
-        if response.status_code == 200:
-            logger.info(f"✅ Данные успешно отправлены в Make для заявки {order_data['order_number']}")
-            return True
-        else:
-            logger.error(f"❌ Ошибка отправки в Make: {response.status_code} - {response.text}")
-            return False
+def prepare_db(tenant):
+    """Открытие соединений и создание схемы"""
+    # Полный VACUUM старой базы возможен только до запуска потока записи
+    enable_incremental_vacuum(tenant.db_path, DB_CONVERT_LIMIT_MB * 1024 * 1024)
+    tenant.storage.start()
+    tenant.storage.write_sync(create_schema)
 
-    except Exception as e:
-        logger.error(f"❌ Ошибка при отправке в Make: {e}")
-        return False
+def init_db():
+    """Инициализация баз данных всех ботов"""
+    for tenant in tenants.values():
+        open_storage(tenant)
+        prepare_db(tenant)
+
+def close_storage():
+    """Закрытие баз данных всех ботов"""
+    for tenant in tenants.values():
+        if tenant.storage is not None:
+            tenant.storage.close()
+
+def get_next_order_number(conn, now):
+    """Генерация номера заявки"""
+    try:
+        return next_order_number(conn, now)
 
-def get_keyboard(buttons, language='ru'):
-    """Создает клавиатуру из списка кнопок"""
-    return ReplyKeyboardMarkup(
-        [[KeyboardButton(button)] for button in buttons],
-        resize_keyboard=True
-    )
+    except sqlite3.Error as e:
+        logger.error("Ошибка базы данных: %s", e, extra={'stage': 'db'})
+        return f"EMG-{now.strftime('%d%m%Y%H%M%S')}"
+
+def save_order(conn, order, make_payload):
+    """Сохранение заявки и записи для Make в одной транзакции"""
+    conn.execute('''INSERT INTO orders
+                    (order_number, user_id, username, name, phone, tech_type, problem, media_files, language,
+                     idempotency_key)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', order)
+    make_outbox.enqueue(conn, make_payload['order_number'], make_payload)
+    # Файлы сохранённой заявки становятся кандидатами на очистку по возрасту и квоте
+    attach_order(conn, order[0], order[7])
+
+def place_order(conn, idempotency_key, now, build, timings=None):
+    """Выделение номера и сохранение заявки одной транзакцией.
+
+    build(order_number) возвращает (строка orders, данные для Make). Повтор с тем же
+    ключом ничего не записывает и возвращает уже выделенный номер: (номер, False).
+    В timings (если передан) записывается длительность этапов в мс для трассы заявки.
+    """
+    row = conn.execute("SELECT order_number FROM orders WHERE idempotency_key = ?", (idempotency_key,)).fetchone()
+    if row is not None:
+        return row[0], False
+    started = time.monotonic()
+    order_number = get_next_order_number(conn, now)
+    numbered = time.monotonic()
+    order, make_payload = build(order_number)
+    save_order(conn, order + (idempotency_key,), make_payload)
+    if timings is not None:
+        timings['order_number_ms'] = round((numbered - started) * 1000, 2)
+        timings['insert_ms'] = round((time.monotonic() - numbered) * 1000, 2)
+    return order_number, True
+
+def build_make_payload(order_data):
+    """Формирование данных заявки для Make"""
+    make_payload = {
+        "chat_id": order_data.get("user_id", 0),
+        "username": order_data.get("username", "Не указано"),
+        "name": order_data.get("name", "Не указано"),
+        "phone": order_data.get("phone", "Не указано"),
+        "tech_type": order_data.get("tech_type", "Не указано"),
+        "problem": order_data.get("problem", "Не указано"),
+        "language": order_data.get("language", "ru"),
+        "order_number": order_data.get("order_number", "Без номера"),
+        "media_count": order_data.get("media_count", 0),
+        "source": "telegram_bot"
+    }
 
-def contact_keyboard(language='ru'):
-    """Клавиатура для отправки контакта"""
-    if language == 'ru':
-        text = "↩️ Назад / Orqaga"
-        button_text = "📱 Отправить мой номер / Mening raqamimni yuborish"
-    else:
-        text = "↩️ Orqaga / Назад"
-        button_text = "📱 Mening raqamimni yuborish / Отправить мой номер"
-    
-    return ReplyKeyboardMarkup([
-        [KeyboardButton(button_text, request_contact=True)],
-        [KeyboardButton(text)]
-    ], resize_keyboard=True)
+    for key, value in make_payload.items():
+        if value is None:
+            make_payload[key] = ""
+        elif not isinstance(value, (str, int, float)):
+            make_payload[key] = str(value)
+
+    return make_payload
 
-def start_keyboard(language='ru'):
-    """Клавиатура для кнопки Старт"""
-    return ReplyKeyboardMarkup([
-        [KeyboardButton("/start")]
-    ], resize_keyboard=True)
+def profile_fields(profile):
+    """Данные профиля для подстановки в HTML-тексты"""
+    return {field: html.escape(profile.get(field) or '—') for field in ('name', 'phone', 'tech_type')}
 
+@timed_handler
 async def start(update: Update, context: CallbackContext) -> int:
     """Начало диалога, выбор языка"""
-    keyboard = [
-        [InlineKeyboardButton("Русский язык", callback_data='lang_ru')],
-        [InlineKeyboardButton("Узбекский язык", callback_data='lang_uz')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    tracing.restart()
+    tenant = current_tenant()
+    text = tenant.texts['ru']['welcome']
+    reply_markup = tenant.catalog.language_menu
+
+    # Постоянному клиенту предлагаем сразу перейти к описанию проблемы
+    profile = await tenant.profiles.get(update.effective_user.id) if tenant.profiles is not None else None
+    if profile is not None:
+        language = profile.get('language') or 'ru'
+        text += tenant.texts[language]['profile_offer'].format(**profile_fields(profile))
+        reply_markup = tenant.catalog.profile_menu(language)
 
     await update.message.reply_text(
-        TEXTS['ru']['welcome'],
+        text,
         reply_markup=reply_markup,
         parse_mode='HTML'
     )
     
     return MAIN_MENU
 
+def requires_session(handler):
+    """Шаг диалога, которому нужна сессия пользователя.
+
+    Состояние ConversationHandler живёт в памяти дольше сессии (SESSION_TTL),
+    поэтому пользователь с истёкшей сессией начинает диалог заново, а не
+    получает KeyError в обработчике.
+    """
+    @wraps(handler)
+    async def wrapper(update: Update, context: CallbackContext) -> int:
+        if update.effective_user.id not in current_tenant().user_data:
+            logger.info("Сессия истекла, начинаем диалог заново",
+                        extra={'user_id': update.effective_user.id, 'stage': 'session'})
+            # Тело start без timed_handler: шаг уже замеряет обёртка исходного обработчика
+            return await start.__wrapped__(update, context)
+        return await handler(update, context)
+    return wrapper
+
+@timed_handler
+async def use_profile(update: Update, context: CallbackContext) -> int:
+    """Заявка с данными из прошлой заявки: имя, телефон и тип техники не спрашиваем"""
+    query = update.callback_query
+    await query.answer()
+
+    tenant = current_tenant()
+    user_id = query.from_user.id
+    profile = await tenant.profiles.get(user_id) if tenant.profiles is not None else None
+    if profile is None:
+        # Профиль ушёл в архив или кнопка из старого сообщения: предлагаем обычный диалог
+        await context.bot.send_message(
+            chat_id=query.message.chat_id,
+            text=tenant.texts['ru']['profile_not_found'] + tenant.texts['ru']['welcome'],
+            reply_markup=tenant.catalog.language_menu,
+            parse_mode='HTML'
+        )
+        return MAIN_MENU
+
+    language = profile.get('language') or 'ru'
+    tenant.user_data[user_id] = {
+        'language': language,
+        'name': profile['name'],
+        'phone': profile['phone'],
+        'tech_type': profile['tech_type'],
+        'step': 'problem'
+    }
+
+    await query.edit_message_text(
+        text=tenant.texts[language]['profile_used'].format(**profile_fields(profile)),
+        parse_mode='HTML'
+    )
+    await context.bot.send_message(
+        chat_id=query.message.chat_id,
+        text=tenant.texts[language]['describe_problem'],
+        reply_markup=tenant.catalog.markup(language, 'back'),
+        parse_mode='HTML'
+    )
+    return GET_PROBLEM
+
+@timed_handler
 async def language_choice(update: Update, context: CallbackContext) -> int:
     """Обработка выбора языка"""
     query = update.callback_query
     await query.answer()
 
+    tenant = current_tenant()
     user_id = query.from_user.id
     language = query.data.split('_')[1]
-    user_data[user_id] = {'language': language, 'step': 'name'}
+    tenant.user_data[user_id] = {'language': language, 'step': 'name'}
 
     # Обновляем сообщение с убранными кнопками
-    welcome_text = TEXTS[language]['welcome'].split('🌐')[0]
+    welcome_text = tenant.texts[language]['welcome'].split('🌐')[0]
     await query.edit_message_text(
         text=welcome_text,
         parse_mode='HTML'
@@ -283,28 +446,36 @@ async def language_choice(update: Update, context: CallbackContext) -> int:
     # Отправляем запрос имени
     await context.bot.send_message(
         chat_id=query.message.chat_id,
-        text=TEXTS[language]['enter_name'],
+        text=tenant.texts[language]['enter_name'],
         parse_mode='HTML'
     )
     
     return GET_NAME
 
+@timed_handler
+@requires_session
 async def get_name(update: Update, context: CallbackContext) -> int:
     """Получение имени пользователя"""
+    tenant = current_tenant()
+    user_data = tenant.user_data
     user_id = update.effective_user.id
     language = user_data[user_id].get('language', 'ru')
     user_data[user_id]['name'] = update.message.text
     user_data[user_id]['step'] = 'phone'
 
     await update.message.reply_text(
-        TEXTS[language]['enter_phone'],
-        reply_markup=contact_keyboard(language),
+        tenant.texts[language]['enter_phone'],
+        reply_markup=tenant.catalog.markup(language, 'contact'),
         parse_mode='HTML'
     )
     return GET_PHONE
 
+@timed_handler
+@requires_session
 async def get_phone(update: Update, context: CallbackContext) -> int:
     """Получение номера телефона"""
+    tenant = current_tenant()
+    user_data = tenant.user_data
     user_id = update.effective_user.id
     language = user_data[user_id].get('language', 'ru')
 
@@ -315,102 +486,176 @@ async def get_phone(update: Update, context: CallbackContext) -> int:
 
     user_data[user_id]['step'] = 'tech_type'
 
-    buttons = TECH_TYPES[language]
-    reply_markup = ReplyKeyboardMarkup(
-        [buttons[i:i+2] for i in range(0, len(buttons), 2)],
-        resize_keyboard=True
-    )
-
     await update.message.reply_text(
-        TEXTS[language]['select_tech'],
-        reply_markup=reply_markup,
+        tenant.texts[language]['select_tech'],
+        reply_markup=tenant.catalog.markup(language, 'tech_types'),
         parse_mode='HTML'
     )
     return GET_TECH_TYPE
 
+@timed_handler
+@requires_session
 async def get_tech_type(update: Update, context: CallbackContext) -> int:
     """Получение типа техники"""
+    tenant = current_tenant()
+    user_data = tenant.user_data
     user_id = update.effective_user.id
     language = user_data[user_id].get('language', 'ru')
     user_data[user_id]['tech_type'] = update.message.text
     user_data[user_id]['step'] = 'problem'
 
     await update.message.reply_text(
-        TEXTS[language]['describe_problem'],
-        reply_markup=get_keyboard([TEXTS[language]['back']], language),
+        tenant.texts[language]['describe_problem'],
+        reply_markup=tenant.catalog.markup(language, 'back'),
         parse_mode='HTML'
     )
     return GET_PROBLEM
 
+@timed_handler
+@requires_session
 async def get_problem(update: Update, context: CallbackContext) -> int:
     """Получение описания проблемы"""
+    tenant = current_tenant()
+    user_data = tenant.user_data
     user_id = update.effective_user.id
     language = user_data[user_id].get('language', 'ru')
     user_data[user_id]['problem'] = update.message.text
     user_data[user_id]['step'] = 'media'
 
     await update.message.reply_text(
-        TEXTS[language]['add_media'],
-        reply_markup=get_keyboard([TEXTS[language]['skip'], TEXTS[language]['back']], language),
+        tenant.texts[language]['add_media'],
+        reply_markup=tenant.catalog.markup(language, 'skip_back'),
         parse_mode='HTML'
     )
     return GET_MEDIA
 
+def attach_media(user_id, attachments):
+    """Добавляет вложения в заявку и ставит их загрузку в очередь.
+
+    Возвращает (число добавленных, число отклонённых по размеру или лимиту)
+    """
+    tenant = current_tenant()
+    user_data = tenant.user_data
+    media = user_data[user_id].get('media', [])
+    known = {item['file_unique_id'] for item in media}
+    added = rejected = 0
+
+    for attachment, kind in attachments:
+        if attachment.file_unique_id in known:
+            continue
+        if (attachment.file_size and attachment.file_size > MEDIA_SIZE_LIMITS[kind]) \
+                or len(media) >= MAX_MEDIA_FILES:
+            rejected += 1
+            continue
+        # Загрузка идёт в фоне, пользователю отвечаем сразу
+        filename = tenant.media_ingestor.submit(attachment.file_id, attachment.file_unique_id, kind, attachment.file_size)
+        media = media + [{
+            'file_id': attachment.file_id,
+            'file_unique_id': attachment.file_unique_id,
+            'type': kind,
+            'filename': filename
+        }]
+        known.add(attachment.file_unique_id)
+        added += 1
+
+    user_data[user_id]['media'] = media
+    return added, rejected
+
+async def reply_media_saved(send, user_id, added, rejected):
+    """Один ответ на принятые вложения (файл или целый альбом)"""
+    tenant = current_tenant()
+    user_data = tenant.user_data
+    language = user_data[user_id].get('language', 'ru')
+    remaining = MAX_MEDIA_FILES - len(user_data[user_id].get('media', []))
+
+    if not added and rejected:
+        await send(
+            "❌ Файл слишком большой (фото до 20MB, видео до 50MB). Попробуйте отправить другой файл:",
+            reply_markup=tenant.catalog.markup(language, 'skip_back'),
+            parse_mode='HTML'
+        )
+    elif remaining > 0:
+        await send(
+            f"📌 Файл сохранён. Можно отправить ещё {remaining} файлов или продолжить:",
+            reply_markup=tenant.catalog.markup(language, 'skip_back'),
+            parse_mode='HTML'
+        )
+    else:
+        await send(
+            "📌 Достигнут лимит вложений (10 файлов). Продолжаем:",
+            reply_markup=tenant.catalog.markup(language, 'skip'),
+            parse_mode='HTML'
+        )
+
+async def handle_album(user_id, attachments, chat_id, bot):
+    """Обработка альбома целиком: одно обновление заявки и один ответ"""
+    tenant = current_tenant()
+    user_data = tenant.user_data
+    if user_id not in user_data:
+        return
+    language = user_data[user_id].get('language', 'ru')
+    try:
+        added, rejected = attach_media(user_id, attachments)
+        await reply_media_saved(partial(bot.send_message, chat_id), user_id, added, rejected)
+    except Exception as e:
+        logger.error("Ошибка сохранения альбома: %s", e, extra={'user_id': user_id, 'stage': 'media'})
+        await bot.send_message(
+            chat_id,
+            "❌ Не удалось сохранить файл. Попробуйте отправить другой файл:",
+            reply_markup=tenant.catalog.markup(language, 'skip'),
+            parse_mode='HTML'
+        )
+
+@timed_handler
+@requires_session
 async def handle_media(update: Update, context: CallbackContext) -> int:
     """Обработка медиафайлов"""
+    tenant = current_tenant()
+    user_data = tenant.user_data
     user_id = update.effective_user.id
     language = user_data[user_id].get('language', 'ru')
 
-    if update.message.text == TEXTS[language]['skip']:
-        return await confirm_data(update, context)
-
     if update.message.photo:
-        file_id = update.message.photo[-1].file_id
-        file = await context.bot.get_file(file_id)
-        ext = "jpg"
+        attachment = update.message.photo[-1]
+        kind = "photo"
     elif update.message.video:
-        file_id = update.message.video.file_id
-        file = await context.bot.get_file(file_id)
-        ext = "mp4"
+        attachment = update.message.video
+        kind = "video"
     else:
+        # Альбом, который ещё копится, должен попасть в заявку до подтверждения
+        await tenant.album_collector.flush_user(user_id)
         return await confirm_data(update, context)
 
-    filename = f"{user_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}.{ext}"
-    file_path = os.path.join(MEDIA_DIR, filename)
+    # Файлы альбома приходят отдельными обновлениями — обрабатываем их пачкой
+    if update.message.media_group_id:
+        tenant.album_collector.add(user_id, update.message.media_group_id, (attachment, kind),
+                                   chat_id=update.effective_chat.id, bot=context.bot)
+        return GET_MEDIA
 
     try:
-        await file.download_to_drive(file_path)
-        user_data[user_id].setdefault('media', []).append(filename)
-        
-        remaining = 10 - len(user_data[user_id]['media'])
-        if remaining > 0:
-            await update.message.reply_text(
-                f"📌 Файл сохранён. Можно отправить ещё {remaining} файлов или продолжить:",
-                reply_markup=get_keyboard([TEXTS[language]['skip'], TEXTS[language]['back']], language),
-                parse_mode='HTML'
-            )
-        else:
-            await update.message.reply_text(
-                "📌 Достигнут лимит вложений (10 файлов). Продолжаем:",
-                reply_markup=get_keyboard([TEXTS[language]['skip']], language),
-                parse_mode='HTML'
-            )
+        added, rejected = attach_media(user_id, [(attachment, kind)])
+        await reply_media_saved(update.message.reply_text, user_id, added, rejected)
     except Exception as e:
-        logger.error(f"Ошибка сохранения файла {filename}: {e}")
+        logger.error("Ошибка сохранения файла %s: %s", attachment.file_unique_id, e,
+                     extra={'user_id': user_id, 'stage': 'media'})
         await update.message.reply_text(
             "❌ Не удалось сохранить файл. Попробуйте отправить другой файл:",
-            reply_markup=get_keyboard([TEXTS[language]['skip']], language),
+            reply_markup=tenant.catalog.markup(language, 'skip'),
             parse_mode='HTML'
         )
 
     return GET_MEDIA
 
+@timed_handler
+@requires_session
 async def confirm_data(update: Update, context: CallbackContext) -> int:
     """Подтверждение данных перед отправкой"""
+    tenant = current_tenant()
+    user_data = tenant.user_data
     user_id = update.effective_user.id
     language = user_data[user_id].get('language', 'ru')
 
-    confirm_text = TEXTS[language]['confirm'].format(
+    confirm_text = tenant.texts[language]['confirm'].format(
         name=user_data[user_id].get('name', '-'),
         phone=user_data[user_id].get('phone', '-'),
         tech_type=user_data[user_id].get('tech_type', '-'),
@@ -419,26 +664,138 @@ async def confirm_data(update: Update, context: CallbackContext) -> int:
 
     await update.message.reply_text(
         confirm_text,
-        reply_markup=get_keyboard(TEXTS[language]['confirm_buttons'], language),
+        reply_markup=tenant.catalog.markup(language, 'confirm'),
         parse_mode='HTML'
     )
     return CONFIRM
 
+def input_media(item, caption=None):
+    """InputMedia для вложения по его file_id"""
+    media_class = InputMediaVideo if item['type'] == 'video' else InputMediaPhoto
+    return media_class(media=item['file_id'], caption=caption, parse_mode='HTML' if caption else None)
+
+async def send_admin_text(bot, chat_id, text):
+    """Текстовое уведомление администратору"""
+    await bot.send_message(
+        chat_id=chat_id,
+        text=text,
+        parse_mode='HTML'
+    )
+
+async def send_admin_media(bot, chat_id, media, caption=None):
+    """Вложения заявки администратору пачками до 10 файлов, подпись у первого"""
+    for start in range(0, len(media), MEDIA_GROUP_LIMIT):
+        chunk = media[start:start + MEDIA_GROUP_LIMIT]
+        chunk_caption = caption if start == 0 else None
+        if len(chunk) == 1:
+            # sendMediaGroup принимает от 2 файлов
+            item = chunk[0]
+            send = bot.send_video if item['type'] == 'video' else bot.send_photo
+            await send(chat_id, item['file_id'], caption=chunk_caption,
+                       parse_mode='HTML' if chunk_caption else None)
+        else:
+            await bot.send_media_group(
+                chat_id=chat_id,
+                media=[input_media(item, chunk_caption if i == 0 else None) for i, item in enumerate(chunk)]
+            )
+
+async def notify_admin(tenant, bot, admin_text, media, order_number):
+    """Уведомление администратора: текст заявки и вложения по file_id без повторной загрузки"""
+    # Если уведомления копятся, объединяем их в дайджест
+    if tenant.admin_digest is not None and tenant.admin_digest.backed_up:
+        tenant.admin_digest.add(admin_text, media, f"#{order_number}")
+        return
+
+    # Короткий текст идёт подписью к первому вложению — одним запросом
+    caption = admin_text if media and len(admin_text) <= CAPTION_LIMIT else None
+    if caption is None:
+        await send_admin_text(bot, tenant.admin_chat_id, admin_text)
+    await send_admin_media(bot, tenant.admin_chat_id, media, caption)
+
+async def notify_admin_later(tenant, bot, admin_text, media, order_number, user_id):
+    """Уведомление администратора после ответа пользователю (фоновая задача).
+
+    Заявка уже сохранена и попадёт в Make, поэтому ошибка здесь только логируется
+    """
+    started = time.monotonic()
+    try:
+        await notify_admin(tenant, bot, admin_text, media, order_number)
+    except Exception as e:
+        logger.error("Ошибка уведомления администратора о заявке %s: %s", order_number, e,
+                     extra={'order_number': order_number, 'user_id': user_id, 'stage': 'notify_admin'})
+    finally:
+        if tenant.tracer is not None:
+            tenant.tracer.add_span(order_number, 'admin.notify', started, time.monotonic() - started,
+                                   files=len(media))
+
+def schedule_admin_notification(*args):
+    """Запускает notify_admin_later; при остановке незавершённые уведомления дожидаются отправки"""
+    task = asyncio.create_task(notify_admin_later(*args))
+    admin_notifications.add(task)
+    task.add_done_callback(admin_notifications.discard)
+
+@timed_handler
+@requires_session
 async def send_to_admin(update: Update, context: CallbackContext) -> int:
     """Отправка заявки администратору"""
+    tenant = current_tenant()
+    user_data = tenant.user_data
     user_id = update.effective_user.id
-    if user_id not in user_data:
-        language = 'ru'
-        await update.message.reply_text(
-            TEXTS[language]['error'],
-            reply_markup=get_keyboard([TEXTS[language]['back']], language),
-            parse_mode='HTML'
-        )
-        return MAIN_MENU
 
     try:
         language = user_data[user_id].get('language', 'ru')
-        order_number = get_next_order_number()
+
+        # Заявке локальные копии не нужны, поэтому загрузку вложений ждём,
+        # только если задан MEDIA_WAIT_TIMEOUT, иначе лишь отмечаем незавершённые
+        media = user_data[user_id].get('media', [])
+        if media:
+            file_unique_ids = [item['file_unique_id'] for item in media]
+            if MEDIA_WAIT_TIMEOUT > 0:
+                with trace_span('media.wait', files=len(media)):
+                    statuses = await tenant.media_ingestor.wait(file_unique_ids, MEDIA_WAIT_TIMEOUT)
+            else:
+                statuses = {uid: tenant.media_ingestor.status(uid) for uid in file_unique_ids}
+            not_ready = [uid for uid, status in statuses.items() if status not in (MEDIA_DONE, MEDIA_REMOTE)]
+            if not_ready:
+                logger.info("Вложения ещё загружаются при подтверждении заявки: %s", not_ready,
+                            extra={'user_id': user_id, 'stage': 'media'})
+
+        session = user_data[user_id]
+        username = update.effective_user.username
+
+        def build(order_number):
+            make_data = {
+                "order_number": order_number,
+                "user_id": user_id,
+                "username": username or "Не указано",
+                "name": session.get('name', 'Не указано'),
+                "phone": session.get('phone', 'Не указано'),
+                "tech_type": session.get('tech_type', 'Не указано'),
+                "problem": session.get('problem', 'Не указано'),
+                "language": language,
+                "media_count": len(media),
+                "source": "telegram"
+            }
+            order = (order_number,
+                     user_id,
+                     username,
+                     session.get('name'),
+                     session.get('phone'),
+                     session.get('tech_type'),
+                     session.get('problem'),
+                     ",".join(item['filename'] for item in media),
+                     language)
+            return order, build_make_payload(make_data)
+
+        # Повторное подтверждение той же заявки (повтор webhook после сбоя)
+        # должно вернуть уже выделенный номер, а не создать новую заявку
+        idempotency_key = session.setdefault('order_key', f"{user_id}:{update.message.message_id}")
+
+        # Выделяем номер и сохраняем заявку и запись для Make в одной транзакции
+        # (время этапа включает ожидание очереди записи и коммит)
+        with trace_span('db.place_order') as timings:
+            order_number, created = await tenant.storage.write(place_order, idempotency_key,
+                                                               datetime.now(MOSCOW_TZ), build, timings)
 
         admin_text = (
             f"🚨 <b>Новая заявка #{order_number}</b>\n\n"
@@ -447,59 +804,37 @@ async def send_to_admin(update: Update, context: CallbackContext) -> int:
             f"🛠 <b>Тип техники:</b> {user_data[user_id].get('tech_type', 'Не указано')}\n"
             f"❗ <b>Проблема:</b> {user_data[user_id].get('problem', 'Не указано')}\n"
             f"🌐 <b>Язык:</b> {language}\n"
-            f"📷 <b>Медиафайлов:</b> {len(user_data[user_id].get('media', []))} шт\n"
+            f"📷 <b>Медиафайлов:</b> {len(media)} шт\n"
             f"🕒 <b>Время:</b> {datetime.now(MOSCOW_TZ).strftime('%H:%M %d.%m.%Y')}"
         )
 
-        # Сохраняем в базу данных
-        conn = sqlite3.connect('orders.db')
-        c = conn.cursor()
-        c.execute('''INSERT INTO orders
-                    (order_number, user_id, username, name, phone, tech_type, problem, media_files, language)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                (order_number,
-                user_id,
-                update.effective_user.username,
-                user_data[user_id].get('name'),
-                user_data[user_id].get('phone'),
-                user_data[user_id].get('tech_type'),
-                user_data[user_id].get('problem'),
-                ",".join(user_data[user_id].get('media', [])),
-                language))
-        conn.commit()
-        conn.close()
-
-        # Отправляем данные в Make
-        make_data = {
-            "order_number": order_number,
-            "user_id": user_id,
-            "username": update.effective_user.username or "Не указано",
-            "name": user_data[user_id].get('name', 'Не указано'),
-            "phone": user_data[user_id].get('phone', 'Не указано'),
-            "tech_type": user_data[user_id].get('tech_type', 'Не указано'),
-            "problem": user_data[user_id].get('problem', 'Не указано'),
-            "language": language,
-            "media_count": len(user_data[user_id].get('media', [])),
-            "source": "telegram"
-        }
-
-        # Отправляем данные в Make
-        await send_to_make_webhook(make_data)
-
-        # Отправляем уведомление администратору
-        await context.bot.send_message(
-            chat_id=ADMIN_CHAT_ID,
-            text=admin_text,
-            parse_mode='HTML'
-        )
+        if created:
+            tracing.set_order(order_number)
+            if tenant.profiles is not None:
+                tenant.profiles.remember(user_id, session)
+
+            # Доставка в Make идёт в фоне, ответ пользователю её не ждёт
+            if tenant.make_dispatcher is not None:
+                tenant.make_dispatcher.wake()
+
+            # Уведомление администратору ставим сразу после сохранения: заявка уже в базе,
+            # и сбой ответа пользователю не должен её потерять (повтор придёт с created=False).
+            # Задача идёт в фоне с низким приоритетом, чат администратора ограничен
+            # 1 сообщением в секунду, и подтверждение не стоит в его очереди
+            schedule_admin_notification(tenant, context.bot, admin_text, media, order_number, user_id)
+
+        else:
+            logger.info("♻️ Повторное подтверждение заявки %s, уведомления не отправляем", order_number,
+                        extra={'order_number': order_number, 'user_id': user_id, 'stage': 'confirm'})
 
         # Отправляем подтверждение пользователю
-        success_text = TEXTS[language]['success'].format(order_number=order_number)
-        await update.message.reply_text(
-            success_text,
-            reply_markup=start_keyboard(language),
-            parse_mode='HTML'
-        )
+        success_text = tenant.texts[language]['success'].format(order_number=order_number)
+        with trace_span('user.reply'):
+            await update.message.reply_text(
+                success_text,
+                reply_markup=tenant.catalog.markup(language, 'start'),
+                parse_mode='HTML'
+            )
 
         # Очищаем данные пользователя
         if user_id in user_data:
@@ -508,17 +843,22 @@ async def send_to_admin(update: Update, context: CallbackContext) -> int:
         return ConversationHandler.END
 
     except Exception as e:
-        logger.error(f"Ошибка при отправке заявки: {e}")
+        logger.error("Ошибка при отправке заявки: %s", e,
+                     extra={'user_id': user_id, 'stage': 'send_order',
+                            'phone': user_data.get(user_id, {}).get('phone')})
         language = user_data.get(user_id, {}).get('language', 'ru')
         await update.message.reply_text(
-            TEXTS[language]['error'],
-            reply_markup=get_keyboard([TEXTS[language]['back']], language),
+            tenant.texts[language]['error'],
+            reply_markup=tenant.catalog.markup(language, 'back'),
             parse_mode='HTML'
         )
         return MAIN_MENU
 
+@timed_handler
 async def cancel(update: Update, context: CallbackContext) -> int:
     """Отмена диалога"""
+    tenant = current_tenant()
+    user_data = tenant.user_data
     user_id = update.effective_user.id
     language = user_data.get(user_id, {}).get('language', 'ru')
     
@@ -526,57 +866,406 @@ async def cancel(update: Update, context: CallbackContext) -> int:
         del user_data[user_id]
     
     await update.message.reply_text(
-        TEXTS[language]['cancel'],
-        reply_markup=start_keyboard(language),
+        tenant.texts[language]['cancel'],
+        reply_markup=tenant.catalog.markup(language, 'start'),
         parse_mode='HTML'
     )
     return ConversationHandler.END
 
 async def error_handler(update: Update, context: CallbackContext) -> None:
     """Обработка ошибок"""
-    logger.error(f"Ошибка при обработке обновления: {context.error}")
+    user = update.effective_user if isinstance(update, Update) else None
+    logger.error("Ошибка при обработке обновления: %s", context.error,
+                 extra={'user_id': user.id if user else None, 'stage': 'update'})
+
+def create_tenants():
+    """Боты процесса: из BOTS_CONFIG или один бот из переменных окружения"""
+    if BOTS_CONFIG:
+        configured = load_tenants(BOTS_CONFIG, TEXTS, TECH_TYPES,
+                                  webhook_url=WEBHOOK_URL, db_path=DB_PATH, media_dir=MEDIA_DIR)
+    else:
+        configured = [Tenant(DEFAULT_BOT_ID, TOKEN, ADMIN_CHAT_ID, MAKE_WEBHOOK_URL, WEBHOOK_URL, DB_PATH, MEDIA_DIR,
+                             TEXTS, TECH_TYPES)]
+
+    for tenant in configured:
+        tenant.catalog = Catalog(tenant.texts, tenant.tech_types)
+        tenant.user_data = SessionStore(capacity=SESSION_CACHE_SIZE, ttl=SESSION_TTL,
+                                        flush_interval=SESSION_FLUSH_INTERVAL)
+        tenant.album_collector = AlbumCollector(handle_album, window=ALBUM_WINDOW)
+        # Очередь общая для всех ботов, поэтому и пороги считаются от её общего размера
+        tenant.admission = AdmissionController(
+            UPDATE_QUEUE_SIZE * WORKER_PROCESSES,
+            confirm_texts=tenant.catalog.confirm_texts,
+            high_water=ADMISSION_HIGH_WATER,
+            reserve=ADMISSION_RESERVE,
+            messages_per_minute=USER_MESSAGES_PER_MINUTE,
+            media_bytes_per_minute=USER_MEDIA_MB_PER_MINUTE * 1024 * 1024
+        )
+    return {tenant.bot_id: tenant for tenant in configured}
+
+tenants = create_tenants()
 
 # Создаем Flask приложение
 app = Flask(__name__)
 
+ACTIVE_SESSIONS.set_function(lambda: sum(len(tenant.user_data) for tenant in tenants.values()))
+UPDATE_QUEUE_DEPTH.set_function(
+    lambda: runtime.qsize if runtime is not None else worker_pool.qsize if worker_pool is not None else 0
+)
+
 @app.route('/')
 def index():
     return "Bot is running and ready to receive webhooks!"
 
+@app.route('/metrics')
+def metrics():
+    """Метрики в формате Prometheus (при WORKER_PROCESSES > 1 — и процессов-обработчиков)"""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+def authorized():
+    """Проверка токена служебных API"""
+    if not ORDERS_API_TOKEN:
+        return False
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    return hmac.compare_digest(token.encode(), ORDERS_API_TOKEN.encode())
+
+def requested_tenant():
+    """Бот служебного API из параметра bot (если бот один, параметр можно не указывать)"""
+    bot_id = request.args.get('bot')
+    if bot_id is None and len(tenants) == 1:
+        return next(iter(tenants.values()))
+    if bot_id is None:
+        raise ValueError(f"Укажите bot: {', '.join(tenants)}")
+    if bot_id not in tenants:
+        raise ValueError(f"Неизвестный бот: {bot_id}")
+    return tenants[bot_id]
+
+@app.route('/orders')
+def orders():
+    """Выборка заявок с фильтрами и keyset-пагинацией"""
+    if not authorized():
+        return jsonify(error="Unauthorized"), 401
+    try:
+        tenant = requested_tenant()
+        if tenant.storage is None:
+            return jsonify(error="Storage not initialized"), 503
+        filters, cursor, limit = parse_filters(request.args)
+        if request.args.get('archive'):
+            # Заявки за месяц из архива (см. maintenance.py)
+            rows, next_cursor = read_archive(DB_ARCHIVE_DIR, tenant.db_path, request.args['archive'],
+                                             query_orders, filters, cursor, limit)
+        else:
+            rows, next_cursor = tenant.storage.read_sync(query_orders, filters, cursor, limit)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    except sqlite3.Error as e:
+        logger.error("Ошибка выборки заявок: %s", e, extra={'stage': 'db'})
+        return jsonify(error="Database error"), 500
+    return jsonify(orders=rows, next_cursor=next_cursor)
+
+@app.route('/orders/export')
+def orders_export():
+    """Потоковая выгрузка заявок в CSV или JSONL"""
+    if not authorized():
+        return jsonify(error="Unauthorized"), 401
+    try:
+        tenant = requested_tenant()
+        fmt, filters, after_id = parse_export_args(request.args)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    if tenant.storage is None:
+        return jsonify(error="Storage not initialized"), 503
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(export_orders(tenant.storage.read_sync, fmt, filters, after_id)),
+                    mimetype=f'{mimetype}; charset=utf-8',
+                    headers={'Content-Disposition': f'attachment; filename=orders.{fmt}'})
+
+@app.route('/orders/stats')
+def orders_stats():
+    """Число заявок по дням, типу техники и языку из предрасчитанных агрегатов"""
+    if not authorized():
+        return jsonify(error="Unauthorized"), 401
+    try:
+        tenant = requested_tenant()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    if tenant.storage is None:
+        return jsonify(error="Storage not initialized"), 503
+    rows = tenant.storage.read_sync(select_rollups, request.args.get('date_from'), request.args.get('date_to'))
+    return jsonify(rollups=rows)
+
+@app.route('/orders/archives')
+def orders_archives():
+    """Месяцы, за которые есть архивы заявок (для /orders?archive=YYYY-MM)"""
+    if not authorized():
+        return jsonify(error="Unauthorized"), 401
+    try:
+        tenant = requested_tenant()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(months=archive_months(DB_ARCHIVE_DIR, tenant.db_path))
+
+@app.route('/debug/trace/<order_number>')
+def debug_trace(order_number):
+    """Этапы заявки с длительностями: из памяти или из сохранённых медленных трасс"""
+    if not authorized():
+        return jsonify(error="Unauthorized"), 401
+    try:
+        tenant = requested_tenant()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    # Во фронтенде многопроцессного режима своих трасс нет — только сохранённые в базе
+    read = tenant.storage.read_sync if tenant.storage is not None else None
+    trace = (tenant.tracer or Tracer()).get(order_number, read)
+    if trace is None:
+        return jsonify(error="Trace not found"), 404
+    return jsonify(trace)
+
+@app.route('/debug/traces')
+def debug_traces():
+    """Самые медленные подтверждения заявок (limit — сколько вернуть)"""
+    if not authorized():
+        return jsonify(error="Unauthorized"), 401
+    try:
+        tenant = requested_tenant()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    try:
+        limit = min(int(request.args.get('limit', 20)), 200)
+    except ValueError:
+        return jsonify(error="limit должен быть числом"), 400
+    read = tenant.storage.read_sync if tenant.storage is not None else None
+    traces = (tenant.tracer or Tracer()).slowest(limit, read)
+    return jsonify(traces=[{key: trace[key] for key in ('order_number', 'user_id', 'started_at', 'latency_ms',
+                                                        'dominant_stage')} for trace in traces])
+
 @app.route('/webhook', methods=['POST'])
-def webhook():
-    """Обработчик webhook от Telegram"""
-    if application is None:
+@app.route('/webhook/<bot_id>', methods=['POST'])
+def webhook(bot_id=DEFAULT_BOT_ID):
+    """Обработчик webhook от Telegram. /webhook — бот без BOTS_CONFIG, /webhook/<id> — бот из конфигурации"""
+    tenant = tenants.get(bot_id)
+    if tenant is None:
+        return "Unknown bot", 404
+    with WEBHOOK_ACK_LATENCY.time():
+        body, status = handle_webhook(tenant)
+    WEBHOOK_RESPONSES.inc(status=status)
+    return body, status
+
+def queue_depth():
+    """Обновлений в очереди (в многопроцессном режиме — во всех процессах)"""
+    if worker_pool is not None:
+        return worker_pool.qsize
+    return runtime.qsize if runtime is not None else 0
+
+def admit_update(tenant, update_data):
+    """Решение admission control и параметры sendMessage для предупреждения пользователя (или None)"""
+    decision = tenant.admission.admit(update_data, queue_depth())
+    notice = None
+    if decision.notify:
+        user_id, chat_id, language_code = sender(update_data)
+        logger.warning("⏳ Обновление пользователя %s сброшено (%s)", user_id, decision.reason,
+                       extra={'user_id': user_id, 'stage': 'admission'})
+        language = 'uz' if language_code == 'uz' else 'ru'
+        notice = {'chat_id': chat_id, 'text': tenant.texts[language]['slow_down'], 'parse_mode': 'HTML'}
+    return decision, notice
+
+def admit_polled(tenant, update_data):
+    """Admission control для polling: очередь сама ждёт места, поэтому сбрасываются только SHED"""
+    decision, notice = admit_update(tenant, update_data)
+    return decision.outcome != SHED, notice
+
+def admission_response(decision, notice):
+    """Ответ на webhook для непринятого обновления"""
+    if decision.outcome == BUSY:
+        return "Busy", 503
+    # Telegram выполнит sendMessage из ответа на webhook, отдельный запрос к Bot API не нужен
+    if notice is not None:
+        return jsonify(method='sendMessage', **notice), 200
+    return "OK", 200
+
+def handle_webhook(tenant):
+    """Разбор обновления и постановка в очередь"""
+    if worker_pool is not None:
+        return forward_webhook(tenant)
+    if runtime is None:
         return "Application not initialized", 500
         
     try:
         # Получаем обновление от Telegram
         update_data = request.get_json()
-        update = Update.de_json(update_data, application.bot)
+        decision, notice = admit_update(tenant, update_data)
+        if decision.outcome != ACCEPT:
+            return admission_response(decision, notice)
         
-        # Обрабатываем обновление асинхронно
-        asyncio.run(application.process_update(update))
+        # Ставим обновление в очередь и сразу отвечаем Telegram. Разбор в Update
+        # идёт в обработчике, поэтому очередь принимает обновления ещё до готовности application
+        # Очередь общая для всех ботов, обновления одного пользователя одного бота идут по порядку
+        if not runtime.submit((tenant.bot_id, raw_update_key(update_data)), (tenant.bot_id, update_data)):
+            logger.error("Очередь обновлений переполнена")
+            return "Busy", 503
         
         return "OK", 200
     except Exception as e:
-        logger.error(f"Ошибка обработки webhook: {e}")
+        logger.error("Ошибка обработки webhook: %s", e, extra={'stage': 'admission'})
         return "Error", 500
 
-async def main() -> None:
-    """Основная функция запуска бота"""
-    global application
-    
-    # Инициализация базы данных
-    init_db()
-    
-    # Создание приложения
-    application = Application.builder().token(TOKEN).build()
+def forward_webhook(tenant):
+    """Передача обновления в процесс-обработчик его пользователя"""
+    try:
+        update_data = request.get_json()
+        decision, notice = admit_update(tenant, update_data)
+        if decision.outcome != ACCEPT:
+            return admission_response(decision, notice)
+        if not worker_pool.submit(raw_update_key(update_data), (tenant.bot_id, update_data)):
+            logger.error("Очередь процесса-обработчика переполнена")
+            return "Busy", 503
+        return "OK", 200
+    except Exception as e:
+        logger.error("Ошибка передачи webhook обработчику: %s", e, extra={'stage': 'admission'})
+        return "Error", 500
+
+def owns_user(user_id):
+    """Обслуживает ли этот процесс пользователя"""
+    return shard_for(user_id, WORKER_PROCESSES) == worker_index
+
+async def process_update(item):
+    """Обработка обновления из очереди: item — (id бота, JSON обновления)"""
+    global first_update_processed
+    bot_id, update_data = item
+    await application_ready.wait()
+    tenant = tenants[bot_id]
+    application = tenant.application
+    update = Update.de_json(update_data, application.bot)
+    if tenant.update_dedupe is not None and await tenant.update_dedupe.seen(update.update_id):
+        logger.info("♻️ Повторное обновление %s пропущено", update.update_id, extra={'stage': 'dedupe'})
+        return
+    # Обработчики диалога берут бота обновления из contextvar: его наследуют и задачи,
+    # созданные во время обработки (альбомы)
+    token = activate_tenant(tenant)
+    try:
+        if update.effective_user is None:
+            await application.process_update(update)
+        else:
+            # Каждое обновление пользователя — этап трассы его будущей заявки
+            with tenant.tracer.update(update.effective_user.id, update_id=update.update_id):
+                with trace_span('session.prefetch'):
+                    await tenant.user_data.prefetch(update.effective_user.id)
+                await application.process_update(update)
+    finally:
+        deactivate_tenant(token)
+
+    if not first_update_processed:
+        first_update_processed = True
+        elapsed = time.monotonic() - BOOT_STARTED
+        TIME_TO_FIRST_UPDATE.set(elapsed)
+        logger.info("⏱ Первое обновление обработано через %.2f с после запуска", elapsed, extra={'stage': 'startup'})
+
+async def shutdown():
+    """Остановка ботов с сохранением незавершённых диалогов"""
+    # Сначала перестаём запрашивать обновления, затем дорабатываем очередь
+    await asyncio.gather(*(tenant.poller.stop() for tenant in tenants.values() if tenant.poller is not None))
+    await runtime.stop_workers()
+    # Уведомления администратору дожидаются отправки, в том числе собранные в дайджест
+    deadline = time.monotonic() + ADMIN_NOTIFY_SHUTDOWN_TIMEOUT
+    if admin_notifications:
+        await asyncio.wait(admin_notifications, timeout=ADMIN_NOTIFY_SHUTDOWN_TIMEOUT)
+    digests = [tenant.admin_digest.close() for tenant in tenants.values() if tenant.admin_digest is not None]
+    if digests:
+        try:
+            await asyncio.wait_for(asyncio.gather(*digests), max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            logger.error("Дайджест администратору не отправлен за %s с", ADMIN_NOTIFY_SHUTDOWN_TIMEOUT,
+                         extra={'stage': 'shutdown'})
+    if preview_pool is not None:
+        preview_pool.shutdown(wait=False, cancel_futures=True)
+    for tenant in tenants.values():
+        application = tenant.application
+        if application is None:
+            continue
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+    # Общие пулы закрываются после остановки всех ботов (пул Bot API закрывает первый application)
+    for client in (make_client, poll_client):
+        if client is not None:
+            await client.aclose()
+
+async def register_webhook(bot, webhook_url):
+    """Установка webhook, если он ещё не указывает на этот сервер"""
+    try:
+        # При каждом пробуждении машины webhook обычно уже установлен — лишние запросы не нужны
+        info = await bot.get_webhook_info()
+        if info.url == webhook_url:
+            logger.info("Webhook уже установлен: %s", webhook_url, extra={'stage': 'startup'})
+            return True
+        # set_webhook заменяет прежний адрес, удалять его заранее не нужно
+        logger.info("Устанавливаем webhook: %s", webhook_url, extra={'stage': 'startup'})
+        await bot.set_webhook(webhook_url)
+        logger.info("Webhook успешно установлен!")
+        return True
+    except Exception as e:
+        logger.error("Ошибка установки webhook: %s", e, extra={'stage': 'startup'})
+        return False
+
+async def connect_bot(tenant, set_webhook):
+    """getMe и проверка webhook"""
+    await tenant.application.bot.initialize()
+    if not set_webhook:
+        return True
+    return await register_webhook(tenant.application.bot, tenant.webhook_url)
+
+def use_polling(webhook_success):
+    """Получать ли обновления через getUpdates"""
+    if UPDATE_MODE == 'polling':
+        return True
+    if not webhook_success and POLLING_FALLBACK:
+        logger.error("Не удалось установить webhook, переходим на long polling")
+        return True
+    return False
+
+def create_poller(tenant, submit, client=None):
+    """Long polling бота с передачей обновлений в submit(id бота, key, data)"""
+    return UpdatePoller(TELEGRAM_API_URL, tenant.token, partial(submit, tenant.bot_id), raw_update_key,
+                        timeout=POLL_TIMEOUT, limit=POLL_LIMIT, allowed_updates=Update.ALL_TYPES,
+                        admit=partial(admit_polled, tenant), client=client)
+
+async def queue_polled(bot_id, key, data):
+    """Передача обновления из polling в общую очередь, дожидаясь места"""
+    await runtime.put((bot_id, key), (bot_id, data))
+
+def build_application(tenant, request, get_updates_request):
+    """Application бота: свои лимиты Bot API и состояния диалогов, общие пулы соединений"""
+    persistence = ConversationPersistence(tenant.storage, ttl=SESSION_TTL, update_interval=SESSION_FLUSH_INTERVAL)
+    # Лимиты Telegram у каждого токена свои; общий лимит делится между процессами-обработчиками
+    rate_limiter = PriorityRateLimiter(overall_rate=OVERALL_RATE / WORKER_PROCESSES,
+                                       low_priority_chats={tenant.admin_chat_id},
+                                       processes=WORKER_PROCESSES)
+    application = (
+        Application.builder()
+        .token(tenant.token)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .persistence(persistence)
+        .rate_limiter(rate_limiter)
+        .build()
+    )
+
+    if ADMIN_DIGEST:
+        tenant.admin_digest = AdminDigest(rate_limiter, tenant.admin_chat_id,
+                                          partial(send_admin_text, application.bot, tenant.admin_chat_id),
+                                          partial(send_admin_media, application.bot, tenant.admin_chat_id),
+                                          threshold=ADMIN_DIGEST_THRESHOLD)
 
     # Настройка ConversationHandler
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
         states={
-            MAIN_MENU: [CallbackQueryHandler(language_choice, pattern='^lang_')],
+            MAIN_MENU: [
+                CallbackQueryHandler(language_choice, pattern='^lang_'),
+                CallbackQueryHandler(use_profile, pattern='^profile_use$')
+            ],
             GET_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_name)],
             GET_PHONE: [
                 MessageHandler(filters.CONTACT, get_phone),
@@ -589,56 +1278,284 @@ async def main() -> None:
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_media)
             ],
             CONFIRM: [
-                MessageHandler(filters.Regex('^(✅ Да, всё верно|✅ Ha, hammasi to\'g\'ri)$'), send_to_admin),
-                MessageHandler(filters.Regex('^(❌ Нет, изменить данные|❌ Yo\'q, o\'zgartirmoqchiman)$'), start)
+                # Тексты кнопок у каждого бота могут быть свои, фильтры собраны из них же
+                MessageHandler(tenant.catalog.confirm_filter, send_to_admin),
+                MessageHandler(tenant.catalog.change_filter, start)
             ]
         },
         fallbacks=[CommandHandler('cancel', cancel)],
         per_message=False,
-        allow_reentry=True
+        allow_reentry=True,
+        name='order',
+        persistent=True
     )
 
     # Добавление обработчиков
     application.add_handler(conv_handler)
     application.add_error_handler(error_handler)
+    tenant.application = application
+
+def start_services(tenant):
+    """Фоновые задачи бота: сессии, отсев повторов, загрузка медиа, Make, очистка диска и обслуживание базы"""
+    runtime.spawn(tenant.user_data.warm(owns=owns_user if WORKER_PROCESSES > 1 else None),
+                  name=f"session-warm-{tenant.bot_id}")
+    runtime.spawn(tenant.user_data.run(), name=f"session-flusher-{tenant.bot_id}")
+    runtime.spawn(tenant.update_dedupe.run(), name=f"update-dedupe-{tenant.bot_id}")
+
+    # Запускаем фоновую загрузку медиафайлов
+    runtime.spawn(tenant.media_ingestor.run(tenant.application.bot, resume=worker_index == 0),
+                  name=f"media-ingestor-{tenant.bot_id}")
+
+    # Доставка в Make, очистка диска от старых оригиналов и обслуживание базы
+    # (в многопроцессном режиме — только в первом процессе)
+    if worker_index == 0:
+        tenant.make_dispatcher = MakeDispatcher(tenant.storage, tenant.make_webhook_url,
+                                                concurrency=MAKE_CONCURRENCY,
+                                                max_attempts=MAKE_MAX_ATTEMPTS,
+                                                poll_interval=MAKE_POLL_INTERVAL if WORKER_PROCESSES > 1 else None,
+                                                tracer=tenant.tracer,
+                                                client=make_client)
+        runtime.spawn(tenant.make_dispatcher.run(), name=f"make-dispatcher-{tenant.bot_id}")
+
+        media_retention = MediaRetention(tenant.storage, tenant.media_dir,
+                                         quota=MEDIA_QUOTA_MB * 1024 * 1024,
+                                         max_age=MEDIA_MAX_AGE_DAYS * 24 * 60 * 60,
+                                         abandon_after=SESSION_TTL,
+                                         interval=MEDIA_RETENTION_INTERVAL)
+        runtime.spawn(media_retention.run(), name=f"media-retention-{tenant.bot_id}")
+
+        db_maintenance = DatabaseMaintenance(tenant.storage, DB_ARCHIVE_DIR,
+                                             horizon=DB_ARCHIVE_DAYS * 24 * 60 * 60,
+                                             backup_dir=DB_BACKUP_DIR,
+                                             interval=DB_MAINTENANCE_INTERVAL,
+                                             backup_interval=DB_BACKUP_INTERVAL,
+                                             backups=DB_BACKUPS)
+        runtime.spawn(db_maintenance.run(), name=f"db-maintenance-{tenant.bot_id}")
+
+async def main(receive_updates=True) -> None:
+    """Основная функция запуска ботов.
+
+    receive_updates=False — обновления приходят от фронтенда (процесс-обработчик),
+    webhook и polling этому процессу не нужны. Возвращает True, если обновления
+    будут приходить всем ботам.
+    """
+    global preview_pool, bot_request, make_client, poll_client
+
+    # Пулы соединений общие для всех ботов: у каждого application по умолчанию были бы
+    # свои httpx-клиенты (со своими TLS-контекстами) для запросов и для getUpdates
+    bot_request = HTTPXRequest(connection_pool_size=BOT_API_CONNECTIONS)
+    # getUpdates средствами PTB не вызывается (см. polling.py), хватает одного соединения
+    updates_request = HTTPXRequest()
+
+    for tenant in tenants.values():
+        open_storage(tenant)
+        tenant.tracer = Tracer(tenant.storage, capacity=TRACE_BUFFER_SIZE, slow_threshold=TRACE_SLOW_SECONDS)
+        tenant.profiles = ProfileCache(tenant.storage, capacity=PROFILE_CACHE_SIZE)
+        build_application(tenant, bot_request, updates_request)
+
+    # Схемы баз создаются в отдельных потоках, пока идут сетевые запросы к Bot API
+    set_webhook = receive_updates and UPDATE_MODE == 'webhook'
+    results = await asyncio.gather(*(asyncio.to_thread(prepare_db, tenant) for tenant in tenants.values()),
+                                   *(connect_bot(tenant, set_webhook) for tenant in tenants.values()))
+    webhook_results = dict(zip(tenants, results[len(tenants):]))
+    await asyncio.gather(*(tenant.application.initialize() for tenant in tenants.values()))
+
+    # Отсев повторных доставок webhook
+    for tenant in tenants.values():
+        tenant.update_dedupe = UpdateDeduplicator(tenant.storage, capacity=DEDUPE_CACHE_SIZE, history=DEDUPE_HISTORY)
+    await asyncio.gather(*(tenant.update_dedupe.warm() for tenant in tenants.values()))
+
+    # Превью строятся в отдельных процессах: процессы запускаются при первом файле, а не при старте
+    if MEDIA_PREVIEW_PROCESSES > 0:
+        preview_pool = ProcessPoolExecutor(max_workers=MEDIA_PREVIEW_PROCESSES,
+                                           mp_context=multiprocessing.get_context('spawn'))
+    for tenant in tenants.values():
+        tenant.media_ingestor = MediaIngestor(tenant.storage, tenant.media_dir, concurrency=MEDIA_CONCURRENCY,
+                                              download=MEDIA_DOWNLOAD, preview_pool=preview_pool)
+
+    await asyncio.gather(*(tenant.application.start() for tenant in tenants.values()))
+
+    # С этого момента обработчики берут обновления из очереди
+    application_ready.set()
+    STARTUP_DURATION.set(time.monotonic() - BOOT_STARTED, stage='ready')
+    logger.info("✅ Ботов готово к обработке обновлений: %s, через %.2f с после запуска",
+                len(tenants), time.monotonic() - BOOT_STARTED, extra={'stage': 'startup'})
+
+    # Остальное запускается в фоне и первое обновление не задерживает
+    if worker_index == 0:
+        make_client = httpx.AsyncClient(
+            timeout=10.0,
+            limits=httpx.Limits(max_connections=MAKE_CONCURRENCY * len(tenants),
+                                max_keepalive_connections=MAKE_CONCURRENCY * len(tenants))
+        )
+    for tenant in tenants.values():
+        start_services(tenant)
 
-    # Устанавливаем webhook
-    webhook_url = "https://zorservbot.fly.dev/webhook"
-    logger.info(f"Устанавливаем webhook: {webhook_url}")
-    
-    try:
-        # Очищаем предыдущий webhook и устанавливаем новый
-        await application.bot.delete_webhook()
-        await asyncio.sleep(1)
-        await application.bot.set_webhook(webhook_url)
-        logger.info("Webhook успешно установлен!")
+    if not receive_updates:
         return True
-    except Exception as e:
-        logger.error(f"Ошибка установки webhook: {e}")
-        return False
-
-def run_bot():
-    """Запуск бота"""
-    global application
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
 
+    # Polling использует ту же очередь и те же обработчики, что и webhook
+    receiving = True
+    for bot_id, tenant in tenants.items():
+        if use_polling(webhook_results[bot_id]):
+            if poll_client is None:
+                poll_client = httpx.AsyncClient(timeout=httpx.Timeout(10.0, read=POLL_TIMEOUT + 10.0))
+            tenant.poller = create_poller(tenant, queue_polled, client=poll_client)
+            tenant.poller.start()
+        elif not webhook_results[bot_id]:
+            receiving = False
+    return receiving
+
+def start_update_queue():
+    """Запуск event loop и очереди обновлений"""
+    global runtime
+    # Один долгоживущий event loop владеет application всех ботов на всё время работы
+    runtime = UpdateRuntime(queue_size=UPDATE_QUEUE_SIZE, workers=UPDATE_WORKERS)
+    runtime.start()
+    # Очередь принимает обновления сразу, обработка начнётся после инициализации application
+    runtime.run(runtime.start_workers(process_update))
+
+def start_runtime(receive_updates=True):
+    """Запуск event loop и инициализация ботов без HTTP-сервера"""
+    start_update_queue()
+    return runtime.run(main(receive_updates))
+
+def stop_runtime():
+    """Остановка ботов с сохранением состояния"""
+    runtime.run(shutdown())
+    close_storage()
+    runtime.stop()
+
+def push_metrics(index, snapshots, stopped):
+    """Периодически отправляет фронтенду снимок метрик процесса-обработчика"""
+    while not stopped.wait(METRICS_PUSH_INTERVAL):
+        snapshots.put((index, REGISTRY.snapshot()))
+
+def run_worker(index, processes, updates, ready, snapshots):
+    """Процесс-обработчик: свой event loop и application ботов, обновления из очереди фронтенда"""
+    global worker_index
+    worker_index = index
     try:
-        webhook_success = loop.run_until_complete(main())
-
-        if webhook_success:
-            logger.info(f"Запускаем Flask сервер на порту {PORT}")
-            from waitress import serve
-            serve(app, host="0.0.0.0", port=PORT)   # блокирующий запуск
-        else:
-            logger.error("Не удалось установить webhook, запускаем polling")
-            application.run_polling(allowed_updates=Update.ALL_TYPES)
+        start_runtime(receive_updates=False)
     except Exception as e:
-        logger.error(f"Критическая ошибка при запуске бота: {e}")
-        try:
-            application.run_polling(allowed_updates=Update.ALL_TYPES)
-        except:
+        logger.critical("Процесс-обработчик %s не запустился: %s", index, e, extra={'stage': 'startup'})
+        ready.put((index, False))
+        return
+    ready.put((index, True))
+    stopped = threading.Event()
+    threading.Thread(target=push_metrics, args=(index, snapshots, stopped), name="metrics-push",
+                     daemon=True).start()
+    try:
+        while True:
+            item = updates.get()
+            if item is None:
+                break
+            bot_id, update_data = item
+            # Обновление уже подтверждено Telegram, поэтому не теряем его, а ждём места в очереди
+            while not runtime.submit((bot_id, raw_update_key(update_data)), item):
+                time.sleep(0.05)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_runtime()
+        stopped.set()
+        # Последний снимок: метрики, накопленные при остановке, тоже попадают на /metrics
+        snapshots.put((index, REGISTRY.snapshot()))
+
+async def register_frontend_webhook(tenant):
+    """Установка webhook из фронтенда, у которого нет своего application"""
+    async with Bot(tenant.token, base_url=f"{TELEGRAM_API_URL}/bot",
+                   base_file_url=f"{TELEGRAM_API_URL}/file/bot") as bot:
+        return await register_webhook(bot, tenant.webhook_url)
+
+async def register_frontend_webhooks():
+    """Webhook всех ботов. Возвращает {id бота: установлен ли webhook}"""
+    results = await asyncio.gather(*(register_frontend_webhook(tenant) for tenant in tenants.values()))
+    return dict(zip(tenants, results))
+
+def start_http_server(sockets=None):
+    """Открывает HTTP-порт и обслуживает запросы в фоновом потоке"""
+    from waitress import create_server
+    if sockets:
+        server = create_server(app, sockets=sockets)
+    else:
+        server = create_server(app, host="0.0.0.0", port=PORT)
+    thread = threading.Thread(target=server.run, name="waitress", daemon=True)
+    thread.start()
+    elapsed = time.monotonic() - BOOT_STARTED
+    STARTUP_DURATION.set(elapsed, stage='listen')
+    logger.info("🌐 HTTP-сервер слушает порт %s через %.2f с после запуска", PORT, elapsed, extra={'stage': 'startup'})
+    return thread
+
+def wait_http_server(thread):
+    """Блокирует главный поток до остановки (Ctrl+C / SIGINT)"""
+    try:
+        thread.join()
+    except KeyboardInterrupt:
+        logger.info("Получен сигнал остановки")
+
+async def submit_to_workers(bot_id, key, data):
+    """Передача обновления из polling в очередь процесса-обработчика"""
+    # Следующий getUpdates подтвердит обновление, поэтому ждём места, а не отбрасываем
+    while not worker_pool.submit(key, (bot_id, data)):
+        await asyncio.sleep(0.05)
+
+def run_sharded(sockets=None):
+    """Запуск HTTP-фронтенда и процессов-обработчиков"""
+    global worker_pool
+    # Фронтенд создаёт схемы до запуска обработчиков и сам отвечает на /orders
+    init_db()
+    # Метрики процессов-обработчиков фронтенд отдаёт на своём /metrics с меткой worker
+    worker_pool = WorkerPool(run_worker, WORKER_PROCESSES, queue_size=UPDATE_QUEUE_SIZE, registry=REGISTRY)
+    # Пока обработчики запускаются, обновления копятся в их очередях
+    thread = start_http_server(sockets)
+    try:
+        worker_pool.start()
+        if UPDATE_MODE == 'webhook':
+            webhook_results = asyncio.run(register_frontend_webhooks())
+        else:
+            webhook_results = dict.fromkeys(tenants, False)
+        for bot_id, tenant in tenants.items():
+            if use_polling(webhook_results[bot_id]):
+                # Фронтенд опрашивает getUpdates и раздаёт обновления процессам так же, как webhook
+                tenant.poller = create_poller(tenant, submit_to_workers)
+                tenant.poller.start_thread()
+            elif not webhook_results[bot_id]:
+                logger.error("Не удалось установить webhook бота %s, обновления не будут приходить", bot_id,
+                             extra={'stage': 'startup'})
+        if not worker_pool.wait_ready():
             logger.critical("Бот не может быть запущен")
+            return
+        wait_http_server(thread)
+    finally:
+        for tenant in tenants.values():
+            if tenant.poller is not None:
+                tenant.poller.stop_thread()
+        worker_pool.stop()
+        close_storage()
+
+def run_bot(sockets=None, started=None):
+    """Запуск ботов.
+
+    sockets — уже открытые слушающие сокеты, started — момент запуска процесса (см. serve.py).
+    """
+    global BOOT_STARTED
+    if started is not None:
+        BOOT_STARTED = started
+    if WORKER_PROCESSES > 1:
+        return run_sharded(sockets)
+
+    # Порт открывается до инициализации application: обновления копятся в очереди
+    start_update_queue()
+    thread = start_http_server(sockets)
+    try:
+        if not runtime.run(main()):
+            logger.error("Не удалось установить webhook, обновления не будут приходить")
+        wait_http_server(thread)
+    except Exception as e:
+        logger.critical("Бот не может быть запущен: %s", e, extra={'stage': 'startup'})
+    finally:
+        stop_runtime()
 
 
 if __name__ == "__main__":
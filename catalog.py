@@ -0,0 +1,105 @@
+"""Каталог текстов и типов техники: загружается один раз, клавиатуры и фильтры строятся при запуске"""
+import os
+import json
+from types import MappingProxyType
+
+from telegram import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.ext import filters
+
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog.json')
+
+# Кнопок выбора типа техники в одном ряду
+TECH_TYPES_PER_ROW = 2
+
+
+def load_catalog(path=CATALOG_PATH):
+    """Тексты и типы техники из файла каталога. Возвращает (texts, tech_types) по языкам.
+
+    {"shared": {"welcome": "..."},
+     "languages": {"ru": {"language_button": "Русский язык", "confirm_buttons": [...],
+                          "tech_types": [...]}, ...}}
+
+    Двуязычные тексты, одинаковые для всех языков, задаются один раз в
+    shared, в languages — только то, что у языков различается.
+    """
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+
+    shared = config.get('shared', {})
+    texts, tech_types = {}, {}
+    for language, overrides in config.get('languages', {}).items():
+        overrides = dict(overrides)
+        if not overrides.get('tech_types'):
+            raise ValueError(f"Не заданы tech_types языка {language}")
+        tech_types[language] = overrides.pop('tech_types')
+        texts[language] = {**shared, **overrides}
+
+    if not texts:
+        raise ValueError(f"В {path} не описано ни одного языка")
+    keys = {language: set(language_texts) for language, language_texts in texts.items()}
+    expected = set.union(*keys.values())
+    for language, language_keys in keys.items():
+        if language_keys != expected:
+            raise ValueError(f"Языку {language} не хватает текстов: {', '.join(sorted(expected - language_keys))}")
+    return texts, tech_types
+
+
+def reply_markup(rows):
+    return ReplyKeyboardMarkup([[KeyboardButton(button) for button in row] for row in rows], resize_keyboard=True)
+
+
+class Catalog:
+    """Клавиатуры и фильтры одного бота, собранные из его текстов при запуске.
+
+    Разметка Telegram неизменяема, поэтому одни и те же объекты отдаются во
+    все ответы: обработчики не строят клавиатуры и не режут список типов
+    техники, а число языков и типов техники не влияет на обработку
+    обновления. Фильтры кнопок подтверждения строятся из тех же текстов,
+    что и клавиатура, и не могут с ней разойтись.
+    """
+
+    def __init__(self, texts, tech_types):
+        self.texts = texts
+        self.tech_types = tech_types
+        self.languages = tuple(texts)
+        self._markups = {language: MappingProxyType(self._build(language)) for language in self.languages}
+
+        self.confirm_texts = frozenset(texts[language]['confirm_buttons'][0] for language in self.languages)
+        self.change_texts = frozenset(texts[language]['confirm_buttons'][1] for language in self.languages)
+        self.confirm_filter = filters.Text(self.confirm_texts)
+        self.change_filter = filters.Text(self.change_texts)
+
+        # Выбор языка в /start и он же с кнопкой «прежние данные» на языке прошлой заявки
+        languages = [[InlineKeyboardButton(texts[language]['language_button'], callback_data=f'lang_{language}')]
+                     for language in self.languages]
+        self.language_menu = InlineKeyboardMarkup(languages)
+        self._profile_menus = {
+            language: InlineKeyboardMarkup([[InlineKeyboardButton(texts[language]['use_profile'],
+                                                                  callback_data='profile_use')]] + languages)
+            for language in self.languages
+        }
+
+    def _build(self, language):
+        texts = self.texts[language]
+        tech_types = self.tech_types[language]
+        return {
+            'back': reply_markup([[texts['back']]]),
+            'skip': reply_markup([[texts['skip']]]),
+            'skip_back': reply_markup([[texts['skip']], [texts['back']]]),
+            'confirm': reply_markup([[button] for button in texts['confirm_buttons']]),
+            'start': reply_markup([["/start"]]),
+            'tech_types': reply_markup([tech_types[i:i + TECH_TYPES_PER_ROW]
+                                        for i in range(0, len(tech_types), TECH_TYPES_PER_ROW)]),
+            'contact': ReplyKeyboardMarkup([
+                [KeyboardButton(texts['share_phone'], request_contact=True)],
+                [KeyboardButton(texts['contact_back'])]
+            ], resize_keyboard=True),
+        }
+
+    def markup(self, language, name):
+        """Готовая клавиатура name на языке language"""
+        return self._markups[language][name]
+
+    def profile_menu(self, language):
+        """Выбор языка с кнопкой «прежние данные» на языке language"""
+        return self._profile_menus[language]
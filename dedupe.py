@@ -0,0 +1,92 @@
+"""Отсев повторно доставленных обновлений Telegram по update_id"""
+import asyncio
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def init_dedupe(c):
+    """Создание таблицы обработанных обновлений (вызывается из init_db)"""
+    c.execute("CREATE TABLE IF NOT EXISTS processed_updates (update_id INTEGER PRIMARY KEY)")
+
+
+class UpdateDeduplicator:
+    """Запоминает обработанные update_id.
+
+    Telegram повторяет webhook, если ответ был 5xx или не пришёл вовремя.
+    Последние capacity идентификаторов держатся в памяти и пакетно пишутся в
+    таблицу processed_updates фоновой задачей run(); более старые обновления
+    проверяются по базе. В базе хранятся только последние history
+    идентификаторов (update_id у бота растут монотонно).
+    """
+
+    def __init__(self, storage, capacity=10000, history=100000, flush_interval=1.0):
+        self.storage = storage
+        self.capacity = capacity
+        self.history = history
+        self.flush_interval = flush_interval
+        self._seen = OrderedDict()
+        self._pending = set()
+        # Идентификаторы меньше _floor могут быть только в базе
+        self._floor = None
+
+    @staticmethod
+    def _select_recent(conn, limit):
+        return conn.execute("SELECT update_id FROM processed_updates ORDER BY update_id DESC LIMIT ?",
+                            (limit,)).fetchall()
+
+    @staticmethod
+    def _select_one(conn, update_id):
+        return conn.execute("SELECT 1 FROM processed_updates WHERE update_id = ?", (update_id,)).fetchone()
+
+    @staticmethod
+    def _apply(conn, update_ids, history):
+        conn.executemany("INSERT OR IGNORE INTO processed_updates (update_id) VALUES (?)", update_ids)
+        conn.execute('''DELETE FROM processed_updates
+                        WHERE update_id < (SELECT MAX(update_id) FROM processed_updates) - ?''', (history,))
+
+    async def warm(self):
+        """Загружает последние обработанные идентификаторы после рестарта"""
+        rows = await self.storage.read(self._select_recent, self.capacity)
+        for (update_id,) in reversed(rows):
+            self._seen[update_id] = None
+        if len(rows) == self.capacity:
+            self._floor = rows[-1][0]
+
+    def _remember(self, update_id):
+        self._seen[update_id] = None
+        self._pending.add(update_id)
+        while len(self._seen) > self.capacity:
+            evicted, _ = self._seen.popitem(last=False)
+            self._floor = max(self._floor or 0, evicted + 1)
+
+    async def seen(self, update_id):
+        """True, если обновление уже обрабатывалось; иначе запоминает его"""
+        if update_id in self._seen or update_id in self._pending:
+            return True
+        if self._floor is not None and update_id < self._floor:
+            if await self.storage.read(self._select_one, update_id) is not None:
+                return True
+        self._remember(update_id)
+        return False
+
+    async def flush(self):
+        """Записывает новые идентификаторы одной транзакцией"""
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, set()
+        try:
+            await self.storage.write(self._apply, [(update_id,) for update_id in batch], self.history)
+        except Exception as e:
+            logger.error("Ошибка сохранения обработанных обновлений: %s", e, extra={'stage': 'dedupe'})
+            self._pending |= batch
+
+    async def run(self):
+        """Фоновая запись обработанных идентификаторов"""
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+        finally:
+            await self.flush()
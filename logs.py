@@ -0,0 +1,144 @@
+"""Логирование вне event loop: очередь, фоновый поток записи, JSON, маскирование и сэмплирование"""
+import re
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+
+from metrics import LOG_DROPPED
+
+# Поля, которые передаются через extra= и попадают в JSON отдельными ключами
+STRUCTURED_FIELDS = ('order_number', 'user_id', 'stage')
+
+# Телефоны в международном формате: «+», допускаются пробелы, дефисы и скобки.
+# Голые последовательности цифр не трогаем — это id пользователей, чатов и обновлений.
+# Телефон, введённый свободным текстом, передаётся в extra={'phone': ...} и
+# маскируется там, где встретился в сообщении (в JSON само поле не попадает)
+PHONE_RE = re.compile(r'\+\d[\d\s()-]{7,}\d')
+# Токен бота в адресах Bot API (httpx пишет их в INFO)
+TOKEN_RE = re.compile(r'bot\d+:[\w-]+')
+
+
+def _masked(phone):
+    """Оставляет от телефона код и две последние цифры"""
+    digits = re.sub(r'\D', '', phone)
+    return ('+' if phone.startswith('+') else '') + digits[:3] + '*' * (len(digits) - 5) + digits[-2:]
+
+
+def mask_phone(text, phone=None):
+    """Маскирует телефоны с «+» и известный телефон phone (как введён и одними цифрами)"""
+    if phone:
+        phone = str(phone).strip()
+        digits = re.sub(r'\D', '', phone)
+        # Короткие значения («Не указано», пара цифр) не телефон, их не ищем
+        if len(digits) >= 7:
+            for variant in {phone, digits}:
+                text = text.replace(variant, _masked(phone))
+    return PHONE_RE.sub(lambda match: _masked(match.group()), text)
+
+
+def mask_secrets(text, phone=None):
+    return TOKEN_RE.sub('bot<token>', mask_phone(text, phone))
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': mask_secrets(record.getMessage(), getattr(record, 'phone', None)),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = mask_secrets(self.formatException(record.exc_info), getattr(record, 'phone', None))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Обычный текстовый формат для локальной разработки, с теми же масками"""
+
+    def format(self, record):
+        return mask_secrets(super().format(record), getattr(record, 'phone', None))
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только долю INFO/DEBUG-записей указанных логгеров.
+
+    rates: {имя логгера: доля от 0 до 1}. Предупреждения и ошибки не отбрасываются.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or not self.rates:
+            return True
+        name = record.name
+        while name:
+            rate = self.rates.get(name)
+            if rate is not None:
+                return random.random() < rate
+            name = name.rpartition('.')[0]
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не блокирует вызывающий поток.
+
+    Сообщение не форматируется при постановке в очередь: это делает поток
+    записи. При переполненной очереди (медленный stdout) запись
+    отбрасывается и учитывается в метрике.
+    """
+
+    def prepare(self, record):
+        # Аргументы сообщения сохраняются как есть, getMessage() вызовет поток записи
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+
+def parse_sampling(spec):
+    """'httpx=0.05,telegram=0.5' -> {'httpx': 0.05, 'telegram': 0.5}"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, rate = item.partition('=')
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+def setup_logging(level=logging.INFO, fmt='json', sampling=None, queue_size=10000):
+    """Настраивает корневой логгер: запись в stdout идёт в отдельном потоке"""
+    handler = logging.StreamHandler(sys.stdout)
+    if fmt == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(TextFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    records = queue.Queue(queue_size)
+    queue_handler = DroppingQueueHandler(records)
+    queue_handler.addFilter(SamplingFilter(sampling or {}))
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    # Дописываем очередь при выходе
+    atexit.register(listener.stop)
+    return listener
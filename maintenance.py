@@ -0,0 +1,327 @@
+"""Обслуживание базы заявок: архивация старых заявок, incremental vacuum, ANALYZE и резервные копии"""
+import os
+import re
+import glob
+import time
+import asyncio
+import logging
+import sqlite3
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from order_queries import init_order_indexes
+from metrics import DB_MAINTENANCE_LATENCY, DB_ARCHIVED_ROWS, DB_FILE_BYTES
+
+logger = logging.getLogger(__name__)
+
+MONTH_PATTERN = re.compile(r'^\d{4}-\d{2}$')
+
+
+def archive_path(archive_dir, db_path, month):
+    """Файл архива базы db_path за месяц YYYY-MM"""
+    stem = os.path.splitext(os.path.basename(db_path))[0]
+    return os.path.join(archive_dir, f"{stem}-{month}.db")
+
+
+def archive_months(archive_dir, db_path):
+    """Месяцы, за которые есть архив базы db_path"""
+    prefix = archive_path(archive_dir, db_path, '')[:-len('.db')]
+    return sorted(path[len(prefix):-len('.db')] for path in glob.glob(glob.escape(prefix) + '*.db')
+                  if MONTH_PATTERN.match(path[len(prefix):-len('.db')]))
+
+
+def enable_incremental_vacuum(path, limit=None):
+    """Перестраивает базу, созданную без auto_vacuum, полным VACUUM. Возвращает True, если база готова.
+
+    VACUUM держит эксклюзивную блокировку всё время перестройки, поэтому
+    вызывается только при запуске, до storage.start(), и только для баз не
+    больше limit байт. Большую базу переводит оператор при остановленном боте:
+
+        python maintenance.py orders.db
+    """
+    if not os.path.exists(path):
+        # Новую базу Storage создаёт сразу с auto_vacuum=INCREMENTAL
+        return True
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return True
+        size = os.path.getsize(path)
+        if limit is not None and size > limit:
+            logger.warning("⚠️ База %s создана без auto_vacuum и занимает %s МБ: incremental vacuum отключён "
+                           "до перестройки командой python maintenance.py %s при остановленном боте",
+                           path, size >> 20, path, extra={'stage': 'maintenance'})
+            return False
+        started = time.monotonic()
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        DB_MAINTENANCE_LATENCY.observe(time.monotonic() - started, task='convert')
+        logger.info("🧹 База %s перестроена с auto_vacuum=INCREMENTAL за %.1f с", path, time.monotonic() - started,
+                    extra={'stage': 'maintenance'})
+        return True
+    finally:
+        conn.close()
+
+
+def read_archive(archive_dir, db_path, month, fn, *args):
+    """fn(conn, *args) над архивом за месяц (только чтение). ValueError, если архива нет.
+
+    Схема архива та же, что у горячей базы (orders с индексами и поиском,
+    make_outbox), поэтому к нему подходят те же запросы, а для выборок
+    вместе с горячей базой его можно подключить через ATTACH.
+    """
+    if not MONTH_PATTERN.match(month or ''):
+        raise ValueError("archive должен быть месяцем в формате YYYY-MM")
+    path = archive_path(archive_dir, db_path, month)
+    if not os.path.exists(path):
+        raise ValueError(f"Архива за {month} нет")
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return fn(conn, *args)
+    finally:
+        conn.close()
+
+
+class DatabaseMaintenance:
+    """Фоновое обслуживание горячей базы, не блокирующее поток записи.
+
+    Раз в interval секунд, если поток записи простаивает не меньше idle_after:
+    * заявки старше horizon (и их завершённые записи outbox) пачками по
+      batch_size копируются в помесячные архивные базы и удаляются из
+      горячей. Копия фиксируется в архиве до удаления, поэтому сбой между
+      шагами оставляет дубликат, который следующий проход перепишет;
+    * свободные страницы возвращаются PRAGMA incremental_vacuum кусками по
+      vacuum_pages, каждый кусок — отдельное короткое задание записи;
+    * раз в analyze_interval — ANALYZE с analysis_limit и PRAGMA optimize.
+    Независимо от нагрузки, раз в backup_interval база копируется через
+    backup API в backup_dir (хранятся последние backups копий).
+
+    Incremental vacuum работает только в базе с auto_vacuum=INCREMENTAL
+    (см. enable_incremental_vacuum).
+    """
+
+    def __init__(self, storage, archive_dir, horizon, backup_dir=None, interval=60.0, idle_after=5.0,
+                 batch_size=500, vacuum_pages=256, analyze_interval=24 * 60 * 60,
+                 backup_interval=6 * 60 * 60, backups=7):
+        self.storage = storage
+        self.archive_dir = archive_dir
+        self.horizon = horizon
+        self.backup_dir = backup_dir
+        self.interval = interval
+        self.idle_after = idle_after
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.analyze_interval = analyze_interval
+        self.backup_interval = backup_interval
+        self.backups = backups
+        self.name = os.path.splitext(os.path.basename(storage.path))[0]
+        self._analyzed_at = time.monotonic()
+
+    @property
+    def idle(self):
+        return self.storage.idle_for >= self.idle_after
+
+    # Задания для потока записи и пула чтения
+
+    @staticmethod
+    def _stats(conn):
+        page_size, pages, free, auto_vacuum = (conn.execute(f"PRAGMA {name}").fetchone()[0]
+                                               for name in ('page_size', 'page_count', 'freelist_count',
+                                                            'auto_vacuum'))
+        return page_size, pages, free, auto_vacuum
+
+    @staticmethod
+    def _schema(conn):
+        return dict(conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table' "
+                                 "AND name IN ('orders', 'make_outbox')").fetchall())
+
+    @staticmethod
+    def _select_archivable(conn, cutoff, limit):
+        """Старые заявки без недоставленных записей outbox и их записи outbox"""
+        cursor = conn.execute('''SELECT * FROM orders o
+                                 WHERE o.created_at < ?
+                                   AND NOT EXISTS (SELECT 1 FROM make_outbox m
+                                                   WHERE m.order_number = o.order_number AND m.status = 'pending')
+                                 ORDER BY o.id LIMIT ?''', (cutoff, limit))
+        columns = [column[0] for column in cursor.description]
+        orders = cursor.fetchall()
+        numbers = sorted({row[columns.index('order_number')] for row in orders})
+        cursor = conn.execute(f'''SELECT * FROM make_outbox
+                                  WHERE order_number IN ({", ".join("?" * len(numbers))})''', numbers)
+        outbox_columns = [column[0] for column in cursor.description]
+        return columns, orders, outbox_columns, cursor.fetchall()
+
+    @staticmethod
+    def _delete_archived(conn, order_ids, outbox_ids):
+        conn.executemany("DELETE FROM orders WHERE id = ?", [(row_id,) for row_id in order_ids])
+        conn.executemany("DELETE FROM make_outbox WHERE id = ?", [(row_id,) for row_id in outbox_ids])
+
+    @staticmethod
+    def _vacuum_slice(conn, pages):
+        # Python выполняет один шаг PRAGMA incremental_vacuum(N), а каждый шаг освобождает
+        # одну страницу, поэтому вызываем его постранично
+        for _ in range(pages):
+            conn.execute("PRAGMA incremental_vacuum(1)")
+        return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    @staticmethod
+    def _analyze(conn):
+        # analysis_limit ограничивает число строк, просматриваемых в каждом индексе
+        conn.execute("PRAGMA analysis_limit=1000")
+        conn.execute("ANALYZE")
+        conn.execute("PRAGMA optimize")
+
+    # Архивация
+
+    @staticmethod
+    def _write_archive(path, schema, tables):
+        """Копирует строки в архив за месяц одной транзакцией (выполняется в отдельном потоке)"""
+        conn = sqlite3.connect(path, isolation_level=None)
+        try:
+            for table, sql in schema.items():
+                conn.execute(sql.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1))
+                # Колонки, добавленные в горячую базу после создания архива
+                existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+                for column in tables[table][0]:
+                    if column not in existing:
+                        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+            init_order_indexes(conn)
+            conn.execute("BEGIN")
+            for table, (columns, rows) in tables.items():
+                if rows:
+                    conn.executemany(f'''INSERT OR IGNORE INTO {table} ({", ".join(columns)})
+                                         VALUES ({", ".join("?" * len(columns))})''', rows)
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    async def archive(self):
+        """Перенос заявок старше horizon в архивы. Возвращает число перенесённых заявок"""
+        cutoff = (datetime.now(timezone.utc) - timedelta(seconds=self.horizon)).strftime('%Y-%m-%d %H:%M:%S')
+        schema = await self.storage.read(self._schema)
+        moved = 0
+        while self.idle:
+            columns, orders, outbox_columns, outbox = await self.storage.read(self._select_archivable, cutoff,
+                                                                              self.batch_size)
+            if not orders:
+                break
+            with DB_MAINTENANCE_LATENCY.time(task='archive'):
+                # Заявка попадает в архив месяца своего created_at, записи outbox — вместе с ней
+                created_at, number = columns.index('created_at'), columns.index('order_number')
+                months = defaultdict(lambda: ([], []))
+                month_of = {}
+                for row in orders:
+                    month_of[row[number]] = row[created_at][:7]
+                    months[row[created_at][:7]][0].append(row)
+                outbox_number = outbox_columns.index('order_number')
+                for row in outbox:
+                    months[month_of[row[outbox_number]]][1].append(row)
+
+                os.makedirs(self.archive_dir, exist_ok=True)
+                for month, (order_rows, outbox_rows) in months.items():
+                    await asyncio.to_thread(self._write_archive,
+                                            archive_path(self.archive_dir, self.storage.path, month), schema,
+                                            {'orders': (columns, order_rows),
+                                             'make_outbox': (outbox_columns, outbox_rows)})
+                await self.storage.write(self._delete_archived, [row[0] for row in orders],
+                                         [row[0] for row in outbox])
+            DB_ARCHIVED_ROWS.inc(len(orders), table='orders')
+            DB_ARCHIVED_ROWS.inc(len(outbox), table='make_outbox')
+            moved += len(orders)
+        if moved:
+            logger.info("🗄 %s: в архив перенесено заявок: %s", self.name, moved, extra={'stage': 'maintenance'})
+        return moved
+
+    # Свободные страницы
+
+    async def vacuum(self):
+        """Возвращает свободные страницы кусками, пока поток записи простаивает"""
+        page_size, pages, free, auto_vacuum = await self.storage.read(self._stats)
+        if auto_vacuum != 2:
+            return 0
+        released = 0
+        while free >= self.vacuum_pages and self.idle:
+            with DB_MAINTENANCE_LATENCY.time(task='vacuum'):
+                left = await self.storage.write(self._vacuum_slice, self.vacuum_pages)
+            released += free - left
+            free = left
+        if released:
+            logger.info("🧹 %s: освобождено %s КБ", self.name, released * page_size >> 10,
+                        extra={'stage': 'maintenance'})
+        return released
+
+    # Статистика планировщика
+
+    async def analyze(self):
+        with DB_MAINTENANCE_LATENCY.time(task='analyze'):
+            await self.storage.write(self._analyze)
+        self._analyzed_at = time.monotonic()
+
+    # Резервные копии
+
+    def _backups(self):
+        return sorted(glob.glob(os.path.join(glob.escape(self.backup_dir), f"{glob.escape(self.name)}-*.db")))
+
+    def _backup_sync(self, path):
+        tmp = path + '.part'
+        source = sqlite3.connect(self.storage.path, timeout=self.storage.busy_timeout)
+        target = sqlite3.connect(tmp)
+        try:
+            # Вся база копируется за один шаг в одной транзакции чтения: в WAL она не мешает
+            # записи, а пошаговое копирование начиналось бы заново после каждого коммита бота
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+        os.replace(tmp, path)
+        for old in self._backups()[:-self.backups]:
+            os.remove(old)
+
+    async def backup(self):
+        """Резервная копия базы, если последняя старше backup_interval. Возвращает путь или None"""
+        existing = self._backups()
+        if existing and time.time() - os.path.getmtime(existing[-1]) < self.backup_interval:
+            return None
+        os.makedirs(self.backup_dir, exist_ok=True)
+        path = os.path.join(self.backup_dir, f"{self.name}-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.db")
+        with DB_MAINTENANCE_LATENCY.time(task='backup'):
+            await asyncio.to_thread(self._backup_sync, path)
+        logger.info("💾 %s: резервная копия %s", self.name, path, extra={'stage': 'maintenance'})
+        return path
+
+    async def _report(self):
+        page_size, pages, free, _ = await self.storage.read(self._stats)
+        wal = self.storage.path + '-wal'
+        DB_FILE_BYTES.set((pages - free) * page_size, db=self.name, kind='used')
+        DB_FILE_BYTES.set(free * page_size, db=self.name, kind='free')
+        DB_FILE_BYTES.set(os.path.getsize(wal) if os.path.exists(wal) else 0, db=self.name, kind='wal')
+
+    async def maintain(self):
+        """Один проход обслуживания"""
+        if self.backup_dir:
+            await self.backup()
+        if self.idle:
+            await self.archive()
+            await self.vacuum()
+            if time.monotonic() - self._analyzed_at >= self.analyze_interval and self.idle:
+                await self.analyze()
+        await self._report()
+
+    async def run(self):
+        """Периодическое обслуживание"""
+        while True:
+            try:
+                await self.maintain()
+            except Exception as e:
+                logger.error("Ошибка обслуживания базы %s: %s", self.name, e, extra={'stage': 'maintenance'})
+            await asyncio.sleep(self.interval)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Перевод базы на auto_vacuum=INCREMENTAL (бот должен быть остановлен)")
+    parser.add_argument('db_path')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    enable_incremental_vacuum(args.db_path)
@@ -0,0 +1,166 @@
+"""Надёжная доставка заявок в Make через таблицу outbox"""
+import json
+import time
+import random
+import asyncio
+import logging
+import sqlite3
+
+import httpx
+
+from metrics import MAKE_LATENCY, MAKE_RESULTS
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+SENT = 'sent'
+DEAD = 'dead'
+
+# Коды 4xx, при которых запрос всё же стоит повторить
+RETRYABLE_STATUSES = {408, 425, 429}
+
+
+def init_outbox(c):
+    """Создание таблицы outbox (вызывается из init_db)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS make_outbox
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  order_number TEXT,
+                  payload TEXT NOT NULL,
+                  status TEXT NOT NULL DEFAULT 'pending',
+                  attempts INTEGER NOT NULL DEFAULT 0,
+                  next_attempt_at REAL NOT NULL DEFAULT 0,
+                  last_error TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  sent_at TIMESTAMP)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_make_outbox_due
+                 ON make_outbox (status, next_attempt_at)''')
+
+
+def enqueue(c, order_number, payload):
+    """Добавляет запись в outbox в рамках текущей транзакции"""
+    c.execute('''INSERT INTO make_outbox (order_number, payload, status, next_attempt_at)
+                 VALUES (?, ?, ?, ?)''',
+              (order_number, json.dumps(payload, ensure_ascii=False), PENDING, time.time()))
+
+
+class MakeDispatcher:
+    """Фоновая доставка записей outbox в Make с повторами и dead-letter.
+
+    Если записи добавляют другие процессы (wake() до диспетчера не доходит),
+    poll_interval ограничивает время ожидания между проверками outbox.
+    client — общий httpx.AsyncClient нескольких диспетчеров (закрывает его владелец).
+    """
+
+    def __init__(self, storage, url, concurrency=4, max_attempts=8,
+                 base_delay=2.0, max_delay=600.0, timeout=10.0, poll_interval=None, tracer=None, client=None):
+        self.storage = storage
+        self.url = url
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.tracer = tracer
+        self._wakeup = asyncio.Event()
+        self._shared_client = client
+        self._client = None
+
+    def wake(self):
+        """Сообщает диспетчеру о новой записи (вызывать из event loop)"""
+        self._wakeup.set()
+
+    def _fetch_due(self, conn):
+        return conn.execute('''SELECT id, order_number, payload, attempts FROM make_outbox
+                               WHERE status = ? AND next_attempt_at <= ?
+                               ORDER BY next_attempt_at LIMIT ?''',
+                            (PENDING, time.time(), self.concurrency)).fetchall()
+
+    def _next_due_in(self, conn):
+        next_at = conn.execute("SELECT MIN(next_attempt_at) FROM make_outbox WHERE status = ?",
+                               (PENDING,)).fetchone()[0]
+        if next_at is None:
+            return None
+        return max(0.0, next_at - time.time())
+
+    @staticmethod
+    def _mark(conn, row_id, status, attempts, next_attempt_at=0, error=None):
+        conn.execute('''UPDATE make_outbox
+                        SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?,
+                            sent_at = CASE WHEN ? = 'sent' THEN CURRENT_TIMESTAMP ELSE sent_at END
+                        WHERE id = ?''',
+                     (status, attempts, next_attempt_at, error, status, row_id))
+
+    def _backoff(self, attempts):
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _deliver(self, row):
+        row_id, order_number, payload, attempts = row
+        attempts += 1
+        retryable = True
+        started = time.monotonic()
+        try:
+            with MAKE_LATENCY.time():
+                response = await self._client.post(self.url, content=payload,
+                                                   headers={'Content-Type': 'application/json'})
+            if response.status_code == 200:
+                MAKE_RESULTS.inc(outcome='sent')
+                await self.storage.write(self._mark, row_id, SENT, attempts)
+                if self.tracer is not None:
+                    self.tracer.add_span(order_number, 'make.deliver', started, time.monotonic() - started,
+                                         attempts=attempts)
+                logger.info("✅ Данные успешно отправлены в Make для заявки %s", order_number,
+                            extra={'order_number': order_number, 'stage': 'make'})
+                return
+            error = f"{response.status_code} - {response.text[:200]}"
+            retryable = response.status_code >= 500 or response.status_code in RETRYABLE_STATUSES
+        except httpx.HTTPError as e:
+            error = f"{type(e).__name__}: {e}"
+
+        # Make может вернуть тело запроса в ответе, телефон из заявки в логе маскируем
+        try:
+            phone = json.loads(payload).get('phone')
+        except (ValueError, AttributeError):
+            phone = None
+        if not retryable or attempts >= self.max_attempts:
+            MAKE_RESULTS.inc(outcome='dead')
+            await self.storage.write(self._mark, row_id, DEAD, attempts, 0, error)
+            logger.error("❌ Заявка %s перемещена в dead-letter после %s попыток: %s", order_number, attempts, error,
+                         extra={'order_number': order_number, 'stage': 'make', 'phone': phone})
+        else:
+            MAKE_RESULTS.inc(outcome='retry')
+            next_at = time.time() + self._backoff(attempts)
+            await self.storage.write(self._mark, row_id, PENDING, attempts, next_at, error)
+            logger.error("❌ Ошибка отправки в Make для заявки %s (попытка %s): %s", order_number, attempts, error,
+                         extra={'order_number': order_number, 'stage': 'make', 'phone': phone})
+
+    async def run(self):
+        """Основной цикл доставки"""
+        self._client = self._shared_client or httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.concurrency,
+                                max_keepalive_connections=self.concurrency)
+        )
+        try:
+            while True:
+                # Сбрасываем событие до выборки, чтобы не потерять wake() во время запроса
+                self._wakeup.clear()
+                try:
+                    rows = await self.storage.read(self._fetch_due)
+                    if rows:
+                        await asyncio.gather(*(self._deliver(row) for row in rows))
+                        continue
+                    delay = await self.storage.read(self._next_due_in)
+                except sqlite3.Error as e:
+                    logger.error("Ошибка базы данных в outbox: %s", e, extra={'stage': 'make'})
+                    delay = self.base_delay
+                if self.poll_interval is not None:
+                    delay = self.poll_interval if delay is None else min(delay, self.poll_interval)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if self._shared_client is None:
+                await self._client.aclose()
@@ -0,0 +1,411 @@
+"""Фоновая загрузка медиафайлов заявок, превью и ограничение места на диске"""
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+from previews import make_preview
+from metrics import (
+    MEDIA_DOWNLOAD_LATENCY,
+    MEDIA_DOWNLOAD_BYTES,
+    MEDIA_DOWNLOADS,
+    MEDIA_PREVIEW_LATENCY,
+    MEDIA_PREVIEWS,
+    MEDIA_DISK_BYTES,
+    MEDIA_EVICTED
+)
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+# Файл не скачивается (больше лимита Bot API или загрузка отключена): храним только file_id
+REMOTE = 'remote'
+# Оригинал удалён при очистке диска, остались превью и file_id
+EVICTED = 'evicted'
+
+# Превью хранятся рядом с оригиналами в подкаталоге
+PREVIEW_DIR = 'previews'
+
+# Bot API не отдаёт боту файлы больше 20MB
+MAX_DOWNLOAD_SIZE = 20 * 1024 * 1024
+
+EXTENSIONS = {'photo': 'jpg', 'video': 'mp4'}
+
+
+def init_media(c):
+    """Создание таблицы медиафайлов (вызывается из init_db)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS media
+                 (file_unique_id TEXT PRIMARY KEY,
+                  file_id TEXT NOT NULL,
+                  kind TEXT NOT NULL,
+                  filename TEXT NOT NULL,
+                  size INTEGER,
+                  status TEXT NOT NULL,
+                  error TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  completed_at TIMESTAMP)''')
+
+    # Колонки превью и очистки диска добавлены позже, старые базы мигрируем
+    columns = [row[1] for row in c.execute("PRAGMA table_info(media)")]
+    for column, definition in (('order_number', 'TEXT'), ('preview', 'TEXT'), ('preview_size', 'INTEGER'),
+                               ('processed_at', 'TIMESTAMP'), ('last_used_at', 'TIMESTAMP')):
+        if column not in columns:
+            c.execute(f"ALTER TABLE media ADD COLUMN {column} {definition}")
+    if 'last_used_at' not in columns:
+        c.execute("UPDATE media SET last_used_at = COALESCE(completed_at, created_at)")
+    if 'order_number' not in columns:
+        # Привязка файлов уже сохранённых заявок
+        for order_number, media_files in c.execute(
+                "SELECT order_number, media_files FROM orders WHERE media_files != ''").fetchall():
+            attach_order(c, order_number, media_files)
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_media_retention
+                 ON media (status, last_used_at)''')
+
+
+def attach_order(c, order_number, media_files):
+    """Привязывает файлы к сохранённой заявке (media_files — имена через запятую)"""
+    filenames = [name for name in (media_files or '').split(',') if name]
+    if filenames:
+        c.execute(f'''UPDATE media SET order_number = ?
+                      WHERE filename IN ({', '.join('?' * len(filenames))})''', (order_number, *filenames))
+
+
+def media_filename(file_unique_id, kind):
+    """Имя файла по file_unique_id: повторно присланный файл попадает в то же место"""
+    return f"{file_unique_id}.{EXTENSIONS.get(kind, 'bin')}"
+
+
+class MediaIngestor:
+    """Очередь загрузки медиафайлов с ограниченным числом одновременных загрузок.
+
+    submit() возвращается сразу, загрузку выполняют фоновые задачи.
+    Один и тот же file_unique_id скачивается не больше одного раза.
+
+    Для скачанного файла строится превью (уменьшенный JPEG фото или кадр
+    видео) в preview_pool — пуле процессов, чтобы декодирование изображений
+    не занимало event loop и GIL. Без пула превью не строятся.
+    """
+
+    def __init__(self, storage, media_dir, concurrency=4, queue_size=500, attempts=3, history=10000,
+                 download=True, preview_pool=None):
+        self.storage = storage
+        self.media_dir = media_dir
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.attempts = attempts
+        self.history = history
+        self.download = download
+        self.preview_pool = preview_pool
+        self.bot = None
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._futures = {}
+        self._statuses = OrderedDict()
+        self._preview_tasks = set()
+
+    @staticmethod
+    def _insert(conn, file_unique_id, file_id, kind, filename, size, status):
+        conn.execute('''INSERT INTO media (file_unique_id, file_id, kind, filename, size, status, last_used_at)
+                        VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                        ON CONFLICT(file_unique_id) DO UPDATE SET
+                            file_id = excluded.file_id,
+                            status = CASE WHEN status = 'done' THEN status ELSE excluded.status END,
+                            last_used_at = CURRENT_TIMESTAMP''',
+                     (file_unique_id, file_id, kind, filename, size, status))
+
+    @staticmethod
+    def _touch(conn, file_unique_id):
+        conn.execute("UPDATE media SET last_used_at = CURRENT_TIMESTAMP WHERE file_unique_id = ?",
+                     (file_unique_id,))
+
+    @staticmethod
+    def _processed(conn, file_unique_id, preview, preview_size):
+        conn.execute('''UPDATE media SET preview = ?, preview_size = ?, processed_at = CURRENT_TIMESTAMP
+                        WHERE file_unique_id = ?''',
+                     (preview, preview_size, file_unique_id))
+
+    @staticmethod
+    def _select_unprocessed(conn):
+        return conn.execute('''SELECT file_unique_id, filename, kind FROM media
+                               WHERE status = 'done' AND processed_at IS NULL''').fetchall()
+
+    @staticmethod
+    def _complete(conn, file_unique_id, status, size=None, error=None):
+        conn.execute('''UPDATE media SET status = ?, size = COALESCE(?, size), error = ?,
+                            completed_at = CURRENT_TIMESTAMP
+                        WHERE file_unique_id = ?''',
+                     (status, size, error, file_unique_id))
+
+    @staticmethod
+    def _select_pending(conn):
+        return conn.execute("SELECT file_unique_id, file_id, kind, size FROM media WHERE status = ?",
+                            (PENDING,)).fetchall()
+
+    def path(self, filename):
+        return os.path.join(self.media_dir, filename)
+
+    def preview_path(self, preview):
+        return os.path.join(self.media_dir, PREVIEW_DIR, preview)
+
+    def _log_write_error(self, future):
+        if future.exception() is not None:
+            logger.error("Ошибка записи статуса медиафайла: %s", future.exception(), extra={'stage': 'media'})
+
+    def _record(self, *args):
+        # Запись ставится в очередь сразу, поэтому порядок insert/update сохраняется
+        self.storage.submit_write(*args).add_done_callback(self._log_write_error)
+
+    def _finish(self, file_unique_id, status):
+        future = self._futures.pop(file_unique_id, None)
+        if future is not None and not future.done():
+            future.set_result(status)
+        self._statuses[file_unique_id] = status
+        self._statuses.move_to_end(file_unique_id)
+        while len(self._statuses) > self.history:
+            self._statuses.popitem(last=False)
+
+    def submit(self, file_id, file_unique_id, kind, size=None):
+        """Ставит файл в очередь загрузки и возвращает имя файла"""
+        filename = media_filename(file_unique_id, kind)
+        if file_unique_id in self._futures:
+            return filename
+        status = self._statuses.get(file_unique_id)
+        # Оригинал мог быть удалён очисткой диска — тогда файл скачивается заново
+        if status == REMOTE or (status == DONE and os.path.exists(self.path(filename))):
+            self._record(self._touch, file_unique_id)
+            return filename
+
+        if os.path.exists(self.path(filename)):
+            status = DONE
+        elif not self.download or (size is not None and size > MAX_DOWNLOAD_SIZE):
+            status = REMOTE
+        else:
+            status = PENDING
+            try:
+                self._queue.put_nowait((file_id, file_unique_id, filename, kind))
+            except asyncio.QueueFull:
+                logger.error("Очередь загрузки медиа переполнена, файл %s не будет скачан", file_unique_id,
+                             extra={'stage': 'media'})
+                status = FAILED
+
+        self._record(self._insert, file_unique_id, file_id, kind, filename, size, status)
+        if status == PENDING:
+            self._futures[file_unique_id] = asyncio.get_running_loop().create_future()
+        else:
+            self._finish(file_unique_id, status)
+        return filename
+
+    async def _download(self, file_id, file_unique_id, filename):
+        final_path = self.path(filename)
+        tmp_path = final_path + '.part'
+        for attempt in range(1, self.attempts + 1):
+            try:
+                file = await self.bot.get_file(file_id)
+                await file.download_to_drive(tmp_path)
+                os.replace(tmp_path, final_path)
+                return DONE, os.path.getsize(final_path), None
+            except Exception as e:
+                logger.error("Ошибка загрузки файла %s (попытка %s): %s", filename, attempt, e,
+                             extra={'stage': 'media'})
+                error = str(e)
+                if attempt < self.attempts:
+                    await asyncio.sleep(2 ** attempt)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return FAILED, None, error
+
+    async def _worker(self):
+        while True:
+            file_id, file_unique_id, filename, kind = await self._queue.get()
+            started = time.monotonic()
+            status = FAILED
+            try:
+                status, size, error = await self._download(file_id, file_unique_id, filename)
+                if status == DONE:
+                    MEDIA_DOWNLOAD_LATENCY.observe(time.monotonic() - started)
+                    MEDIA_DOWNLOAD_BYTES.inc(size)
+                    logger.info("Файл %s сохранён за %.2f с", filename, time.monotonic() - started,
+                                extra={'stage': 'media'})
+                self._record(self._complete, file_unique_id, status, size, error)
+                if status == DONE:
+                    self._schedule_preview(file_unique_id, filename, kind)
+            except Exception as e:
+                logger.error("Ошибка обработки файла %s: %s", filename, e, extra={'stage': 'media'})
+            finally:
+                MEDIA_DOWNLOADS.inc(status=status)
+                self._finish(file_unique_id, status)
+                self._queue.task_done()
+
+    def _schedule_preview(self, file_unique_id, filename, kind):
+        if self.preview_pool is None:
+            return
+        task = asyncio.create_task(self._preview(file_unique_id, filename, kind))
+        self._preview_tasks.add(task)
+        task.add_done_callback(self._preview_tasks.discard)
+
+    async def _preview(self, file_unique_id, filename, kind):
+        preview = media_filename(file_unique_id, 'photo')
+        started = time.monotonic()
+        try:
+            size = await asyncio.get_running_loop().run_in_executor(
+                self.preview_pool, make_preview, self.path(filename), self.preview_path(preview), kind)
+        except Exception as e:
+            # Превью необязательно: отмечаем файл обработанным, чтобы не повторять при каждом запуске
+            MEDIA_PREVIEWS.inc(status=FAILED)
+            logger.warning("Превью для %s не построено: %s", filename, e, extra={'stage': 'media'})
+            self._record(self._processed, file_unique_id, None, None)
+            return
+        MEDIA_PREVIEWS.inc(status=DONE)
+        MEDIA_PREVIEW_LATENCY.observe(time.monotonic() - started)
+        self._record(self._processed, file_unique_id, preview, size)
+
+    def status(self, file_unique_id):
+        """Текущий статус загрузки файла"""
+        if file_unique_id in self._futures:
+            return PENDING
+        return self._statuses.get(file_unique_id, FAILED)
+
+    async def wait(self, file_unique_ids, timeout):
+        """Ждёт завершения загрузок не дольше timeout секунд. Возвращает {file_unique_id: статус}"""
+        pending = [self._futures[uid] for uid in file_unique_ids if uid in self._futures]
+        if pending:
+            await asyncio.wait(pending, timeout=timeout)
+        return {uid: self.status(uid) for uid in file_unique_ids}
+
+    async def run(self, bot, resume=True):
+        """Запуск фоновых загрузок и возобновление прерванных рестартом"""
+        self.bot = bot
+        os.makedirs(os.path.join(self.media_dir, PREVIEW_DIR), exist_ok=True)
+        if resume:
+            for file_unique_id, file_id, kind, size in await self.storage.read(self._select_pending):
+                self.submit(file_id, file_unique_id, kind, size)
+            for file_unique_id, filename, kind in await self.storage.read(self._select_unprocessed):
+                if os.path.exists(self.path(filename)):
+                    self._schedule_preview(file_unique_id, filename, kind)
+        workers = [asyncio.create_task(self._worker(), name=f"media-worker-{i}")
+                   for i in range(self.concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers + list(self._preview_tasks):
+                task.cancel()
+
+
+class MediaRetention:
+    """Ограничение места, которое занимают медиафайлы.
+
+    Раз в interval секунд:
+    * удаляются оригиналы файлов сохранённых заявок старше max_age
+      (администратор получил их по file_id, превью остаются);
+    * удаляются оригиналы и превью файлов, не попавших ни в одну заявку,
+      если диалог брошен дольше abandon_after;
+    * если оригиналы и превью вместе занимают больше quota, удаляются
+      оригиналы файлов сохранённых заявок, которые дольше всего не
+      использовались (LRU по last_used_at), пока занятое место не опустится
+      до low_water * quota.
+    Файлы незавершённых диалогов по квоте не удаляются.
+    """
+
+    def __init__(self, storage, media_dir, quota, max_age, abandon_after, interval=600.0,
+                 low_water=0.9, batch_size=200):
+        self.storage = storage
+        self.media_dir = media_dir
+        self.quota = quota
+        self.max_age = max_age
+        self.abandon_after = abandon_after
+        self.interval = interval
+        self.low_water = low_water
+        self.batch_size = batch_size
+
+    @staticmethod
+    def _usage(conn):
+        return conn.execute('''SELECT COALESCE(SUM(CASE WHEN status = 'done' THEN size END), 0),
+                                       COALESCE(SUM(preview_size), 0)
+                                FROM media''').fetchone()
+
+    @staticmethod
+    def _select_expired(conn, max_age, limit):
+        return conn.execute('''SELECT file_unique_id, filename, size FROM media
+                               WHERE status = 'done' AND order_number IS NOT NULL
+                                 AND last_used_at < datetime('now', ?)
+                               ORDER BY last_used_at LIMIT ?''', (f"-{int(max_age)} seconds", limit)).fetchall()
+
+    @staticmethod
+    def _select_lru(conn, limit):
+        return conn.execute('''SELECT file_unique_id, filename, size FROM media
+                               WHERE status = 'done' AND order_number IS NOT NULL
+                               ORDER BY last_used_at LIMIT ?''', (limit,)).fetchall()
+
+    @staticmethod
+    def _select_abandoned(conn, abandon_after, limit):
+        return conn.execute('''SELECT file_unique_id, filename, size, preview FROM media
+                               WHERE status IN ('done', 'evicted') AND order_number IS NULL
+                                 AND (status = 'done' OR preview IS NOT NULL)
+                                 AND last_used_at < datetime('now', ?)
+                               LIMIT ?''', (f"-{int(abandon_after)} seconds", limit)).fetchall()
+
+    @staticmethod
+    def _mark_evicted(conn, file_unique_ids, drop_preview):
+        conn.executemany(f'''UPDATE media SET status = 'evicted'
+                               {", preview = NULL, preview_size = NULL" if drop_preview else ""}
+                           WHERE file_unique_id = ?''', [(uid,) for uid in file_unique_ids])
+
+    @staticmethod
+    def _remove(paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    async def _evict(self, rows, reason, drop_preview=False):
+        paths = [os.path.join(self.media_dir, row[1]) for row in rows]
+        if drop_preview:
+            paths += [os.path.join(self.media_dir, PREVIEW_DIR, row[3]) for row in rows if row[3]]
+        await asyncio.to_thread(self._remove, paths)
+        await self.storage.write(self._mark_evicted, [row[0] for row in rows], drop_preview)
+        MEDIA_EVICTED.inc(len(rows), reason=reason)
+        return sum(row[2] or 0 for row in rows)
+
+    async def enforce(self):
+        """Один проход очистки. Возвращает число освобождённых байт"""
+        freed = 0
+        while rows := await self.storage.read(self._select_expired, self.max_age, self.batch_size):
+            freed += await self._evict(rows, 'age')
+        while rows := await self.storage.read(self._select_abandoned, self.abandon_after, self.batch_size):
+            freed += await self._evict(rows, 'abandoned', drop_preview=True)
+
+        originals, previews = await self.storage.read(self._usage)
+        if originals + previews > self.quota:
+            target = self.quota * self.low_water
+            while originals + previews > target:
+                rows = await self.storage.read(self._select_lru, self.batch_size)
+                if not rows:
+                    logger.warning("Медиафайлы занимают %s МБ при квоте %s МБ, но все они относятся к незавершённым "
+                                   "диалогам", (originals + previews) >> 20, self.quota >> 20,
+                                   extra={'stage': 'media_retention'})
+                    break
+                # Удаляем ровно столько самых давних файлов, сколько нужно до target
+                excess, count = originals + previews - target, 0
+                while count < len(rows) and excess > 0:
+                    excess -= rows[count][2] or 0
+                    count += 1
+                released = await self._evict(rows[:count], 'quota')
+                originals -= released
+                freed += released
+        MEDIA_DISK_BYTES.set(originals, kind='original')
+        MEDIA_DISK_BYTES.set(previews, kind='preview')
+        if freed:
+            logger.info("🧹 Очистка медиа: освобождено %s МБ", freed >> 20, extra={'stage': 'media_retention'})
+        return freed
+
+    async def run(self):
+        """Периодическая очистка"""
+        while True:
+            try:
+                await self.enforce()
+            except Exception as e:
+                logger.error("Ошибка очистки медиафайлов: %s", e, extra={'stage': 'media_retention'})
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,250 @@
+"""Метрики в формате Prometheus для /metrics"""
+import time
+import threading
+from functools import wraps
+
+from tracing import span as trace_span
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _with_label(line, name, value):
+    """Добавляет метку в строку сэмпла: 'm{a="1"} 2' -> 'm{name="value",a="1"} 2'"""
+    metric, _, rest = line.partition(' ')
+    if metric.endswith('}'):
+        head, _, labels = metric.partition('{')
+        return f'{head}{{{name}="{value}",{labels} {rest}'
+    return f'{metric}{{{name}="{value}"}} {rest}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """Набор метрик, отдаваемых на /metrics.
+
+    В многопроцессном режиме процессы-обработчики присылают снимки своих
+    метрик (snapshot), фронтенд запоминает последний снимок каждого (merge)
+    и отдаёт их вместе со своими с меткой worker.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._remote = {}
+        self._remote_lock = threading.Lock()
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        """Строки сэмплов всех метрик {имя: [строки]} для передачи в другой процесс"""
+        return {metric.name: metric.samples() for metric in self._metrics}
+
+    def merge(self, source, snapshot):
+        """Запоминает снимок метрик процесса source (заменяет предыдущий)"""
+        with self._remote_lock:
+            self._remote[str(source)] = snapshot
+
+    def render(self):
+        with self._remote_lock:
+            remote = list(self._remote.items())
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+            for source, snapshot in remote:
+                lines.extend(_with_label(line, 'worker', source) for line in snapshot.get(metric.name, ()))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in values]
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), registry=REGISTRY):
+        super().__init__(name, documentation, labels, registry)
+        self._function = None
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function):
+        """Значение вычисляется при каждом запросе /metrics"""
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            return [f"{self.name} {_format_value(self._function())}"]
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in values]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, documentation, labels, registry)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        """Контекстный менеджер, замеряющий длительность блока"""
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(state[0]), state[1], state[2]) for key, state in self._values.items()]
+        lines = []
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = (("le", _format_value(bound)),)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+# Обработчики диалога
+HANDLER_LATENCY = Histogram('bot_handler_duration_seconds', "Длительность обработчиков диалога", ['handler'])
+HANDLER_ERRORS = Counter('bot_handler_errors_total', "Исключения в обработчиках диалога", ['handler'])
+
+# Webhook
+WEBHOOK_ACK_LATENCY = Histogram('bot_webhook_ack_seconds', "Время от получения webhook до ответа Telegram",
+                                buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+WEBHOOK_RESPONSES = Counter('bot_webhook_responses_total', "Ответы на webhook по HTTP-коду", ['status'])
+UPDATE_QUEUE_DEPTH = Gauge('bot_update_queue_depth', "Обновлений в очереди на обработку")
+ADMISSION_DECISIONS = Counter('bot_admission_decisions_total', "Решения admission control по входящим обновлениям",
+                              ['priority', 'outcome', 'reason'])
+
+# Long polling
+POLL_BATCH_SIZE = Histogram('bot_poll_batch_size', "Обновлений в одном ответе getUpdates",
+                            buckets=(0, 1, 2, 5, 10, 25, 50, 100))
+POLL_ERRORS = Counter('bot_poll_errors_total', "Ошибки запросов getUpdates")
+
+# SQLite
+SQLITE_LATENCY = Histogram('bot_sqlite_seconds', "Длительность запросов к SQLite (включая ожидание очереди)",
+                           ['op', 'query'])
+SQLITE_BATCH_SIZE = Histogram('bot_sqlite_commit_batch_size', "Заданий записи в одном групповом коммите",
+                              buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+DB_MAINTENANCE_LATENCY = Histogram('bot_db_maintenance_seconds', "Длительность задач обслуживания базы",
+                                   ['task'], buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300))
+DB_ARCHIVED_ROWS = Counter('bot_db_archived_rows_total', "Строк, перенесённых в помесячные архивные базы", ['table'])
+DB_FILE_BYTES = Gauge('bot_db_file_bytes', "Размер базы: занятые и свободные страницы, WAL", ['db', 'kind'])
+
+# Make
+MAKE_LATENCY = Histogram('bot_make_request_seconds', "Длительность запросов к Make")
+MAKE_RESULTS = Counter('bot_make_requests_total', "Результаты доставки в Make", ['outcome'])
+
+# Медиафайлы
+MEDIA_DOWNLOAD_LATENCY = Histogram('bot_media_download_seconds', "Длительность загрузки медиафайлов",
+                                   buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+MEDIA_DOWNLOAD_BYTES = Counter('bot_media_download_bytes_total', "Скачано байт медиафайлов")
+MEDIA_DOWNLOADS = Counter('bot_media_downloads_total', "Загрузки медиафайлов по статусу", ['status'])
+MEDIA_PREVIEW_LATENCY = Histogram('bot_media_preview_seconds', "Построение превью медиафайла (включая ожидание пула)",
+                                  buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+MEDIA_PREVIEWS = Counter('bot_media_previews_total', "Превью медиафайлов по статусу", ['status'])
+MEDIA_DISK_BYTES = Gauge('bot_media_disk_bytes', "Место, занятое медиафайлами", ['kind'])
+MEDIA_EVICTED = Counter('bot_media_evicted_total', "Удалённые при очистке оригиналы медиафайлов", ['reason'])
+
+# Bot API
+BOT_API_LATENCY = Histogram('bot_api_request_seconds', "Длительность запросов к Bot API", ['endpoint'])
+BOT_API_WAIT = Histogram('bot_api_ratelimit_wait_seconds', "Ожидание в ограничителе запросов", ['priority'])
+BOT_API_429 = Counter('bot_api_429_total', "Ответы 429 от Bot API", ['endpoint'])
+
+# Запуск
+STARTUP_DURATION = Gauge('bot_startup_seconds', "Время от запуска процесса до этапа запуска", ['stage'])
+TIME_TO_FIRST_UPDATE = Gauge('bot_time_to_first_update_seconds',
+                             "Время от запуска процесса до обработки первого обновления")
+
+# Логи
+LOG_DROPPED = Counter('bot_log_records_dropped_total', "Записей лога, отброшенных при переполненной очереди")
+
+# Сессии
+ACTIVE_SESSIONS = Gauge('bot_active_sessions', "Активных диалогов в памяти")
+
+
+def timed_handler(func):
+    """Замеряет длительность обработчика диалога, считает исключения и пишет этап в трассу заявки"""
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            with trace_span(f"handler.{func.__name__}"):
+                return await func(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=func.__name__)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, handler=func.__name__)
+    return wrapper
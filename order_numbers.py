@@ -0,0 +1,36 @@
+"""Атомарная выдача номеров заявок"""
+from datetime import datetime
+
+# Сброс счётчика в начале дня и инкремент выполняются одним оператором,
+# поэтому несколько процессов не могут получить одинаковый номер
+NEXT_NUMBER_SQL = '''
+    INSERT INTO counters (id, last_order_number, last_reset_date) VALUES (1, 1, ?)
+    ON CONFLICT(id) DO UPDATE SET
+        last_order_number = CASE
+            WHEN last_reset_date = excluded.last_reset_date THEN last_order_number + 1
+            ELSE 1
+        END,
+        last_reset_date = excluded.last_reset_date
+    RETURNING last_order_number
+'''
+
+
+def init_counters(c, now: datetime):
+    """Создание таблицы счётчика (вызывается из init_db)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS counters
+                 (id INTEGER PRIMARY KEY,
+                  last_order_number INTEGER,
+                  last_reset_date TEXT)''')
+    c.execute("INSERT OR IGNORE INTO counters (id, last_order_number, last_reset_date) VALUES (1, 0, ?)",
+              (now.strftime('%Y-%m-%d'),))
+
+
+def format_order_number(day, number):
+    """Номер заявки в формате DDMMYYYY-NNNN"""
+    return f"{day.strftime('%d%m%Y')}-{number:04d}"
+
+
+def next_order_number(conn, now: datetime):
+    """Выдаёт следующий номер заявки за день now в рамках текущей транзакции"""
+    number = conn.execute(NEXT_NUMBER_SQL, (now.strftime('%Y-%m-%d'),)).fetchone()[0]
+    return format_order_number(now, number)
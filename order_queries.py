@@ -0,0 +1,145 @@
+"""Выборка заявок: вторичные индексы, keyset-пагинация и полнотекстовый поиск по проблеме"""
+import json
+import base64
+import logging
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+MAX_LIMIT = 100
+DEFAULT_LIMIT = 20
+
+# Фильтры по равенству: параметр запроса -> колонка
+EQUALITY_FILTERS = {
+    'user_id': 'o.user_id',
+    'phone': 'o.phone',
+    'order_number': 'o.order_number',
+    'tech_type': 'o.tech_type',
+    'language': 'o.language',
+}
+
+COLUMNS = ('id', 'order_number', 'user_id', 'username', 'name', 'phone', 'tech_type', 'problem',
+           'media_files', 'language', 'created_at')
+
+
+def init_order_indexes(c):
+    """Индексы и полнотекстовый поиск по заявкам (вызывается из init_db)"""
+    # Все выборки отсортированы по (created_at, id), поэтому он замыкает составные индексы
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_user ON orders (user_id, created_at, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_tech_type ON orders (tech_type, created_at, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_language ON orders (language, created_at, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_phone ON orders (phone)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_order_number ON orders (order_number)")
+
+    exists = c.execute("SELECT 1 FROM sqlite_master WHERE name = 'orders_fts'").fetchone()
+    try:
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS orders_fts
+                     USING fts5(problem, content='orders', content_rowid='id', tokenize='unicode61')''')
+    except sqlite3.OperationalError as e:
+        logger.warning("⚠️ FTS5 недоступен, поиск по описанию проблемы отключён: %s", e, extra={'stage': 'db'})
+        return
+    c.execute('''CREATE TRIGGER IF NOT EXISTS orders_fts_insert AFTER INSERT ON orders BEGIN
+                     INSERT INTO orders_fts (rowid, problem) VALUES (new.id, new.problem);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS orders_fts_delete AFTER DELETE ON orders BEGIN
+                     INSERT INTO orders_fts (orders_fts, rowid, problem) VALUES ('delete', old.id, old.problem);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS orders_fts_update AFTER UPDATE OF problem ON orders BEGIN
+                     INSERT INTO orders_fts (orders_fts, rowid, problem) VALUES ('delete', old.id, old.problem);
+                     INSERT INTO orders_fts (rowid, problem) VALUES (new.id, new.problem);
+                 END''')
+    if not exists:
+        # Индексируем заявки, сохранённые до появления поиска
+        c.execute("INSERT INTO orders_fts (orders_fts) VALUES ('rebuild')")
+
+
+def encode_cursor(created_at, row_id):
+    return base64.urlsafe_b64encode(json.dumps([created_at, row_id]).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return str(created_at), int(row_id)
+    except (ValueError, TypeError):
+        raise ValueError("Некорректный cursor")
+
+
+def fts_query(text):
+    """Поисковая строка пользователя -> запрос FTS5 (слова по префиксу, без операторов)"""
+    terms = ['"' + term.replace('"', '""') + '"*' for term in text.split()]
+    if not terms:
+        raise ValueError("Пустой поисковый запрос")
+    return " ".join(terms)
+
+
+def parse_filters(args):
+    """Параметры запроса /orders -> (фильтры, cursor, limit). ValueError при ошибке"""
+    filters = {}
+    for name in EQUALITY_FILTERS:
+        value = args.get(name)
+        if value:
+            filters[name] = int(value) if name == 'user_id' else value
+    for name in ('date_from', 'date_to', 'q'):
+        if args.get(name):
+            filters[name] = args[name]
+    cursor = args.get('cursor') or None
+    limit = int(args.get('limit') or DEFAULT_LIMIT)
+    if not 1 <= limit <= MAX_LIMIT:
+        raise ValueError(f"limit должен быть от 1 до {MAX_LIMIT}")
+    return filters, cursor, limit
+
+
+def query_orders(conn, filters, cursor=None, limit=DEFAULT_LIMIT):
+    """Заявки от новых к старым. Возвращает (список словарей, cursor следующей страницы или None).
+
+    cursor — значение next_cursor предыдущей страницы.
+
+    Фильтры: user_id, phone, order_number, tech_type, language — по равенству,
+    date_from/date_to — по created_at (UTC, date_to не включается),
+    q — полнотекстовый поиск по описанию проблемы.
+    """
+    where, params = [], []
+    source = "orders o"
+    order = "o.created_at DESC, o.id DESC"
+    if 'q' in filters:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'orders_fts'").fetchone() is None:
+            raise ValueError("Полнотекстовый поиск недоступен")
+        # id и created_at растут вместе, а по rowid FTS5 отдаёт совпадения уже отсортированными,
+        # поэтому частые слова не требуют сортировки всех найденных заявок
+        source = "orders_fts JOIN orders o ON o.id = orders_fts.rowid"
+        order = "orders_fts.rowid DESC"
+        where.append("orders_fts MATCH ?")
+        params.append(fts_query(filters['q']))
+    for name, column in EQUALITY_FILTERS.items():
+        if name in filters:
+            where.append(f"{column} = ?")
+            params.append(filters[name])
+    if 'date_from' in filters:
+        where.append("o.created_at >= ?")
+        params.append(filters['date_from'])
+    if 'date_to' in filters:
+        where.append("o.created_at < ?")
+        params.append(filters['date_to'])
+    if cursor is not None:
+        # Keyset-пагинация: продолжаем строго после последней выданной строки
+        created_at, row_id = decode_cursor(cursor)
+        if 'q' in filters:
+            where.append("orders_fts.rowid < ?")
+            params.append(row_id)
+        else:
+            where.append("(o.created_at, o.id) < (?, ?)")
+            params.extend((created_at, row_id))
+
+    sql = (f"SELECT {', '.join('o.' + column for column in COLUMNS)} FROM {source}"
+           + (" WHERE " + " AND ".join(where) if where else "")
+           + f" ORDER BY {order} LIMIT ?")
+    rows = conn.execute(sql, (*params, limit + 1)).fetchall()
+
+    orders = [dict(zip(COLUMNS, row)) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = orders[-1]
+        next_cursor = encode_cursor(last['created_at'], last['id'])
+    return orders, next_cursor
@@ -0,0 +1,178 @@
+"""Получение обновлений через getUpdates (long polling)"""
+import asyncio
+import logging
+import threading
+
+import httpx
+
+from metrics import POLL_BATCH_SIZE, POLL_ERRORS
+
+logger = logging.getLogger(__name__)
+
+
+class UpdatePoller:
+    """Long polling Bot API с передачей сырых обновлений в очередь обработки.
+
+    Обновления не обрабатываются здесь: submit(key, data) кладёт их в ту же
+    очередь, что и webhook (UpdateRuntime или очереди процессов-обработчиков),
+    поэтому разные пользователи обрабатываются параллельно, а обновления
+    одного пользователя — по порядку. Следующий getUpdates отправляется только
+    после того, как вся пачка принята в очередь: offset подтверждает Telegram
+    только уже принятые обновления, а переполненная очередь притормаживает
+    опрос. Последняя неподтверждённая пачка после перезапуска приходит снова
+    и отсеивается UpdateDeduplicator.
+
+    admit(data) -> (принять ли, параметры sendMessage для ответа или None) —
+    admission control до постановки в очередь. client — общий httpx.AsyncClient
+    нескольких ботов одного event loop (закрывает его владелец).
+    """
+
+    def __init__(self, api_url, token, submit, key, timeout=30, limit=100, allowed_updates=None,
+                 admit=None, max_delay=30.0, client=None):
+        self.url = f"{api_url}/bot{token}"
+        self.submit = submit
+        self.key = key
+        self.timeout = timeout
+        self.limit = limit
+        self.allowed_updates = allowed_updates
+        self.admit = admit
+        self.max_delay = max_delay
+        self.offset = None
+        self._shared_client = client
+        self._client = None
+        self._thread = None
+        self._loop = None
+        self._task = None
+
+    async def call(self, method, **params):
+        response = await self._client.post(f"{self.url}/{method}", json=params)
+        data = response.json()
+        if not data.get('ok'):
+            retry_after = (data.get('parameters') or {}).get('retry_after')
+            raise PollError(response.status_code, data.get('description'), retry_after)
+        return data['result']
+
+    async def delete_webhook(self):
+        """Снимает webhook: пока он установлен, getUpdates отвечает 409"""
+        await self.call('deleteWebhook', drop_pending_updates=False)
+        logger.info("Webhook снят, обновления получаем через getUpdates", extra={'stage': 'polling'})
+
+    async def _fetch(self):
+        params = {'timeout': self.timeout, 'limit': self.limit}
+        if self.offset is not None:
+            params['offset'] = self.offset
+        if self.allowed_updates is not None:
+            params['allowed_updates'] = self.allowed_updates
+        return await self.call('getUpdates', **params)
+
+    async def run(self):
+        """Цикл опроса до отмены задачи"""
+        self._client = self._shared_client or httpx.AsyncClient(timeout=httpx.Timeout(10.0, read=self.timeout + 10.0))
+        delay = 1.0
+        webhook_deleted = False
+        logger.info("📥 Long polling: timeout %s с, limit %s", self.timeout, self.limit, extra={'stage': 'polling'})
+        try:
+            while True:
+                try:
+                    if not webhook_deleted:
+                        await self.delete_webhook()
+                        webhook_deleted = True
+                    updates = await self._fetch()
+                    POLL_BATCH_SIZE.observe(len(updates))
+                except Exception as e:
+                    # Любая ошибка запроса или ответа — повтор с задержкой, а не остановка опроса
+                    POLL_ERRORS.inc()
+                    wait = delay
+                    if isinstance(e, PollError):
+                        if e.retry_after:
+                            wait = e.retry_after
+                        if e.status == 409:
+                            # Webhook установлен заново (например, предыдущей версией при деплое)
+                            webhook_deleted = False
+                    logger.error("Ошибка getUpdates: %s, повтор через %.0f с", e, wait, extra={'stage': 'polling'})
+                    await asyncio.sleep(wait)
+                    delay = min(delay * 2, self.max_delay)
+                    continue
+                delay = 1.0
+                for data in updates:
+                    update_id = data.get('update_id') if isinstance(data, dict) else None
+                    try:
+                        await self._accept(data)
+                    except Exception as e:
+                        # Одно непонятное обновление не должно останавливать опрос: пропускаем его
+                        logger.error("Ошибка приёма обновления %s: %s", update_id, e, extra={'stage': 'polling'})
+                    if isinstance(update_id, int):
+                        self.offset = update_id + 1
+        finally:
+            if self._shared_client is None:
+                await self._client.aclose()
+
+    async def _accept(self, data):
+        if self.admit is not None:
+            accepted, notice = self.admit(data)
+            if notice is not None:
+                try:
+                    await self.call('sendMessage', **notice)
+                except (httpx.HTTPError, ValueError, PollError) as e:
+                    logger.error("Ошибка отправки предупреждения о лимите в чат %s: %s", notice['chat_id'], e,
+                                 extra={'stage': 'admission'})
+            if not accepted:
+                return
+        await self.submit(self.key(data), data)
+
+    def start(self):
+        """Запуск опроса в текущем event loop"""
+        self._task = asyncio.get_running_loop().create_task(self._guarded_run(), name="update-poller")
+
+    async def stop(self):
+        """Остановка опроса: новые обновления больше не запрашиваются"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def start_thread(self):
+        """Опрос в отдельном потоке со своим event loop (для фронтенда многопроцессного режима)"""
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_thread, name="update-poller", daemon=True)
+        self._thread.start()
+
+    def _run_thread(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._thread_main())
+        self._loop.close()
+
+    async def _thread_main(self):
+        self.start()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    def stop_thread(self, timeout=5):
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(lambda: self._task.cancel())
+            self._thread.join(timeout)
+            self._thread = None
+
+    async def _guarded_run(self):
+        # Ошибки запросов и отдельных обновлений run обрабатывает сам, сюда доходят
+        # только непредвиденные: опрос перезапускается, а не останавливается навсегда
+        delay = 1.0
+        while True:
+            try:
+                await self.run()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                POLL_ERRORS.inc()
+                logger.error("Long polling прерван: %s, перезапуск через %.0f с", e, delay, extra={'stage': 'polling'})
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_delay)
+
+
+class PollError(Exception):
+    """Ответ Bot API с ok=false"""
+
+    def __init__(self, status, description, retry_after=None):
+        super().__init__(f"{status} - {description}")
+        self.status = status
+        self.retry_after = retry_after
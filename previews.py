@@ -0,0 +1,49 @@
+"""Превью медиафайлов. Функции выполняются в пуле процессов, а не в event loop"""
+import os
+import shutil
+import subprocess
+
+PREVIEW_SIZE = 320
+PREVIEW_QUALITY = 70
+
+
+def _photo_preview(src, dst):
+    from PIL import Image, ImageOps
+
+    with Image.open(src) as image:
+        # draft() декодирует JPEG сразу в уменьшенном масштабе — в разы быстрее полного декодирования
+        image.draft('RGB', (PREVIEW_SIZE, PREVIEW_SIZE))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+        image.convert('RGB').save(dst, 'JPEG', quality=PREVIEW_QUALITY, optimize=True)
+
+
+def _video_poster(src, dst, timeout=60):
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        raise RuntimeError("ffmpeg не найден, кадр видео не извлекается")
+    subprocess.run([ffmpeg, '-loglevel', 'error', '-y', '-ss', '1', '-i', src, '-frames:v', '1',
+                    '-vf', f"scale='min({PREVIEW_SIZE},iw)':-2", '-q:v', '5', dst],
+                   check=True, capture_output=True, timeout=timeout)
+    if not os.path.exists(dst):
+        # Видео короче секунды: берём первый кадр
+        subprocess.run([ffmpeg, '-loglevel', 'error', '-y', '-i', src, '-frames:v', '1',
+                        '-vf', f"scale='min({PREVIEW_SIZE},iw)':-2", '-q:v', '5', dst],
+                       check=True, capture_output=True, timeout=timeout)
+
+
+def make_preview(src, dst, kind):
+    """Сжатое превью фото или кадр видео в dst (JPEG). Возвращает размер превью в байтах"""
+    tmp = dst + '.part'
+    try:
+        if kind == 'video':
+            _video_poster(src, tmp + '.jpg')
+            os.replace(tmp + '.jpg', tmp)
+        else:
+            _photo_preview(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        for path in (tmp, tmp + '.jpg'):
+            if os.path.exists(path):
+                os.remove(path)
+    return os.path.getsize(dst)
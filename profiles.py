@@ -0,0 +1,48 @@
+"""Данные постоянных клиентов из их прошлых заявок"""
+from collections import OrderedDict
+
+FIELDS = ('name', 'phone', 'tech_type', 'language')
+
+_MISSING = object()
+
+
+class ProfileCache:
+    """LRU-кэш данных клиента (имя, телефон, тип техники, язык) по user_id.
+
+    При промахе данные берутся из последней заявки пользователя по индексу
+    idx_orders_user. Отсутствие заявок тоже кэшируется, поэтому новый клиент
+    не обращается к базе повторно; после новой заявки кэш обновляет remember().
+    """
+
+    def __init__(self, storage, capacity=10000):
+        self.storage = storage
+        self.capacity = capacity
+        self._cache = OrderedDict()
+
+    @staticmethod
+    def _select_latest(conn, user_id):
+        return conn.execute(f'''SELECT {', '.join(FIELDS)} FROM orders WHERE user_id = ?
+                                ORDER BY created_at DESC, id DESC LIMIT 1''', (user_id,)).fetchone()
+
+    def _store(self, user_id, profile):
+        self._cache[user_id] = profile
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.capacity:
+            self._cache.popitem(last=False)
+
+    async def get(self, user_id):
+        """Данные из последней заявки или None, если их не хватает для повторной заявки"""
+        profile = self._cache.get(user_id, _MISSING)
+        if profile is _MISSING:
+            row = await self.storage.read(self._select_latest, user_id)
+            profile = dict(zip(FIELDS, row)) if row is not None else None
+            if profile is not None and not (profile['name'] and profile['phone']):
+                profile = None
+            self._store(user_id, profile)
+        else:
+            self._cache.move_to_end(user_id)
+        return profile
+
+    def remember(self, user_id, profile):
+        """Обновляет кэш после сохранения новой заявки"""
+        self._store(user_id, {field: profile.get(field) for field in FIELDS})
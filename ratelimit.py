@@ -0,0 +1,221 @@
+"""Ограничение исходящих запросов к Bot API"""
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import BOT_API_LATENCY, BOT_API_WAIT, BOT_API_429
+
+logger = logging.getLogger(__name__)
+
+# Чем меньше число, тем раньше запрос уходит в Telegram
+PRIORITY_USER = 0
+PRIORITY_ADMIN = 1
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота,
+# 1 сообщение в секунду в личный чат и 20 в минуту в группу
+OVERALL_RATE = 30
+PRIVATE_CHAT_RATE = 1
+GROUP_CHAT_RATE = 20 / 60
+
+
+class PriorityBucket:
+    """Token bucket с очередью ожидающих по приоритету"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._pump_task = None
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _wait_time(self):
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    @property
+    def backlog(self):
+        return len(self._waiters)
+
+    @property
+    def idle(self):
+        return not self._waiters and self._wait_time() == 0 and self.tokens >= self.capacity
+
+    def pause(self, seconds):
+        """Приостанавливает выдачу токенов (ответ 429 с retry_after)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self, priority):
+        if not self._waiters and self._wait_time() == 0:
+            self.tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        await future
+
+    async def _pump(self):
+        while self._waiters:
+            wait = self._wait_time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self.tokens -= 1
+                future.set_result(None)
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """Ограничитель запросов для всего бота и для каждого чата.
+
+    Запросы к чатам из low_priority_chats (уведомления администратору)
+    пропускают вперёд ответы пользователям. После 429 чат (или весь бот,
+    если чат неизвестен) приостанавливается на retry_after, и запрос
+    повторяется не более max_retries раз. Приоритет можно задать явно через
+    rate_limit_args={'priority': ...}.
+
+    Чаты пользователей распределены по процессам-обработчикам, а в чат
+    администратора пишут все processes процессов, поэтому его лимит (как и
+    overall_rate у вызывающего кода) делится между ними.
+    """
+
+    def __init__(self, overall_rate=OVERALL_RATE, private_rate=PRIVATE_CHAT_RATE, group_rate=GROUP_CHAT_RATE,
+                 burst=3, low_priority_chats=(), max_retries=3, max_chats=10000, processes=1):
+        self.overall = PriorityBucket(overall_rate, overall_rate)
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.low_priority_chats = set(low_priority_chats)
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.processes = processes
+        self._chats = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.max_chats:
+                # Удаляем простаивающие чаты, чтобы словарь не рос бесконечно
+                for key in [key for key, value in self._chats.items() if value.idle]:
+                    del self._chats[key]
+            rate = self.group_rate if str(chat_id).startswith('-') else self.private_rate
+            burst = self.burst
+            if chat_id in self.low_priority_chats:
+                rate /= self.processes
+                burst = max(1, burst // self.processes)
+            bucket = self._chats[chat_id] = PriorityBucket(rate, burst)
+        return bucket
+
+    def backlog(self, chat_id):
+        """Число запросов, ожидающих отправки в чат"""
+        bucket = self._chats.get(chat_id)
+        return bucket.backlog if bucket else 0
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        priority = (rate_limit_args or {}).get(
+            'priority', PRIORITY_ADMIN if chat_id in self.low_priority_chats else PRIORITY_USER
+        )
+        chat = self._chat_bucket(chat_id) if chat_id is not None else None
+
+        for attempt in range(self.max_retries + 1):
+            if chat is not None:
+                started = time.perf_counter()
+                await chat.acquire(priority)
+                await self.overall.acquire(priority)
+                BOT_API_WAIT.observe(time.perf_counter() - started, priority=priority)
+            try:
+                with BOT_API_LATENCY.time(endpoint=endpoint):
+                    return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                BOT_API_429.inc(endpoint=endpoint)
+                if attempt == self.max_retries:
+                    raise
+                logger.warning("429 от Telegram для %s (чат %s), пауза %s с", endpoint, chat_id, e.retry_after,
+                               extra={'stage': 'bot_api'})
+                (chat or self.overall).pause(e.retry_after)
+                if chat is None:
+                    await asyncio.sleep(e.retry_after)
+
+
+class AdminDigest:
+    """Дайджест уведомлений администратору.
+
+    Пока очередь в чат администратора короче threshold, уведомления уходят
+    как обычно. Когда они начинают копиться, тексты заявок объединяются в
+    одно сообщение (до max_length символов), а вложения отправляются следом.
+    """
+
+    def __init__(self, limiter, chat_id, send_text, send_media, threshold=3, max_length=4096):
+        self.limiter = limiter
+        self.chat_id = chat_id
+        self.send_text = send_text
+        self.send_media = send_media
+        self.threshold = threshold
+        self.max_length = max_length
+        self._pending = []
+        self._task = None
+
+    @property
+    def backed_up(self):
+        return bool(self._pending) or self.limiter.backlog(self.chat_id) >= self.threshold
+
+    def add(self, text, media, caption):
+        """Ставит уведомление в дайджест; отправка идёт в фоне"""
+        self._pending.append((text, media, caption))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush(), name="admin-digest")
+
+    def _take_batch(self):
+        batch, length = [], 0
+        while self._pending:
+            text = self._pending[0][0]
+            if batch and length + len(text) + 2 > self.max_length:
+                break
+            batch.append(self._pending.pop(0))
+            length += len(text) + 2
+        return batch
+
+    async def _flush(self):
+        while self._pending:
+            batch = self._take_batch()
+            try:
+                await self.send_text("\n\n".join(text for text, _, _ in batch))
+                for _, media, caption in batch:
+                    if media:
+                        await self.send_media(media, caption)
+            except Exception as e:
+                logger.error("Ошибка отправки дайджеста администратору (%s заявок): %s", len(batch), e,
+                             extra={'stage': 'notify_admin'})
+
+    async def close(self):
+        """Дожидается отправки накопленных уведомлений (при остановке бота)"""
+        if self._task is not None and not self._task.done():
+            await self._task
+        if self._pending:
+            await self._flush()
@@ -0,0 +1,108 @@
+"""Выгрузка заявок потоком и агрегаты по дням для дашбордов"""
+import io
+import csv
+import json
+
+from order_queries import COLUMNS, EQUALITY_FILTERS
+
+EXPORT_BATCH_SIZE = 500
+EXPORT_FORMATS = ('csv', 'jsonl')
+EXPORT_FILTERS = ('tech_type', 'language', 'user_id')
+
+
+def init_rollups(c, utc_offset_hours):
+    """Таблица заявок по дням, типу техники и языку (вызывается из init_db).
+
+    Счётчики увеличиваются триггером в той же транзакции, что и вставка заявки.
+    День считается по местному времени (created_at хранится в UTC). Удаление
+    заявок при архивации агрегаты не уменьшает.
+    """
+    exists = c.execute("SELECT 1 FROM sqlite_master WHERE name = 'order_rollups'").fetchone()
+    c.execute('''CREATE TABLE IF NOT EXISTS order_rollups
+                 (day TEXT NOT NULL,
+                  tech_type TEXT NOT NULL,
+                  language TEXT NOT NULL,
+                  orders INTEGER NOT NULL,
+                  PRIMARY KEY (day, tech_type, language)) WITHOUT ROWID''')
+    modifier = f"{utc_offset_hours:+g} hours"
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS order_rollups_insert AFTER INSERT ON orders BEGIN
+                      INSERT INTO order_rollups (day, tech_type, language, orders)
+                      VALUES (date(new.created_at, '{modifier}'), COALESCE(new.tech_type, ''),
+                              COALESCE(new.language, ''), 1)
+                      ON CONFLICT (day, tech_type, language) DO UPDATE SET orders = orders + 1;
+                  END''')
+    if not exists:
+        # Заявки, сохранённые до появления агрегатов
+        c.execute(f'''INSERT INTO order_rollups (day, tech_type, language, orders)
+                      SELECT date(created_at, '{modifier}'), COALESCE(tech_type, ''), COALESCE(language, ''),
+                             COUNT(*)
+                      FROM orders GROUP BY 1, 2, 3''')
+
+
+def select_rollups(conn, date_from=None, date_to=None):
+    """Агрегаты за период [date_from, date_to] включительно"""
+    rows = conn.execute('''SELECT day, tech_type, language, orders FROM order_rollups
+                           WHERE day >= ? AND day <= ? ORDER BY day, tech_type, language''',
+                        (date_from or '', date_to or '9999-12-31')).fetchall()
+    return [dict(zip(('day', 'tech_type', 'language', 'orders'), row)) for row in rows]
+
+
+def parse_export_args(args):
+    """Параметры /orders/export -> (формат, фильтры, after_id). ValueError при ошибке"""
+    fmt = args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"format должен быть одним из: {', '.join(EXPORT_FORMATS)}")
+    filters = {}
+    for name in EXPORT_FILTERS:
+        if args.get(name):
+            filters[name] = int(args[name]) if name == 'user_id' else args[name]
+    for name in ('date_from', 'date_to'):
+        if args.get(name):
+            filters[name] = args[name]
+    after_id = int(args.get('after_id') or 0)
+    return fmt, filters, after_id
+
+
+def export_batch(conn, filters, after_id, limit=EXPORT_BATCH_SIZE):
+    """Следующая пачка заявок после after_id в порядке id"""
+    where, params = ["o.id > ?"], [after_id]
+    for name in EXPORT_FILTERS:
+        if name in filters:
+            where.append(f"{EQUALITY_FILTERS[name]} = ?")
+            params.append(filters[name])
+    if 'date_from' in filters:
+        where.append("o.created_at >= ?")
+        params.append(filters['date_from'])
+    if 'date_to' in filters:
+        where.append("o.created_at < ?")
+        params.append(filters['date_to'])
+    sql = (f"SELECT {', '.join('o.' + column for column in COLUMNS)} FROM orders o"
+           f" WHERE {' AND '.join(where)} ORDER BY o.id LIMIT ?")
+    return conn.execute(sql, (*params, limit)).fetchall()
+
+
+def export_orders(read, fmt, filters, after_id=0):
+    """Генератор строк выгрузки.
+
+    read(fn, *args) выполняет запрос (storage.read_sync). Заявки читаются
+    пачками по id, каждая пачка — отдельный короткий запрос, поэтому память
+    не растёт с размером таблицы, а запись в базу не блокируется. Прерванную
+    выгрузку можно продолжить с after_id = id последней полученной заявки.
+    """
+    if fmt == 'csv':
+        yield _csv_rows([COLUMNS])
+    while True:
+        rows = read(export_batch, filters, after_id)
+        if not rows:
+            return
+        if fmt == 'csv':
+            yield _csv_rows(rows)
+        else:
+            yield "".join(json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False) + "\n" for row in rows)
+        after_id = rows[-1][0]
+
+
+def _csv_rows(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
@@ -0,0 +1,157 @@
+"""Постоянный event loop и очередь обновлений для webhook"""
+import asyncio
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateRuntime:
+    """Долгоживущий event loop в отдельном потоке с пулом обработчиков обновлений.
+
+    HTTP-слой только кладёт обновление в ограниченную очередь и сразу отвечает,
+    не дожидаясь event loop: место в очереди резервируется потокобезопасным
+    счётчиком, а само обновление передаётся в loop через call_soon_threadsafe.
+    Обработчики вызывают process_update. Обновления одного пользователя
+    обрабатываются строго по порядку, разных пользователей — параллельно.
+    Пока обработчик занят пользователем, его следующие обновления передаются
+    этому же обработчику, а не ждут блокировку: остальные обработчики
+    свободны для других пользователей.
+    """
+
+    def __init__(self, queue_size=1000, workers=8):
+        self.queue_size = queue_size
+        self.workers = workers
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name="bot-loop", daemon=True)
+        self._queue = None
+        self._space = None
+        self._tasks = []
+        # Обновления пользователей, которые сейчас обрабатываются, по ключу
+        self._pending = {}
+        # Принятых, но ещё не начатых обновлений (в очереди и в _pending).
+        # Меняется из потоков HTTP-сервера и из loop, поэтому под блокировкой
+        self._waiting = 0
+        self._waiting_lock = threading.Lock()
+        self._process = None
+        self._background = set()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self):
+        """Запуск потока с event loop"""
+        self._thread.start()
+
+    def run(self, coro, timeout=None):
+        """Выполняет корутину в event loop и ждёт результат (вызывать из другого потока)"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    async def start_workers(self, process):
+        """Создаёт очередь и запускает обработчики (вызывать внутри event loop)"""
+        self._process = process
+        # Размер ограничивает счётчик _waiting, сама очередь не ограничена
+        self._queue = asyncio.Queue()
+        self._space = asyncio.Event()
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"update-worker-{i}")
+            for i in range(self.workers)
+        ]
+        logger.info("Запущено обработчиков обновлений: %s, размер очереди: %s", self.workers, self.queue_size,
+                    extra={'stage': 'startup'})
+
+    def spawn(self, coro, name=None):
+        """Запускает фоновую задачу, которая живёт до остановки runtime"""
+        task = self.loop.create_task(coro, name=name)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    def _reserve(self):
+        with self._waiting_lock:
+            if self._waiting >= self.queue_size:
+                return False
+            self._waiting += 1
+            return True
+
+    def _release(self, count=1):
+        """Освобождает место в очереди (вызывается внутри event loop)"""
+        if not count:
+            return
+        with self._waiting_lock:
+            self._waiting -= count
+        self._space.set()
+
+    async def put(self, key, update):
+        """Ставит обновление в очередь, дожидаясь места (вызывать внутри event loop)"""
+        # Место освобождают только обработчики в этом же loop, поэтому между
+        # неудачной попыткой и clear() освободиться оно не может
+        while not self._reserve():
+            self._space.clear()
+            await self._space.wait()
+        self._queue.put_nowait((key, update))
+
+    def submit(self, key, update):
+        """Потокобезопасно ставит обновление в очередь без ожидания loop. False — если очередь переполнена"""
+        if self._queue is None or not self._reserve():
+            return False
+        try:
+            self.loop.call_soon_threadsafe(self._queue.put_nowait, (key, update))
+        except RuntimeError:
+            # Loop уже остановлен
+            with self._waiting_lock:
+                self._waiting -= 1
+            return False
+        return True
+
+    @property
+    def qsize(self):
+        # Переданные занятому обработчику обновления тоже ждут обработки
+        return self._waiting
+
+    async def _worker(self):
+        while True:
+            key, update = await self._queue.get()
+            # Между get() и проверкой нет await, поэтому порядок обновлений
+            # одного пользователя сохраняется. task_done() вызывает тот, кто обработал
+            pending = self._pending.get(key)
+            if pending is not None:
+                pending.append(update)
+                continue
+            pending = self._pending[key] = deque([update])
+            try:
+                while pending:
+                    update = pending.popleft()
+                    self._release()
+                    try:
+                        await self._process(update)
+                    except Exception as e:
+                        logger.error("Ошибка обработки обновления %s: %s", key, e, extra={'stage': 'update'})
+                    finally:
+                        self._queue.task_done()
+            finally:
+                # При отмене обработчика непереданные обновления теряются вместе с ним
+                self._release(len(self._pending.pop(key)))
+
+    async def stop_workers(self, timeout=10):
+        """Дожидается опустошения очереди и останавливает обработчики"""
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.error("Очередь не опустела за %s с, необработанных обновлений: %s", timeout, self.qsize,
+                             extra={'stage': 'shutdown'})
+        tasks = self._tasks + list(self._background)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stop(self):
+        """Остановка обработчиков и event loop"""
+        if self.loop.is_running():
+            self.run(self.stop_workers())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join(timeout=5)
@@ -0,0 +1,24 @@
+"""Точка входа для продакшена: порт открывается раньше тяжёлых импортов.
+
+На Fly машина запускается по первому запросу. Сокет открывается сразу,
+а соединения, пришедшие пока импортируются telegram и Flask и
+инициализируется бот, ждут в очереди ядра, а не получают отказ.
+"""
+import time
+
+STARTED = time.monotonic()
+
+import os  # noqa: E402
+import socket  # noqa: E402
+
+
+def main():
+    port = int(os.environ.get('PORT', 8080))
+    sock = socket.create_server(('0.0.0.0', port), backlog=1024)
+
+    import bot
+    bot.run_bot(sockets=[sock], started=STARTED)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+"""Хранилище состояния диалогов: LRU/TTL-кэш в памяти и отложенная запись в SQLite"""
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+# Запись в _dirty: сериализовать текущее значение из кэша при сбросе
+_LIVE = object()
+
+
+def init_sessions(c):
+    """Создание таблиц сессий и состояний диалогов (вызывается из init_db)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS sessions
+                 (user_id INTEGER PRIMARY KEY,
+                  data TEXT NOT NULL,
+                  updated_at REAL NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions (updated_at)")
+    c.execute('''CREATE TABLE IF NOT EXISTS conversations
+                 (name TEXT NOT NULL,
+                  key TEXT NOT NULL,
+                  state TEXT,
+                  updated_at REAL NOT NULL,
+                  PRIMARY KEY (name, key))''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations (updated_at)")
+
+
+class Session(dict):
+    """Данные диалога пользователя. Любое изменение помечает сессию для записи в базу"""
+    __slots__ = ('_store', '_key', 'touched_at')
+
+    def __init__(self, store, key, data=(), touched_at=None):
+        super().__init__(data)
+        self._store = store
+        self._key = key
+        self.touched_at = touched_at or time.time()
+
+    def _changed(self):
+        self._store._mark_dirty(self._key)
+
+    def __setitem__(self, name, value):
+        super().__setitem__(name, value)
+        self._changed()
+
+    def __delitem__(self, name):
+        super().__delitem__(name)
+        self._changed()
+
+    def setdefault(self, name, default=None):
+        if name not in self:
+            self[name] = default
+        return super().__getitem__(name)
+
+    def pop(self, name, *args):
+        result = super().pop(name, *args)
+        self._changed()
+        return result
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._changed()
+
+
+class SessionStore:
+    """Сессии пользователей с доступом как к словарю user_id -> данные.
+
+    В памяти держится не больше capacity сессий, неактивные дольше ttl секунд
+    удаляются. Изменения накапливаются и пакетом записываются в таблицу
+    sessions фоновой задачей run(). Перед обработкой обновления нужно вызвать
+    prefetch(), чтобы вытесненная из памяти сессия была подгружена без
+    блокировки event loop.
+    """
+
+    def __init__(self, capacity=10000, ttl=86400, flush_interval=2.0):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.storage = None
+        self._cache = OrderedDict()
+        self._dirty = {}
+        self._inflight = {}
+
+    def bind(self, storage):
+        """Подключение к хранилищу (вызывается из init_db)"""
+        self.storage = storage
+
+    # Доступ как к словарю
+
+    def _expired(self, session, now=None):
+        return (now or time.time()) - session.touched_at > self.ttl
+
+    def _lookup(self, user_id):
+        session = self._cache.get(user_id)
+        if session is None:
+            return None
+        if self._expired(session):
+            self._drop(user_id)
+            return None
+        session.touched_at = time.time()
+        self._cache.move_to_end(user_id)
+        return session
+
+    def __contains__(self, user_id):
+        return self._lookup(user_id) is not None
+
+    def __getitem__(self, user_id):
+        session = self._lookup(user_id)
+        if session is None:
+            raise KeyError(user_id)
+        return session
+
+    def get(self, user_id, default=None):
+        session = self._lookup(user_id)
+        return default if session is None else session
+
+    def __setitem__(self, user_id, data):
+        self._cache[user_id] = Session(self, user_id, data)
+        self._cache.move_to_end(user_id)
+        self._mark_dirty(user_id)
+        self._evict()
+
+    def __delitem__(self, user_id):
+        if user_id not in self._cache:
+            raise KeyError(user_id)
+        self._drop(user_id)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _drop(self, user_id):
+        self._cache.pop(user_id, None)
+        self._dirty[user_id] = None
+
+    def _mark_dirty(self, user_id):
+        self._dirty[user_id] = _LIVE
+
+    def _evict(self):
+        while len(self._cache) > self.capacity:
+            user_id, session = self._cache.popitem(last=False)
+            # Несохранённые изменения вытесненной сессии сериализуем сразу
+            if self._dirty.get(user_id) is _LIVE:
+                self._dirty[user_id] = (json.dumps(session, ensure_ascii=False), session.touched_at)
+
+    # Загрузка
+
+    def _restore(self, user_id, data, touched_at):
+        session = Session(self, user_id, json.loads(data), touched_at)
+        if self._expired(session):
+            return
+        self._cache[user_id] = session
+        self._cache.move_to_end(user_id)
+        self._evict()
+
+    @staticmethod
+    def _select_one(conn, user_id):
+        return conn.execute("SELECT data, updated_at FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+
+    @staticmethod
+    def _select_recent(conn, since, limit):
+        return conn.execute('''SELECT user_id, data, updated_at FROM sessions
+                               WHERE updated_at >= ? ORDER BY updated_at DESC LIMIT ?''',
+                            (since, limit)).fetchall()
+
+    async def warm(self, owns=None):
+        """Загружает последние активные сессии, чтобы после рестарта кэш был тёплым.
+
+        owns(user_id) отбирает сессии, которые обслуживает этот процесс.
+        """
+        rows = await self.storage.read(self._select_recent, time.time() - self.ttl, self.capacity)
+        for user_id, data, updated_at in reversed(rows):
+            if owns is not None and not owns(user_id):
+                continue
+            if user_id not in self._cache and user_id not in self._dirty:
+                self._restore(user_id, data, updated_at)
+        logger.info("Восстановлено сессий: %s", len(self._cache), extra={'stage': 'sessions'})
+
+    async def prefetch(self, user_id):
+        """Подгружает сессию из базы, если её нет в памяти"""
+        if user_id in self._cache:
+            return
+        for pending in (self._dirty, self._inflight):
+            if user_id in pending:
+                value = pending[user_id]
+                if isinstance(value, tuple):
+                    self._restore(user_id, *value)
+                return
+        row = await self.storage.read(self._select_one, user_id)
+        if row is not None and user_id not in self._cache and user_id not in self._dirty:
+            self._restore(user_id, *row)
+
+    # Сброс в базу
+
+    @staticmethod
+    def _apply(conn, upserts, deletes, expire_before):
+        if upserts:
+            conn.executemany('''INSERT INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?)
+                                ON CONFLICT(user_id) DO UPDATE SET
+                                    data = excluded.data, updated_at = excluded.updated_at''', upserts)
+        if deletes:
+            conn.executemany("DELETE FROM sessions WHERE user_id = ?", deletes)
+        conn.execute("DELETE FROM sessions WHERE updated_at < ?", (expire_before,))
+        # Состояния диалогов старше сессий при рестарте всё равно не загружаются
+        conn.execute("DELETE FROM conversations WHERE updated_at < ?", (expire_before,))
+
+    def _expire(self):
+        now = time.time()
+        while self._cache:
+            user_id, session = next(iter(self._cache.items()))
+            if not self._expired(session, now):
+                break
+            self._drop(user_id)
+
+    async def flush(self):
+        """Записывает накопленные изменения одной транзакцией"""
+        self._expire()
+        if not self._dirty:
+            return
+        self._inflight, self._dirty = self._dirty, {}
+        upserts, deletes = [], []
+        for user_id, value in self._inflight.items():
+            if value is _LIVE:
+                session = self._cache.get(user_id)
+                if session is None:
+                    continue
+                value = (json.dumps(session, ensure_ascii=False), session.touched_at)
+                self._inflight[user_id] = value
+            if value is None:
+                deletes.append((user_id,))
+            else:
+                upserts.append((user_id, *value))
+        try:
+            await self.storage.write(self._apply, upserts, deletes, time.time() - self.ttl)
+        except Exception as e:
+            logger.error("Ошибка сохранения сессий: %s", e, extra={'stage': 'sessions'})
+            # Возвращаем изменения, не перетирая более новые
+            for user_id, value in self._inflight.items():
+                self._dirty.setdefault(user_id, value)
+        finally:
+            self._inflight = {}
+
+    async def run(self):
+        """Фоновая запись изменений и удаление устаревших сессий и состояний диалогов"""
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+        finally:
+            await self.flush()
+
+
+class ConversationPersistence(BasePersistence):
+    """Сохранение состояний ConversationHandler в SQLite.
+
+    Хранит только состояния диалогов; данные пользователей ведёт SessionStore.
+    """
+
+    def __init__(self, storage, ttl=86400, update_interval=2.0):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self.storage = storage
+        self.ttl = ttl
+
+    @staticmethod
+    def _select(conn, name, since):
+        return conn.execute("SELECT key, state FROM conversations WHERE name = ? AND updated_at >= ?",
+                            (name, since)).fetchall()
+
+    @staticmethod
+    def _upsert(conn, name, key, state):
+        if state is None:
+            conn.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, key))
+        else:
+            conn.execute('''INSERT INTO conversations (name, key, state, updated_at) VALUES (?, ?, ?, ?)
+                            ON CONFLICT(name, key) DO UPDATE SET
+                                state = excluded.state, updated_at = excluded.updated_at''',
+                         (name, key, state, time.time()))
+
+    async def get_conversations(self, name):
+        rows = await self.storage.read(self._select, name, time.time() - self.ttl)
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        state = None if new_state is None else json.dumps(new_state)
+        await self.storage.write(self._upsert, name, json.dumps(list(key)), state)
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_user_data(self, user_id, data):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def drop_user_data(self, user_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        pass
@@ -0,0 +1,196 @@
+"""Слой доступа к SQLite: WAL, один поток записи с групповыми коммитами"""
+import time
+import queue
+import asyncio
+import logging
+import sqlite3
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from metrics import SQLITE_LATENCY, SQLITE_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class Storage:
+    """Долгоживущие соединения с базой заявок.
+
+    Все изменения выполняются в одном потоке записи: задания, накопившиеся
+    за время предыдущего коммита, выполняются в одной транзакции (каждое в
+    своём SAVEPOINT) и фиксируются одним fsync. Чтение идёт через небольшой
+    пул потоков со своими соединениями, WAL позволяет читать параллельно с
+    записью. Подготовленные операторы переиспользуются через кэш sqlite3,
+    поэтому SQL передаётся константными строками. cache_mb — кэш страниц
+    каждого соединения: горячая база должна целиком помещаться в него.
+    """
+
+    def __init__(self, path, synchronous='NORMAL', readers=2, batch_size=128,
+                 busy_timeout=30.0, cached_statements=256, cache_mb=None):
+        self.path = path
+        self.synchronous = synchronous
+        self.cache_mb = cache_mb
+        self.readers = readers
+        self.batch_size = batch_size
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._writer_loop, name="sqlite-writer", daemon=True)
+        self._read_pool = None
+        self._local = threading.local()
+        self._read_conns = []
+        self._read_conns_lock = threading.Lock()
+        self._started = False
+        self._last_commit = time.monotonic()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                               check_same_thread=False, cached_statements=self.cached_statements)
+        # Действует только для новой базы (до создания таблиц): свободные страницы
+        # возвращаются PRAGMA incremental_vacuum без полного VACUUM (см. maintenance.py)
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if self.cache_mb:
+            conn.execute(f"PRAGMA cache_size=-{int(self.cache_mb) * 1024}")
+        return conn
+
+    def start(self):
+        """Открывает соединения и запускает поток записи"""
+        if self._started:
+            return
+        self._writer_conn = self._connect()
+        self._read_pool = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="sqlite-reader")
+        self._writer.start()
+        self._started = True
+
+    def close(self):
+        """Дожидается выполнения записанных заданий и закрывает соединения"""
+        if not self._started:
+            return
+        self._queue.put(_STOP)
+        self._writer.join()
+        self._read_pool.shutdown(wait=True)
+        with self._read_conns_lock:
+            for conn in self._read_conns:
+                conn.close()
+            self._read_conns = []
+        self._writer_conn.close()
+        self._started = False
+
+    # Запись
+
+    def submit_write(self, fn, *args) -> Future:
+        """Ставит fn(conn, *args) в очередь записи. Возвращает concurrent.futures.Future"""
+        future = Future()
+        self._queue.put((future, fn, args))
+        return future
+
+    def write_sync(self, fn, *args):
+        """Синхронная запись (для запуска и вспомогательных потоков)"""
+        return self.submit_write(fn, *args).result()
+
+    @property
+    def idle_for(self):
+        """Секунд с последнего коммита; 0, если в очереди записи есть задания"""
+        if not self._queue.empty():
+            return 0.0
+        return time.monotonic() - self._last_commit
+
+    async def write(self, fn, *args):
+        """Запись из event loop: fsync выполняется в потоке записи"""
+        with SQLITE_LATENCY.time(op='write', query=fn.__qualname__):
+            return await asyncio.wrap_future(self.submit_write(fn, *args))
+
+    def _writer_loop(self):
+        stop = False
+        while not stop:
+            job = self._queue.get()
+            if job is _STOP:
+                break
+            batch = [job]
+            # Всё, что накопилось, пока шёл предыдущий коммит, фиксируем вместе
+            while len(batch) < self.batch_size:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is _STOP:
+                    stop = True
+                    break
+                batch.append(job)
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        conn = self._writer_conn
+        results = []
+        SQLITE_BATCH_SIZE.observe(len(batch))
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for future, fn, args in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT job")
+                try:
+                    result = fn(conn, *args)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    results.append((future, None, e))
+                else:
+                    conn.execute("RELEASE job")
+                    results.append((future, result, None))
+            conn.execute("COMMIT")
+            self._last_commit = time.monotonic()
+        except Exception as e:
+            # Любая ошибка (в том числе не sqlite3) не должна останавливать поток записи
+            logger.error("Ошибка группового коммита (%s заданий): %s", len(batch), e, extra={'stage': 'db'})
+            try:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+            except sqlite3.Error as rollback_error:
+                logger.error("Ошибка отката транзакции: %s", rollback_error, extra={'stage': 'db'})
+            # Транзакция не зафиксирована: ошибку получают все задания пакета,
+            # включая те, до которых цикл не дошёл
+            for future, fn, args in batch:
+                if future.done():
+                    continue
+                if future.running() or future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            return
+
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    # Чтение
+
+    def _reader_conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            conn.execute("PRAGMA query_only=ON")
+            self._local.conn = conn
+            with self._read_conns_lock:
+                self._read_conns.append(conn)
+        return conn
+
+    def _run_read(self, fn, args):
+        return fn(self._reader_conn(), *args)
+
+    def submit_read(self, fn, *args) -> Future:
+        """Выполняет fn(conn, *args) в пуле чтения. Возвращает concurrent.futures.Future"""
+        return self._read_pool.submit(self._run_read, fn, args)
+
+    def read_sync(self, fn, *args):
+        """Синхронное чтение (для вспомогательных потоков)"""
+        return self.submit_read(fn, *args).result()
+
+    async def read(self, fn, *args):
+        """Чтение из event loop без блокировки обработки сообщений"""
+        with SQLITE_LATENCY.time(op='read', query=fn.__qualname__):
+            return await asyncio.wrap_future(self.submit_read(fn, *args))
@@ -0,0 +1,122 @@
+"""Несколько ботов в одном процессе: конфигурация брендов и бот текущего обновления"""
+import os
+import re
+import json
+import contextvars
+
+DEFAULT_BOT_ID = 'default'
+
+BOT_ID_PATTERN = re.compile(r'^[a-z0-9_-]{1,32}$')
+
+_current = contextvars.ContextVar('tenant', default=None)
+
+
+class Tenant:
+    """Один бот (бренд): настройки и объекты, которые у каждого бота свои.
+
+    У каждого бота своя база SQLite (номера заявок, сессии, outbox и
+    update_id у разных ботов независимы), свои application, лимиты Bot API,
+    сессии, кэши и доставка в Make. Event loop, очередь обновлений, пулы
+    HTTP-соединений и пул превью общие для всех ботов процесса.
+    """
+
+    def __init__(self, bot_id, token, admin_chat_id, make_webhook_url, webhook_url, db_path, media_dir,
+                 texts, tech_types):
+        self.bot_id = bot_id
+        self.token = token
+        self.admin_chat_id = admin_chat_id
+        self.make_webhook_url = make_webhook_url
+        self.webhook_url = webhook_url
+        self.db_path = db_path
+        self.media_dir = media_dir
+        self.texts = texts
+        self.tech_types = tech_types
+        # Создаются в bot.py при запуске
+        self.catalog = None
+        self.user_data = None
+        self.admission = None
+        self.album_collector = None
+        self.storage = None
+        self.application = None
+        self.make_dispatcher = None
+        self.media_ingestor = None
+        self.admin_digest = None
+        self.update_dedupe = None
+        self.profiles = None
+        self.tracer = None
+        self.poller = None
+
+    def __repr__(self):
+        return f"Tenant({self.bot_id!r})"
+
+
+def merge_texts(base, overrides):
+    """Тексты бота: стандартные, поверх них — заданные в конфигурации"""
+    unknown = set(overrides) - set(base)
+    if unknown:
+        raise ValueError(f"Неизвестные языки в texts: {', '.join(sorted(unknown))}")
+    return {language: {**texts, **overrides.get(language, {})} for language, texts in base.items()}
+
+
+def load_tenants(path, texts, tech_types, webhook_url, db_path, media_dir):
+    """Боты из JSON-файла конфигурации.
+
+    {"bots": [{"id": "samarkand", "token_env": "SAMARKAND_BOT_TOKEN", "admin_chat_id": 123,
+               "make_webhook_url": "https://hook...", "texts": {"ru": {"welcome": "..."}},
+               "tech_types": {"ru": [...], "uz": [...]}}]}
+
+    Токен задаётся прямо (token) или именем переменной окружения (token_env).
+    Необязательные webhook_url, db_path и media_dir по умолчанию выводятся из
+    общих WEBHOOK_URL, DB_PATH и MEDIA_DIR: <WEBHOOK_URL>/<id>, orders-<id>.db
+    рядом с DB_PATH и <MEDIA_DIR>/<id>.
+    """
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+
+    tenants = []
+    for bot in config.get('bots', []):
+        bot_id = bot.get('id', '')
+        if not BOT_ID_PATTERN.match(bot_id):
+            raise ValueError(f"Некорректный id бота {bot_id!r}: допустимы a-z, 0-9, _ и -")
+        if any(tenant.bot_id == bot_id for tenant in tenants):
+            raise ValueError(f"Бот {bot_id} описан дважды")
+        token = bot.get('token') or os.environ.get(bot.get('token_env', ''))
+        if not token:
+            raise ValueError(f"❌ Не найден токен бота {bot_id}")
+        for field in ('admin_chat_id', 'make_webhook_url'):
+            if not bot.get(field):
+                raise ValueError(f"Не задан {field} бота {bot_id}")
+
+        bot_tech_types = bot.get('tech_types', tech_types)
+        if set(bot_tech_types) != set(texts):
+            raise ValueError(f"tech_types бота {bot_id} должны быть заданы для языков: {', '.join(texts)}")
+
+        tenants.append(Tenant(
+            bot_id,
+            token,
+            int(bot['admin_chat_id']),
+            bot['make_webhook_url'],
+            bot.get('webhook_url') or f"{webhook_url.rstrip('/')}/{bot_id}",
+            bot.get('db_path') or os.path.join(os.path.dirname(db_path), f"orders-{bot_id}.db"),
+            bot.get('media_dir') or os.path.join(media_dir, bot_id),
+            merge_texts(texts, bot.get('texts', {})),
+            bot_tech_types
+        ))
+
+    if not tenants:
+        raise ValueError(f"В {path} не описано ни одного бота")
+    return tenants
+
+
+def current():
+    """Бот, обновление которого сейчас обрабатывается"""
+    return _current.get()
+
+
+def activate(tenant):
+    """Делает tenant текущим ботом. Возвращает токен для deactivate()"""
+    return _current.set(tenant)
+
+
+def deactivate(token):
+    _current.reset(token)
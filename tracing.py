@@ -0,0 +1,194 @@
+"""Трассировка заявок: этапы от /start до ответа пользователю с монотонными замерами"""
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+
+_current = contextvars.ContextVar('order_trace', default=None)
+
+
+def init_traces(c):
+    """Таблица медленных трасс (вызывается из init_db)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS order_traces
+                 (order_number TEXT PRIMARY KEY,
+                  user_id INTEGER NOT NULL,
+                  started_at REAL NOT NULL,
+                  latency REAL NOT NULL,
+                  trace TEXT NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_order_traces_latency ON order_traces (latency)")
+
+
+class Trace:
+    """Этапы диалога одного пользователя. Время этапов — смещение от начала трассы.
+
+    Хранятся последние max_spans этапов: пользователь, который переписывается
+    с ботом, не подтверждая заявку, не должен копить их без ограничения.
+    """
+
+    __slots__ = ('user_id', 'order_number', 'started', 'started_at', 'spans', 'latency', '_update_started')
+
+    def __init__(self, user_id, started, max_spans=200):
+        self.user_id = user_id
+        self.order_number = None
+        self.started = started
+        self.started_at = time.time() - (time.monotonic() - started)
+        self.spans = deque(maxlen=max_spans)
+        # Длительность обновления, в котором создана заявка (от нажатия ✅ до ответа)
+        self.latency = None
+        self._update_started = started
+
+    def add(self, name, started, duration, attrs=None):
+        self.spans.append((name, started - self.started, duration, attrs or None))
+
+    def to_dict(self):
+        spans = [{'name': name, 'start_ms': round(offset * 1000, 1), 'duration_ms': round(duration * 1000, 1),
+                  **({'attrs': attrs} if attrs else {})}
+                 for name, offset, duration, attrs in sorted(self.spans, key=lambda span: span[1])]
+        # Самый долгий из именованных этапов (без обновлений целиком и обёрток обработчиков)
+        stages = [span for span in spans if span['name'] != 'update' and not span['name'].startswith('handler.')]
+        return {
+            'order_number': self.order_number,
+            'user_id': self.user_id,
+            'started_at': self.started_at,
+            'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None,
+            'dominant_stage': max(stages, key=lambda span: span['duration_ms'])['name'] if stages else None,
+            'spans': spans,
+        }
+
+
+@contextmanager
+def span(name, **attrs):
+    """Этап текущей трассы. Без активной трассы ничего не записывает"""
+    trace = _current.get()
+    started = time.monotonic()
+    try:
+        yield attrs
+    finally:
+        if trace is not None:
+            trace.add(name, started, time.monotonic() - started, attrs)
+
+
+def restart():
+    """Начинает трассу заново с текущего обновления (вызывается на /start)"""
+    trace = _current.get()
+    if trace is not None:
+        trace.spans.clear()
+        trace.started = trace._update_started
+        trace.started_at = time.time() - (time.monotonic() - trace.started)
+
+
+def set_order(order_number):
+    """Привязывает текущую трассу к заявке: она завершится вместе с текущим обновлением"""
+    trace = _current.get()
+    if trace is not None:
+        trace.order_number = order_number
+
+
+class Tracer:
+    """Трассы заявок в памяти и в SQLite.
+
+    Пока диалог не завершён, трасса хранится по user_id. Когда обновление,
+    в котором создана заявка, обработано, трасса переходит в кольцевой буфер
+    последних capacity заявок. Если ответ на подтверждение занял дольше
+    slow_threshold секунд, трасса сохраняется в таблицу order_traces и
+    доступна после перезапуска и из других процессов.
+    """
+
+    def __init__(self, storage=None, capacity=1000, slow_threshold=5.0, active=10000, max_spans=200):
+        self.storage = storage
+        self.capacity = capacity
+        self.slow_threshold = slow_threshold
+        self.active = active
+        self.max_spans = max_spans
+        self._active = OrderedDict()
+        self._completed = OrderedDict()
+        # Этапы, завершившиеся раньше ответа пользователю (доставка в Make идёт параллельно)
+        self._early = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def update(self, user_id, **attrs):
+        """Обработка одного обновления пользователя как этап его трассы"""
+        now = time.monotonic()
+        trace = self._active.get(user_id)
+        if trace is None:
+            trace = self._active[user_id] = Trace(user_id, now, self.max_spans)
+            while len(self._active) > self.active:
+                self._active.popitem(last=False)
+        else:
+            self._active.move_to_end(user_id)
+        trace._update_started = now
+        token = _current.set(trace)
+        try:
+            yield trace
+        finally:
+            _current.reset(token)
+            duration = time.monotonic() - now
+            trace.add('update', now, duration, attrs)
+            if trace.order_number is not None:
+                trace.latency = duration
+                self._complete(trace)
+
+    def _complete(self, trace):
+        if self._active.get(trace.user_id) is trace:
+            del self._active[trace.user_id]
+        key = str(trace.order_number)
+        with self._lock:
+            for span_args in self._early.pop(key, ()):
+                trace.add(*span_args)
+            self._completed[key] = trace
+            self._completed.move_to_end(key)
+            while len(self._completed) > self.capacity:
+                self._completed.popitem(last=False)
+        if self.storage is not None and self.slow_threshold is not None and trace.latency >= self.slow_threshold:
+            self.storage.submit_write(self._insert, trace.to_dict())
+
+    def add_span(self, order_number, name, started, duration, **attrs):
+        """Этап уже завершённой трассы, например доставка в Make после ответа пользователю"""
+        key = str(order_number)
+        with self._lock:
+            trace = self._completed.get(key)
+            if trace is not None:
+                trace.add(name, started, duration, attrs)
+                return
+            self._early.setdefault(key, []).append((name, started, duration, attrs))
+            while len(self._early) > self.capacity:
+                self._early.popitem(last=False)
+
+    @staticmethod
+    def _insert(conn, trace):
+        conn.execute('''INSERT OR REPLACE INTO order_traces (order_number, user_id, started_at, latency, trace)
+                        VALUES (?, ?, ?, ?, ?)''',
+                     (str(trace['order_number']), trace['user_id'], trace['started_at'],
+                      trace['latency_ms'] / 1000, json.dumps(trace, ensure_ascii=False)))
+
+    @staticmethod
+    def _select(conn, order_number):
+        row = conn.execute("SELECT trace FROM order_traces WHERE order_number = ?", (order_number,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @staticmethod
+    def _select_slowest(conn, limit):
+        rows = conn.execute("SELECT trace FROM order_traces ORDER BY latency DESC LIMIT ?", (limit,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get(self, order_number, read=None):
+        """Трасса заявки из памяти, иначе из order_traces. read — storage.read_sync"""
+        with self._lock:
+            trace = self._completed.get(str(order_number))
+            if trace is not None:
+                return trace.to_dict()
+        if read is not None:
+            return read(self._select, str(order_number))
+        return None
+
+    def slowest(self, limit=20, read=None):
+        """Самые медленные подтверждения заявок из памяти и order_traces"""
+        with self._lock:
+            traces = {str(trace.order_number): trace.to_dict() for trace in self._completed.values()}
+        if read is not None:
+            for trace in read(self._select_slowest, limit):
+                traces.setdefault(str(trace['order_number']), trace)
+        return sorted(traces.values(), key=lambda trace: trace['latency_ms'] or 0, reverse=True)[:limit]
@@ -0,0 +1,129 @@
+"""Многопроцессный режим: обновления распределяются по процессам по пользователю"""
+import queue
+import logging
+import threading
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+_STOP = None
+
+
+def shard_for(key, shards):
+    """Номер процесса для ключа: один пользователь всегда попадает в один процесс"""
+    return int(key) % shards
+
+
+def raw_update_key(data):
+    """Ключ пользователя из JSON обновления без построения объекта Update"""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get('from') or value.get('user')
+        if user:
+            return user['id']
+        chat = value.get('chat')
+        if chat:
+            return chat['id']
+    return data.get('update_id', 0)
+
+
+class WorkerPool:
+    """Процессы-обработчики, у каждого своя очередь обновлений.
+
+    HTTP-фронтенд только разбирает JSON, определяет пользователя и кладёт
+    обновление в очередь его процесса. Обновления одного пользователя всегда
+    обрабатываются одним процессом в порядке поступления, разных пользователей —
+    параллельно на разных ядрах. Общее состояние (номера заявок, сессии,
+    состояния диалогов, outbox) хранится в SQLite.
+
+    target(index, processes, updates, ready, snapshots) выполняется в дочернем
+    процессе: после запуска он кладёт в ready пару (index, ok), затем читает
+    обновления из updates до None. В snapshots процесс кладёт пары
+    (index, снимок метрик), фронтенд передаёт их в registry.merge, чтобы
+    /metrics фронтенда показывал метрики всех процессов.
+    """
+
+    def __init__(self, target, processes, queue_size=1000, start_timeout=60.0, stop_timeout=30.0,
+                 registry=None):
+        self.target = target
+        self.processes = processes
+        self.start_timeout = start_timeout
+        self.stop_timeout = stop_timeout
+        self.registry = registry
+        # spawn: дочерний процесс не наследует потоки и event loop родителя
+        self._ctx = multiprocessing.get_context('spawn')
+        self._queues = [self._ctx.Queue(queue_size) for _ in range(processes)]
+        self._ready = self._ctx.Queue()
+        self._snapshots = self._ctx.Queue()
+        self._collector = None
+        self._procs = []
+
+    def start(self):
+        """Запускает процессы, не дожидаясь их готовности"""
+        if self.registry is not None:
+            self._collector = threading.Thread(target=self._collect_metrics, name="metrics-collector", daemon=True)
+            self._collector.start()
+        for index, updates in enumerate(self._queues):
+            proc = self._ctx.Process(target=self.target,
+                                     args=(index, self.processes, updates, self._ready, self._snapshots),
+                                     name=f"bot-worker-{index}")
+            proc.start()
+            self._procs.append(proc)
+
+    def _collect_metrics(self):
+        while True:
+            item = self._snapshots.get()
+            if item is _STOP:
+                break
+            index, snapshot = item
+            self.registry.merge(index, snapshot)
+
+    def wait_ready(self):
+        """Ждёт готовности процессов. False — если кто-то не запустился"""
+        for _ in self._procs:
+            try:
+                index, ok = self._ready.get(timeout=self.start_timeout)
+            except queue.Empty:
+                logger.error("Процессы-обработчики не запустились за %s с", self.start_timeout,
+                             extra={'stage': 'startup'})
+                return False
+            if not ok:
+                logger.error("Процесс-обработчик %s не запустился", index, extra={'stage': 'startup'})
+                return False
+        logger.info("Запущено процессов-обработчиков: %s", self.processes, extra={'stage': 'startup'})
+        return True
+
+    def submit(self, key, data):
+        """Кладёт обновление в очередь процесса пользователя. False — если очередь переполнена"""
+        try:
+            self._queues[shard_for(key, self.processes)].put_nowait(data)
+            return True
+        except queue.Full:
+            return False
+
+    @property
+    def qsize(self):
+        try:
+            return sum(updates.qsize() for updates in self._queues)
+        except NotImplementedError:
+            # macOS не поддерживает qsize у multiprocessing.Queue
+            return 0
+
+    def stop(self):
+        """Дожидается обработки очередей и останавливает процессы"""
+        for updates in self._queues:
+            updates.put(_STOP)
+        for proc in self._procs:
+            proc.join(self.stop_timeout)
+            if proc.is_alive():
+                logger.error("Процесс %s не остановился за %s с, завершаем", proc.name, self.stop_timeout,
+                             extra={'stage': 'shutdown'})
+                proc.terminate()
+                proc.join()
+        self._procs = []
+        if self._collector is not None:
+            # Последние снимки процессы отправили перед выходом
+            self._snapshots.put(_STOP)
+            self._collector.join()
+            self._collector = None